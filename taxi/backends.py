@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Storage Backends: Task Queue, Object Store and Statistics Table
+#
+# The "aws" backend uses SQS, S3 and DynamoDB. The "local" backend keeps
+# everything under `local_root` on one box, so the whole pipeline can run
+# (and be benchmarked) without network latency:
+#
+#   queue  <local_root>/queue/<queue name>.db   SQLite, with visibility timeout
+#   store  <local_root>/s3/<bucket>/<key>       plain files, range reads
+#   table  <local_root>/ddb/<table name>.db     SQLite, additive counters
+
+from __future__ import print_function
+
+import contextlib
+import os
+import os.path
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+import boto3
+import botocore
+
+from boto3.dynamodb.conditions import Key
+
+__all__ = ['get_backend', 'AWSBackend', 'LocalBackend', 'QueueMessage',
+           'BACKEND_ERRORS']
+
+# errors of any backend call, of AWS services, SQLite files or local files
+BACKEND_ERRORS = (botocore.exceptions.BotoCoreError,
+                  botocore.exceptions.ClientError,
+                  sqlite3.Error, EnvironmentError)
+
+def makedirs(path):
+    if not os.path.isdir(path): os.makedirs(path)
+    return path
+
+class QueueMessage:
+    def __init__(self, message_id, receipt_handle, body):
+        self.message_id = message_id
+        self.receipt_handle = receipt_handle
+        self.body = body
+
+class SQSQueue:
+    def __init__(self, url, region=None):
+        self.url = url
+        self.sqs = boto3.resource('sqs', region_name=region)
+        self.queue = self.sqs.Queue(url)
+
+    def send_message(self, body):
+        self.queue.send_message(MessageBody=body)
+
+    def receive_message(self):
+        messages = self.queue.receive_messages(
+            MaxNumberOfMessages=1, WaitTimeSeconds=1)
+        if not messages: return None
+        m = messages[0]
+        return QueueMessage(m.message_id, m.receipt_handle, m.body)
+
+    def receive_matching(self, n, match, timeout):
+        """Receive for `timeout` seconds those of the next `n` messages
+        that `match`. SQS cannot peek, the others are received as well and
+        made visible again at once, which counts as a receive of them."""
+        messages = self.queue.receive_messages(MaxNumberOfMessages=min(n, 10),
+            WaitTimeSeconds=1, VisibilityTimeout=timeout)
+        received, released = [], []
+        for m in messages:
+            message = QueueMessage(m.message_id, m.receipt_handle, m.body)
+            (received if match(message) else released).append(message)
+        if released:
+            self.queue.change_message_visibility_batch(Entries=[
+                {'Id': str(i), 'ReceiptHandle': m.receipt_handle,
+                 'VisibilityTimeout': 0} for i, m in enumerate(released)])
+        return received
+
+    def change_visibility(self, receipt_handle, timeout):
+        self.queue.Message(receipt_handle).change_visibility(
+            VisibilityTimeout=timeout)
+
+    def delete_message(self, message_id, receipt_handle):
+        self.queue.delete_messages(
+            Entries = [{'Id': message_id, 'ReceiptHandle': receipt_handle}])
+
+    def count(self):
+        self.queue.reload()
+        attr = self.queue.attributes
+        return int(attr['ApproximateNumberOfMessages']), \
+               int(attr['ApproximateNumberOfMessagesNotVisible'])
+
+    def purge(self):
+        self.queue.purge()
+
+class SQLiteFile(object):
+    """A SQLite file of one connection per thread and process
+
+    sqlite3 objects may only be used in the thread that created them, and
+    TaskHeartbeat extends tasks from a thread of its own.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        makedirs(os.path.dirname(path))
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        local = self.local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.db = sqlite3.connect(self.path, timeout=60,
+                                       isolation_level=None)
+            local.pid = os.getpid()
+        return local.db
+
+class SQLiteQueue(SQLiteFile):
+    """A SQS-like queue in a SQLite file shared by local processes"""
+
+    VISIBILITY_TIMEOUT = 30     # SQS default visibility timeout
+
+    def __init__(self, path):
+        super(SQLiteQueue, self).__init__(path)
+        self.url = 'sqlite://' + path
+        self.db.execute('CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT, '
+            'visible REAL, handle TEXT)')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        # HOWTO: take the write lock upfront so receivers never race
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def send_message(self, body):
+        with self.transaction() as db:
+            db.execute('INSERT INTO messages (body, visible) VALUES (?, 0)',
+                (body,))
+
+    def receive_message(self):
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute('SELECT id, body FROM messages WHERE visible <= ? '
+                'ORDER BY id LIMIT 1', (now,)).fetchone()
+            if row is None: return None
+            handle = uuid.uuid4().hex
+            db.execute('UPDATE messages SET visible = ?, handle = ? '
+                'WHERE id = ?', (now + self.VISIBILITY_TIMEOUT, handle, row[0]))
+        return QueueMessage(str(row[0]), handle, str(row[1]))
+
+    def receive_matching(self, n, match, timeout):
+        """Receive for `timeout` seconds those of the next `n` messages
+        that `match`, the others are left as they are"""
+        now = time.time()
+        received = []
+        with self.transaction() as db:
+            rows = db.execute('SELECT id, body FROM messages WHERE visible <= ? '
+                'ORDER BY id LIMIT ?', (now, n)).fetchall()
+            for row in rows:
+                message = QueueMessage(str(row[0]), uuid.uuid4().hex,
+                                       str(row[1]))
+                if not match(message): continue
+                db.execute('UPDATE messages SET visible = ?, handle = ? '
+                    'WHERE id = ?', (now + timeout, message.receipt_handle,
+                                     row[0]))
+                received.append(message)
+        return received
+
+    def change_visibility(self, receipt_handle, timeout):
+        # a stale handle means the message was received again elsewhere
+        with self.transaction() as db:
+            db.execute('UPDATE messages SET visible = ? WHERE handle = ?',
+                (time.time() + timeout, receipt_handle))
+
+    def delete_message(self, message_id, receipt_handle):
+        with self.transaction() as db:
+            db.execute('DELETE FROM messages WHERE handle = ?',
+                (receipt_handle,))
+
+    def count(self):
+        now = time.time()
+        remain = self.db.execute('SELECT COUNT(*) FROM messages '
+            'WHERE visible <= ?', (now,)).fetchone()[0]
+        retry = self.db.execute('SELECT COUNT(*) FROM messages '
+            'WHERE visible > ?', (now,)).fetchone()[0]
+        return remain, retry
+
+    def purge(self):
+        with self.transaction() as db:
+            db.execute('DELETE FROM messages')
+
+class S3Store:
+    def __init__(self, bucket):
+        self.s3 = boto3.resource('s3')
+        self.client = self.s3.meta.client
+        self.bucket = self.s3.Bucket(bucket)
+        self.name = bucket
+        self.uri = 's3://' + bucket
+
+    def exists(self):
+        # HOWTO: check if a bucket exists
+        try:
+            self.client.head_bucket(Bucket=self.name)
+        except botocore.exceptions.ClientError as e:
+            if int(e.response['Error']['Code']) == 404: return False
+            raise
+        return True
+
+    def size(self, key):
+        return self.bucket.Object(key).content_length
+
+    def read_range(self, key, start, end):
+        """Return a stream of bytes [start, end) of an object"""
+        # HOWTO: read object by range
+        bytes_range = 'bytes=%d-%d' % (start, end - 1)
+        return self.bucket.Object(key).get(Range=bytes_range)['Body']
+
+    def get(self, key):
+        try:
+            return self.bucket.Object(key).get()['Body'].read()
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ['NoSuchKey', '404']: return None
+            raise
+
+    def put(self, key, data):
+        self.bucket.Object(key).put(Body=data)
+
+    def upload_fileobj(self, fileobj, key, **kwargs):
+        self.bucket.Object(key).upload_fileobj(fileobj, **kwargs)
+
+class RangeFile:
+    """File-like object limited to `length` bytes from current position"""
+
+    def __init__(self, f, length):
+        self.f = f
+        self.remain = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remain: size = self.remain
+        data = self.f.read(size)
+        self.remain -= len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+class DirectoryStore:
+    """Objects as files in a directory, the local stand-in of a bucket"""
+
+    def __init__(self, path, uri=None):
+        self.path = path
+        self.name = os.path.basename(path.rstrip('/'))
+        self.uri = uri or 'file://' + path
+
+    def exists(self):
+        return os.path.isdir(self.path)
+
+    def size(self, key):
+        return os.path.getsize(os.path.join(self.path, key))
+
+    def read_range(self, key, start, end):
+        f = open(os.path.join(self.path, key), 'rb')
+        f.seek(start)
+        return RangeFile(f, end - start)
+
+    def get(self, key):
+        path = os.path.join(self.path, key)
+        if not os.path.isfile(path): return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, key, data):
+        with self.open_write(key) as f:
+            f.write(data)
+
+    def upload_fileobj(self, fileobj, key, **kwargs):
+        with self.open_write(key) as f:
+            shutil.copyfileobj(fileobj, f, 1024 ** 2)
+
+    @contextlib.contextmanager
+    def open_write(self, key):
+        # HOWTO: write to a temporary file then rename, as S3 put is atomic
+        path = os.path.join(makedirs(self.path), key)
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            yield f
+        os.rename(tmp, path)
+
+class DynamoTable:
+    MAX_UPDATE = 200    # attributes per update, of expressions up to 4KB
+
+    def __init__(self, name, region=None, endpoint=None):
+        self.ddb = boto3.resource('dynamodb',
+            region_name=region, endpoint_url=endpoint)
+        self.table = self.ddb.Table(name)
+        self.name = name
+        self.uri = '%s/%s' % (endpoint, name)
+
+    def exists(self):
+        try:
+            return self.table.table_status == 'ACTIVE'
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ResourceNotFoundException':
+                return False
+            raise
+
+    def create(self):
+        self.table = self.ddb.create_table(
+            TableName=self.name,
+            KeySchema=[
+                {
+                    'AttributeName': 'color',
+                    'KeyType': 'HASH'   # partition key
+                },
+                {
+                    'AttributeName': 'date',
+                    'KeyType': 'RANGE'  # sort key
+                }
+            ],
+            AttributeDefinitions=[
+                {
+                    'AttributeName': 'color',
+                    'AttributeType': 'S'
+                },
+                {
+                    'AttributeName': 'date',
+                    'AttributeType': 'N'
+                },
+
+            ],
+            ProvisionedThroughput={
+                'ReadCapacityUnits': 2,
+                'WriteCapacityUnits': 10
+            }
+        )
+
+    def add(self, key, values):
+        """Add numeric `values` to attributes of item `key`, atomically
+        by updates of at most MAX_UPDATE attributes"""
+        names = sorted(values)
+        for i in range(0, len(names), self.MAX_UPDATE):
+            # HOWTO: contrurct update expression
+            chunk = names[i:i + self.MAX_UPDATE]
+            expr = ','.join(['%s :%s' % (name, name) for name in chunk])
+            self.table.update_item(
+                Key=key,
+                UpdateExpression='add ' + expr,
+                ExpressionAttributeValues=dict(
+                    [(':' + name, values[name]) for name in chunk])
+            )
+
+    def get(self, key):
+        return self.table.get_item(Key=key).get('Item')
+
+    def keys(self, color):
+        # HOWTO: query by partition key
+        response = self.table.query(
+            KeyConditionExpression=Key('color').eq(color))
+        return [{'color': item['color'], 'date': item['date']}
+                for item in response['Items']]
+
+    def delete(self, key):
+        self.table.delete_item(Key=key)
+
+class SQLiteTable(SQLiteFile):
+    """A DynamoDB-like table of additive counters in a SQLite file"""
+
+    def __init__(self, path):
+        super(SQLiteTable, self).__init__(path)
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.uri = 'sqlite://' + path
+
+    def exists(self):
+        return self.db.execute("SELECT name FROM sqlite_master "
+            "WHERE type = 'table' AND name = 'items'").fetchone() is not None
+
+    def create(self):
+        self.db.execute('CREATE TABLE IF NOT EXISTS items ('
+            'color TEXT, date INTEGER, name TEXT, value, '
+            'PRIMARY KEY (color, date, name))')
+
+    def add(self, key, values):
+        db = self.db
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            for name, value in values.items():
+                db.execute('INSERT OR IGNORE INTO items '
+                    'VALUES (?, ?, ?, 0)', (key['color'], key['date'], name))
+                db.execute('UPDATE items SET value = value + ? '
+                    'WHERE color = ? AND date = ? AND name = ?',
+                    (value, key['color'], key['date'], name))
+            db.execute('COMMIT')
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+    def get(self, key):
+        rows = self.db.execute('SELECT name, value FROM items '
+            'WHERE color = ? AND date = ?', (key['color'], key['date']))
+        item = dict(rows.fetchall())
+        if not item: return None
+        item.update(key)
+        return item
+
+    def keys(self, color):
+        rows = self.db.execute('SELECT DISTINCT date FROM items '
+            'WHERE color = ?', (color,))
+        return [{'color': color, 'date': date} for date, in rows.fetchall()]
+
+    def delete(self, key):
+        self.db.execute('DELETE FROM items WHERE color = ? AND date = ?',
+            (key['color'], key['date']))
+
+class AWSBackend:
+    name = 'aws'
+
+    def __init__(self, opts=None):
+        self.region = getattr(opts, 'region', None)
+        self.ddb_endpoint = getattr(opts, 'ddb_endpoint', None)
+
+    def queue(self, url):
+        return SQSQueue(url, self.region)
+
+    def store(self, uri):
+        if uri.startswith('file://'):
+            return DirectoryStore(os.path.realpath(uri[7:]))
+        return S3Store(uri[5:].strip('/'))
+
+    def table(self, name):
+        return DynamoTable(name, self.region, self.ddb_endpoint)
+
+class LocalBackend:
+    name = 'local'
+
+    def __init__(self, opts):
+        self.root = os.path.expanduser(opts.local_root)
+
+    def queue(self, url):
+        name = url.rstrip('/').split('/')[-1]
+        return SQLiteQueue(os.path.join(self.root, 'queue', name + '.db'))
+
+    def store(self, uri):
+        if uri.startswith('file://'):
+            return DirectoryStore(os.path.realpath(uri[7:]))
+        bucket = uri[5:].strip('/')
+        return DirectoryStore(os.path.join(self.root, 's3', bucket), uri)
+
+    def table(self, name):
+        return SQLiteTable(os.path.join(self.root, 'ddb', name + '.db'))
+
+BACKENDS = {
+    'aws': AWSBackend,
+    'local': LocalBackend
+}
+
+def get_backend(opts):
+    """Backend selected by `backend` in config.ini, AWS by default"""
+    return BACKENDS[getattr(opts, 'backend', 'aws')](opts)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Microbenchmarks of Mapper, Reader and Converter Hot Paths
+
+from __future__ import print_function
+
+import copy
+import json
+import logging
+import multiprocessing
+import os.path
+import pickle
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from common import *
+from mapred import NYCTaxiStat, RecordReader, StatDB, TaxiStat
+from mapred import start_multiprocess
+from raw2aws import RawReader
+from synth import TripGenerator
+from backends import get_backend
+
+logging.basicConfig()
+logger = logging.getLogger(os.path.basename(__file__))
+
+def parse_argv():
+    o = Options()
+    o.add('-n', '--records', metavar='NUM', type=int,
+        default=100000, help="records per benchmark")
+    o.add('--repeat', metavar='NUM', type=int,
+        default=3, help="repeat each benchmark and take the best")
+    o.add('--only', metavar='NAME', type=str, nargs='*',
+        default=None, help="run only these benchmarks")
+    o.add('--baseline', metavar='PATH', type=str,
+        default='bench_baseline.json', help="baseline file")
+    o.add('--save-baseline', dest='save_baseline', action='store_true',
+        default=False, help="save results as new baseline")
+    o.add('--tolerance', metavar='RATIO', type=float,
+        default=0.2, help="slowdown over baseline flagged as regression")
+    o.add('--scaling', action='store_true',
+        default=False, help="benchmark start_multiprocess across --procs")
+    o.add('--procs', metavar='NUM', type=int, nargs='*', dest='procs_list',
+        default=None, help="process counts of scaling benchmark")
+    o.add('--csv', metavar='PATH', type=str,
+        default=None, help="also write scaling results as CSV")
+
+    opts = o.load()
+    opts.baseline = os.path.join(os.path.dirname(__file__), opts.baseline)
+    logger.setLevel(opts.verbose)
+    return opts
+
+class Benchmark:
+    """Time hot paths on deterministic synthetic trips of one month
+
+    Each bench_<name> method prepares its input and returns the number of
+    items processed per run and the function to time, so that setup is
+    never part of the measured rate.
+    """
+
+    BENCHMARKS = ['search', 'readlines.file', 'readlines.store',
+                  'readlines.zblock', 'readcolumns', 'add',
+                  'statdb.encode', 'statdb.decode', 'reformat', 'convert',
+                  'read']
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.generator = TripGenerator(opts.color, opts.year, opts.month)
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-bench-')
+        self.results = []
+
+    def mapper_opts(self, n, **kwargs):
+        opts = copy.copy(self.opts)
+        opts.src = 'file://' + self.tmpdir
+        opts.start, opts.end, opts.nprocs = 0, n, 1
+        opts.backend, opts.local_root = 'local', self.tmpdir
+        opts.profile, opts.where, opts.columns = None, None, None
+        opts.queries = [[]]
+        for name, value in kwargs.items(): setattr(opts, name, value)
+        return opts
+
+    def sample_stat(self, n):
+        stat = NYCTaxiStat(self.mapper_opts(n))
+        for line in self.generator.records(n): stat.search(line)
+        return stat
+
+    def bench_search(self, n):
+        n = max(n / 50, 1)  # point-in-polygon lookups are slow
+        stat = NYCTaxiStat(self.mapper_opts(n))
+        lines = list(self.generator.records(n))
+        def run():
+            for line in lines: stat.search(line)
+        return len(lines), run
+
+    def bench_readlines_file(self, n):
+        self.generator.write_records(self.tmpdir, n)
+        opts = self.mapper_opts(n)
+        reader = RecordReader(get_backend(opts))
+        def run():
+            with reader.open(opts.color, opts.year, opts.month,
+                             opts.src, 0, n) as fin:
+                for line in fin.readlines(): pass
+        return n, run
+
+    def bench_readlines_store(self, n):
+        bucket = os.path.join(self.tmpdir, 's3', 'bench')
+        if not os.path.isdir(bucket): os.makedirs(bucket)
+        self.generator.write_records(bucket, n)
+        opts = self.mapper_opts(n, src='s3://bench')
+        reader = RecordReader(get_backend(opts))
+        def run():
+            with reader.open(opts.color, opts.year, opts.month,
+                             opts.src, 0, n) as fin:
+                for line in fin.readlines(): pass
+        return n, run
+
+    def bench_readlines_zblock(self, n):
+        bucket = os.path.join(self.tmpdir, 's3', 'bench')
+        if not os.path.isdir(bucket): os.makedirs(bucket)
+        self.generator.write_records(bucket, n, 'zblock')
+        opts = self.mapper_opts(n, src='s3://bench', record_format='zblock')
+        reader = RecordReader(get_backend(opts), opts.record_format)
+        def run():
+            with reader.open(opts.color, opts.year, opts.month,
+                             opts.src, 0, n) as fin:
+                for line in fin.readlines(): pass
+        return n, run
+
+    def bench_readcolumns(self, n):
+        bucket = os.path.join(self.tmpdir, 's3', 'bench')
+        if not os.path.isdir(bucket): os.makedirs(bucket)
+        self.generator.write_records(bucket, n, 'columnar')
+        opts = self.mapper_opts(n, src='s3://bench', record_format='columnar')
+        reader = RecordReader(get_backend(opts), opts.record_format)
+        def run():
+            with reader.open(opts.color, opts.year, opts.month,
+                             opts.src, 0, n) as fin:
+                for columns in fin.readcolumns(NYCTaxiStat.COLUMNS):
+                    pass
+        return n, run
+
+    def bench_add(self, n):
+        n = max(n / 100, 1)
+        master, other = self.sample_stat(500), self.sample_stat(500)
+        def run():
+            for i in range(n): master.__add__(other)
+        return n, run
+
+    def bench_statdb_encode(self, n):
+        n = max(n / 100, 1)
+        stat = self.sample_stat(500)
+        def run():
+            for i in range(n): StatDB.encode(stat)
+        return n, run
+
+    def bench_statdb_decode(self, n):
+        n = max(n / 100, 1)
+        stat = self.sample_stat(500)
+        values = StatDB.encode(stat)
+        def run():
+            for i in range(n): StatDB.decode(values, TaxiStat())
+        return n, run
+
+    def raw_reader(self):
+        reader = RawReader()
+        reader.color = self.opts.color
+        reader.year, reader.month = self.opts.year, self.opts.month
+        return reader
+
+    def bench_reformat(self, n):
+        reader = self.raw_reader()
+        lines = list(self.generator.raw_lines(n))[2:]
+        def run():
+            for line in lines: reader.reformat(line)
+        return n, run
+
+    def bench_convert(self, n):
+        from converter import VectorConverter
+        converter = VectorConverter(self.raw_reader())
+        data = ''.join(list(self.generator.raw_lines(n))[2:])
+        chunks, start = [], 0
+        while start < len(data):
+            end = data.find('\n', start + RawReader.CHUNK_SIZE) + 1 or len(data)
+            chunks.append(data[start:end])
+            start = end
+        def run():
+            for chunk in chunks: converter.convert(chunk)
+        return n, run
+
+    def bench_read(self, n):
+        # RawReader.read as boto3 pulls multipart chunks of 8MB
+        self.generator.write_raw(self.tmpdir, n)
+        reader = self.raw_reader()
+        def run():
+            with reader.open(self.opts.color, self.opts.year, self.opts.month,
+                             'file://' + self.tmpdir, sys.maxint,
+                             RawReader.DEFAULT_BUFFER_SIZE) as fin:
+                size = 0
+                while True:
+                    data = fin.read(8 * 1024 * 1024)
+                    if not data: break
+                    size += len(data)
+            logger.info('read: %.2f copies per byte' % \
+                (reader.buf.copied / float(max(size, 1))))
+        return n, run
+
+    def measure(self, name):
+        count, run = getattr(self, 'bench_' + name.replace('.', '_'))(
+            self.opts.records)
+        best = None
+        for i in range(self.opts.repeat):
+            elapsed = time.time()
+            run()
+            elapsed = time.time() - elapsed
+            if best is None or elapsed < best: best = elapsed
+        return count, best
+
+    def load_baseline(self):
+        try:
+            with open(self.opts.baseline, 'r') as f:
+                return json.load(f)['rates']
+        except (IOError, ValueError, KeyError):
+            return {}
+
+    def save_baseline(self):
+        with open(self.opts.baseline, 'w') as f:
+            json.dump({
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'records': self.opts.records,
+                'rates': dict([(name, round(rate, 1))
+                    for name, _, _, rate in self.results])
+            }, f, indent=2, sort_keys=True)
+
+    def report(self, baseline):
+        regressions = []
+        format_str = "%16s %10s %10s %14s %14s %8s"
+        print(format_str % ('Benchmark', 'Items', 'Seconds',
+                            'Items/sec', 'Baseline', 'Change'))
+        for name, count, elapsed, rate in self.results:
+            base = baseline.get(name)
+            change, status = '', ''
+            if base:
+                change = '%+.1f%%' % ((rate / base - 1) * 100)
+                if rate < base * (1 - self.opts.tolerance):
+                    status = ' REGRESSION'
+                    regressions.append(name)
+            print(format_str % (name, count, '%.3f' % elapsed, '%.1f' % rate,
+                base or '-', change) + status)
+        return regressions
+
+    def scaling(self):
+        """Run one synthetic month with 1, 2, 4, ... processes"""
+        procs_list = self.opts.procs_list
+        if not procs_list:
+            cpus = multiprocessing.cpu_count()
+            procs_list = [n for n in [1, 2, 4, 8, 16, 32, 64] if n < cpus]
+            procs_list.append(cpus)
+
+        n = self.opts.records
+        self.generator.write_records(self.tmpdir, n)
+        columns = ['procs', 'wall', 'speedup', 'efficiency', 'pool', 'load',
+                   'map', 'reduce', 'max_rss_kb', 'mean_rss_kb', 'result_bytes']
+        rows = []
+        try:
+            for nprocs in procs_list:
+                logger.info('scaling %d processes => start' % nprocs)
+                opts = self.mapper_opts(n, nprocs=nprocs, report=False)
+                master = start_multiprocess(opts)
+                t = master.timings
+                if not rows: base = t['wall']
+                rows.append([nprocs, t['wall'], base / t['wall'],
+                    base / t['wall'] / nprocs, t['pool'], t['load'], t['map'],
+                    t['reduce'], max(master.mappers_rss),
+                    sum(master.mappers_rss) / len(master.mappers_rss),
+                    len(pickle.dumps(master, pickle.HIGHEST_PROTOCOL))])
+        finally:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+        print(''.join(['%13s' % name for name in columns]))
+        for row in rows:
+            print(''.join(['%13.3f' % x if isinstance(x, float) else '%13d' % x
+                           for x in row]))
+        if self.opts.csv:
+            with open(self.opts.csv, 'w') as f:
+                f.write(','.join(columns) + '\n')
+                for row in rows:
+                    f.write(','.join([str(x) for x in row]) + '\n')
+
+    def run(self):
+        if self.opts.scaling: return self.scaling()
+
+        names = self.opts.only or self.BENCHMARKS
+        try:
+            for name in names:
+                logger.info('%s => start' % name)
+                count, elapsed = self.measure(name)
+                self.results.append((name, count, elapsed,
+                    count / max(elapsed, 1e-9)))
+        finally:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+        regressions = self.report(self.load_baseline())
+        if self.opts.save_baseline:
+            self.save_baseline()
+            print('Baseline saved to %s' % self.opts.baseline)
+        elif regressions:
+            fatal('regression in %s' % ', '.join(regressions))
+
+if __name__ == '__main__':
+    Benchmark(parse_argv()).run()
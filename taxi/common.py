@@ -5,19 +5,29 @@ from __future__ import print_function
 
 import argparse
 import datetime
+import json
 import logging
 import os.path
 import sys
 import ConfigParser
 
-import boto3
+from backends import AWSBackend
 
-__all__ = ['RECORD_LENGTH', 'MIN_DATE', 'MAX_DATE', 'BASE_DATE', \
+__all__ = ['RECORD_LENGTH', 'RECORD_FORMATS', \
+           'MIN_DATE', 'MAX_DATE', 'BASE_DATE', \
            'fatal', 'error', \
            'get_file_name', 'get_file_size', 'get_file_length', \
-           'Options']
+           'get_marker', 'parse_marker', \
+           'get_index_name', 'get_zonemap_name', \
+           'parse_time', 'TimeIndex', \
+           'load_config', 'Options']
 
 RECORD_LENGTH = 80
+RECORD_FORMATS = {  # file name suffix of record formats
+    'plain': '',    # records as they are
+    'zblock': '.zb', # blocks of records compressed by zlib, see formats.py
+    'columnar': '.col' # row groups of typed columns, see formats.py
+}
 MIN_DATE = {
     'yellow': datetime.datetime(2009, 1, 1),
     'green' : datetime.datetime(2013, 8, 1)
@@ -37,11 +47,13 @@ def error(message):
     sys.stderr.write('error: %s\n' % message)
     sys.stderr.flush()
 
-def get_file_name(color, year, month):
-    return '%s-%s-%02d.csv' % (color, year, int(month))
+def get_file_name(color, year, month, record_format='plain'):
+    return '%s-%s-%02d.csv%s' % (color, year, int(month),
+                                 RECORD_FORMATS[record_format])
 
-def get_file_size(source, color, year, month):
-    name = get_file_name(color, year, month)
+def get_file_size(source, color, year, month, backend=None,
+                  record_format='plain'):
+    name = get_file_name(color, year, month, record_format)
 
     if source.startswith('file://'):
         directory = os.path.realpath(source[7:])
@@ -57,20 +69,146 @@ def get_file_size(source, color, year, month):
         return os.path.getsize(path)
 
     elif source.startswith('s3://'):
-        s3 = boto3.resource('s3')
-        bucket = s3.Bucket(source[5:])
-
+        bucket = (backend or AWSBackend()).store(source)
+        if not bucket.exists():
+            fatal("%s does not exists" % source)
+
+        return bucket.size(name)
+
+def get_file_length(source, color, year, month, backend=None,
+                    record_format='plain'):
+    size = get_file_size(source, color, year, month, backend, record_format)
+    if record_format == 'plain': return size / RECORD_LENGTH
+    from formats import count_records # formats imports common
+    return count_records((backend or AWSBackend()).store(source),
+        get_file_name(color, year, month, record_format), record_format)
+
+def get_marker(color, year, month):
+    """Record announcing the month of the records streamed after it"""
+    marker = '#%s,%d,%02d,' % (color, year, int(month))
+    return marker.ljust(RECORD_LENGTH - 1, '*') + '\n'
+
+def parse_marker(line):
+    color, year, month, _ = line[1:].split(',')
+    return color, int(year), int(month)
+
+def get_index_name(color, year, month):
+    return get_file_name(color, year, month) + '.index.json'
+
+def get_zonemap_name(color, year, month):
+    return get_file_name(color, year, month) + '.zonemap.json'
+
+def parse_time(text):
+    """Datetime of 'YYYY-MM-DD' or 'YYYY-MM-DDTHH', hours of time index"""
+    for format in ['%Y-%m-%dT%H', '%Y-%m-%d %H', '%Y-%m-%d']:
         try:
-            s3.meta.client.head_bucket(Bucket=bucket.name)
-        except botocore.exceptions.ClientError as e:
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
-                fatal("%s does not exists" % self.opts.dst)
+            return datetime.datetime.strptime(text, format)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('invalid time: %s' % text)
+
+class TimeIndex:
+    """Record offsets of the hours of a month sorted by pickup time
+
+    `hours[h]` is the number of records picked up before hour `h` of the
+    month, for h in [0, hours of month], so the records of hour `h` are
+    [hours[h], hours[h+1]) and those of day `d` start at hours[24 * d].
+    Records picked up outside of the month, bad raw data, are sorted
+    before hours[0] or from hours[-1].
+    """
+
+    def __init__(self, color, year, month, hours, records):
+        self.color = color
+        self.year = year
+        self.month = month
+        self.hours = hours
+        self.records = records
+        self.date = datetime.datetime(year, month, 1)
+
+    PICKUP_WIDTH = 20   # characters of a record holding its pickup time
+
+    @classmethod
+    def pickups(cls, rows):
+        """Pickup times in seconds since BASE_DATE of an (n, RECORD_LENGTH)
+        array of records"""
+        import numpy
+        # HOWTO: one column of characters at a time, up to the first comma
+        value = numpy.zeros(len(rows), numpy.int64)
+        inside = numpy.ones(len(rows), bool)
+        for k in range(cls.PICKUP_WIDTH):
+            column = rows[:, k]
+            inside &= column != 44      # ','
+            digit = inside & (column >= 48) & (column <= 57)
+            value = numpy.where(digit, value * 10 + column - 48, value)
+        return numpy.where(rows[:, 0] == 45, -value, value)   # '-'
 
-        return bucket.Object(name).content_length
+    @classmethod
+    def sort(cls, color, year, month, data):
+        """Records of data sorted by pickup time, an (n, RECORD_LENGTH)
+        array, and their index
+
+        The records are sorted in memory. Peak memory is about twice their
+        size, data and its sorted copy: some 2 GB for a yellow month.
+        """
+        import numpy
+        if data:
+            rows = numpy.frombuffer(data, numpy.uint8).reshape(
+                -1, RECORD_LENGTH)
+        else:
+            rows = numpy.zeros((0, RECORD_LENGTH), numpy.uint8)
+        pickups = cls.pickups(rows)
+        order = numpy.argsort(pickups, kind='mergesort') # ties keep raw order
+
+        date = datetime.datetime(year, month, 1)
+        end = datetime.datetime(year + month / 12, month % 12 + 1, 1)
+        start = int((date - BASE_DATE).total_seconds())
+        n_hours = int((end - date).total_seconds()) / 3600
+        hours = numpy.searchsorted(pickups[order],
+            start + 3600 * numpy.arange(n_hours + 1), 'left').tolist()
+        return rows[order], cls(color, year, month, hours, len(rows))
+
+    def range(self, start=None, end=None):
+        """Records [first, last) picked up from `start` until `end`"""
+        def offset(time, default):
+            if time is None: return default
+            h = int((time - self.date).total_seconds()) // 3600
+            if h < 0: return 0
+            if h >= len(self.hours): return self.records
+            return self.hours[h]
+        first, last = offset(start, 0), offset(end, self.records)
+        return first, max(first, last)
+
+    def encode(self):
+        return json.dumps({
+            'color': self.color,
+            'year': self.year,
+            'month': self.month,
+            'records': self.records,
+            'hours': self.hours
+        })
+
+    @classmethod
+    def decode(cls, body):
+        index = json.loads(body)
+        return cls(index['color'], index['year'], index['month'],
+                   index['hours'], index['records'])
 
-def get_file_length(source, color, year, month):
-    return get_file_size(source, color, year, month) / RECORD_LENGTH
+    @classmethod
+    def load(cls, store, color, year, month):
+        """Index of a month in a store, None if it was not sorted"""
+        body = store.get(get_index_name(color, year, month))
+        if body is None: return None
+        return cls.decode(body)
+
+def load_config(opts, config='config.ini', debug=False):
+    """Set options of the 'debug' or 'default' profile of a config file"""
+    p = ConfigParser.SafeConfigParser()
+    cwd = os.path.dirname(__file__)
+    p.read(os.path.join(cwd, config))
+    profile = 'debug' if debug else 'default'
+    for name, value in p.items(profile):
+        setattr(opts, name, value)
+    return opts
 
 class Options:
     def __init__(self):
@@ -116,14 +254,7 @@ class Options:
         self. _validate()
 
         # load configurations
-        p = ConfigParser.SafeConfigParser()
-        cwd = os.path.dirname(__file__)
-        p.read(os.path.join(cwd, self.opts.config))
-        profile = 'debug' if self.opts.debug else 'default'
-        for name, value in p.items(profile):
-            setattr(self.opts, name, value)
-
-        return self.opts
+        return load_config(self.opts, self.opts.config, self.opts.debug)
 
     def _validate(self):
         if self.opts.color not in ['yellow', 'green']:
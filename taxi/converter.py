@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Chunked Vectorized Conversion of Raw Taxi Trips
+#
+# Converts a chunk of whole raw TLC lines at once with numpy into the same
+# fixed-length records RawReader.reformat produces line by line. Rows that
+# cannot be proven to convert identically (unusual number notation, odd
+# timestamps, ties in rounding, over-long records, ...) are handed back to
+# RawReader.reformat, so the output is byte-identical.
+
+from __future__ import print_function
+
+import io
+
+import numpy as np
+
+__all__ = ['VectorConverter']
+
+RECORD_LENGTH = 80
+BASE_DAYS = 14245                       # 2009-01-01 in days since 1970-01-01
+POW10 = 10 ** np.arange(19, dtype=np.int64)
+POW10F = np.array([float('1e%d' % k) for k in range(23)])   # exact doubles
+DIGITS4 = np.array(['%04d' % i for i in range(10000)], 'S4').view(np.uint32)
+
+def days_from_civil(year, month, day):
+    """Days since 1970-01-01 of proleptic Gregorian dates (vectorized)"""
+    # HOWTO: http://howardhinnant.github.io/date_algorithms.html
+    year = year - (month <= 2)
+    era = year // 400
+    yoe = year - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+def date_table(first_year=1970, last_year=2099):
+    """Seconds since 2009-01-01 by ((year - first_year) * 12 + month - 1)
+    * 32 + day, -1 for invalid days"""
+    year, month, day = np.meshgrid(np.arange(first_year, last_year + 1),
+        np.arange(1, 13), np.arange(32), indexing='ij')
+    days = days_from_civil(year, month, np.maximum(day, 1))
+    following = days_from_civil(year + (month == 12), month % 12 + 1, 1)
+    valid = (day >= 1) & (days < following)
+    return np.where(valid, (days - BASE_DAYS) * 86400, -1).reshape(-1)
+
+DATES = date_table()
+DIGIT_COLUMNS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+LOW_BITS = (np.uint64(1) << np.arange(33, dtype=np.uint64)) - np.uint64(1)
+SPREAD = np.uint64(0x8040201008040201)  # 0/1 bytes of a word to 8 bits
+U8, U56 = np.uint64(8), np.uint64(56)
+WHITESPACE = np.zeros(256, dtype=bool)
+WHITESPACE[[9, 10, 11, 12, 13, 32]] = True
+
+def window(buf, end, width):
+    """(n, width) characters ending right before `end`"""
+    # HOWTO: a void view of overlapping items copies each row at once
+    view = np.ndarray(shape=(len(buf) - width + 1,), dtype='V%d' % width,
+                      buffer=buf, strides=(1,))
+    return view[np.maximum(end - width, 0)].view(np.uint8).reshape(-1, width)
+
+def parse_datetime(buf, start, end):
+    """Seconds since 2009-01-01 of 'YYYY-MM-DD HH:MM:SS' fields"""
+    chars = window(buf, end, 19)
+    digits = chars[:, DIGIT_COLUMNS] - np.uint8(48)
+    ok = (end - start == 19) & (end >= 19) & (digits <= 9).all(1) & \
+         (chars[:, 4] == 45) & (chars[:, 7] == 45) & (chars[:, 10] == 32) & \
+         (chars[:, 13] == 58) & (chars[:, 16] == 58)
+
+    # century, year, month, day, hour, minute, second
+    pairs = (digits[:, 0::2] * np.uint8(10) + digits[:, 1::2]).astype(np.int64)
+    year = pairs[:, 0] * 100 + pairs[:, 1]
+    key = ((year - 1970) * 12 + pairs[:, 2] - 1) * 32 + pairs[:, 3]
+    valid = (year >= 1970) & (pairs[:, 2] >= 1) & (pairs[:, 2] <= 12) & \
+            (pairs[:, 3] < 32) & (key < len(DATES))
+    date = DATES[np.where(valid, key, 0)]
+    ok &= valid & (date >= 0) & \
+          (pairs[:, 4] < 24) & (pairs[:, 5] < 60) & (pairs[:, 6] < 60)
+    seconds = date + pairs[:, 4] * 3600 + pairs[:, 5] * 60 + pairs[:, 6]
+    return seconds, ok
+
+def parse_decimal(buf, start, end, width):
+    """Sign, mantissa, scale and validity of '[-]digits[.digits]' fields"""
+    n, length = len(start), end - start
+    words = (width + 7) // 8
+    negative = buf[np.minimum(start, len(buf) - 1)] == 45
+    chars = window(buf, end, 8 * words)
+    digits = chars - np.uint8(48)
+    other = digits > 9
+
+    # bit r of `mask`: non-digit r characters before the end, within field
+    flags = other.view(np.uint64)
+    mask = np.zeros(n, dtype=np.uint64)
+    for k in range(words):
+        mask = (mask << U8) | (flags[:, k] * SPREAD >> U56)
+    size = np.minimum(length, width)
+    mask = (mask & LOW_BITS[size - negative]).astype(np.int64)
+
+    # at most one non-digit left, and it is the decimal point
+    dot = mask > 0
+    scale = np.frexp(mask)[1] - dot
+    ok = (length <= width) & (end >= 8 * words) & \
+         ((mask & (mask - 1)) == 0) & (length - negative - dot >= 1)
+    ok &= ~dot | (chars[np.arange(n), 8 * words - 1 - scale] == 46)
+
+    # eight digits of a word at once, dropping digits before the field,
+    # then close the gap of the decimal point
+    values = digits.view(np.uint64) & ~(flags * np.uint64(0xff))
+    total = np.zeros(n, dtype=np.int64)
+    for k in range(words):
+        value = (values[:, k] * np.uint64(2561)) >> U8
+        value = ((value & np.uint64(0x00ff00ff00ff00ff)) * \
+                 np.uint64(6553601)) >> np.uint64(16)
+        value = ((value & np.uint64(0x0000ffff0000ffff)) * \
+                 np.uint64(42949672960001)) >> np.uint64(32)
+        inside = np.clip(size - 8 * (words - 1 - k), 0, 8)
+        total = total * POW10[8] + (value.astype(np.int64) % POW10[inside])
+    right = total % POW10[scale]
+    mantissa = np.where(dot, (total - right) // 10 + right, total)
+    return negative, mantissa, scale, ok
+
+def fixed_point(mantissa, scale, decimals):
+    """Integer value of '%.<decimals>f' % float(mantissa / 10 ** scale)"""
+    # exact decimals: the double rounds back to the same digits
+    exact = scale <= decimals
+    factor = POW10[np.clip(decimals - scale, 0, 18)]
+
+    # more decimals: float(s) is the correctly rounded quotient if both
+    # operands are exact doubles, then round unless too close to a tie
+    t = mantissa / POW10F[np.minimum(scale, 22)] * POW10F[decimals]
+    floor = np.floor(t)
+    fraction = t - floor
+    value = np.where(exact, mantissa * factor,
+                     floor.astype(np.int64) + (fraction > 0.5))
+    ok = np.where(exact, mantissa < (2 ** 50) // factor,
+                  (mantissa < 2 ** 53) & (scale <= 22) & (t < 2 ** 40) & \
+                  (np.abs(fraction - 0.5) > 1e-3))
+    return value, ok
+
+def digit_chars(value, groups):
+    """(n, 4 * groups) decimal digits of non-negative integers, zero padded"""
+    chars = np.empty((len(value), groups), dtype=np.uint32)
+    for k in range(groups - 1, -1, -1):
+        value, rest = np.divmod(value, 10000)
+        chars[:, k] = DIGITS4[rest]
+    return chars.view(np.uint8)
+
+def format_fixed(value, negative, decimals):
+    """Right-aligned '[-]digits[.digits],' characters and their lengths"""
+    n = len(value)
+    integer, fraction = np.divmod(value, POW10[decimals])
+    width = len(str(int(integer.max()))) if n else 1
+    ndigits = np.searchsorted(POW10[1:width], integer, side='right') + 1
+
+    parts = [np.zeros((n, 1), dtype=np.uint8),
+             digit_chars(integer, (width + 3) // 4)[:, -width:]]
+    tail = 0
+    if decimals:
+        parts += [np.full((n, 1), 46, dtype=np.uint8),
+                  digit_chars(fraction, (decimals + 3) // 4)[:, -decimals:]]
+        tail = decimals + 1
+    parts.append(np.full((n, 1), 44, dtype=np.uint8))
+    chars = np.hstack(parts)
+
+    rows = np.flatnonzero(negative)
+    chars[rows, chars.shape[1] - 2 - tail - ndigits[rows]] = 45
+    return chars, ndigits + negative + tail + 1
+
+class VectorConverter:
+    FIELDS = ['pickup_datetime', 'dropoff_datetime',
+              'pickup_longitude', 'pickup_latitude',
+              'dropoff_longitude', 'dropoff_latitude',
+              'trip_distance', 'fare_amount']
+    COORDINATES = FIELDS[2:6]
+    DECIMALS = {
+        'pickup_longitude': 6, 'pickup_latitude': 6,
+        'dropoff_longitude': 6, 'dropoff_latitude': 6,
+        'trip_distance': 2, 'fare_amount': 2
+    }
+    FIELD_WIDTH = 18    # longer numbers go to the line by line path
+
+    def __init__(self, reader):
+        self.reader = reader    # RawReader for column layout and fallback
+        columns = reader.columns(reader.color, reader.year, reader.month)
+        self.n_columns = len(columns)
+        self.index = dict([(name, columns.index(name))
+                           for name in self.FIELDS])
+        self.fallbacks = 0
+
+    def split(self, buf):
+        """Line bounds, and field bounds of lines with the right columns"""
+        separators = np.flatnonzero((buf == 44) | (buf == 10))
+        newline = buf[separators] == 10
+        if len(buf) and buf[-1] != 10:
+            separators = np.append(separators, len(buf))
+            newline = np.append(newline, True)
+        newline = np.flatnonzero(newline)
+        first = np.append(0, newline[:-1] + 1)   # first separator of lines
+        ends = separators[newline]
+        starts = np.append(0, ends[:-1] + 1)
+        line_ends = ends.copy()
+
+        # line.strip(): drop one '\r', anything else falls back
+        nonempty = line_ends > starts
+        cr = nonempty & (buf[np.maximum(line_ends - 1, 0)] == 13)
+        line_ends[cr] -= 1
+        nonempty = line_ends > starts
+        clean = nonempty & ~WHITESPACE[buf[np.maximum(line_ends - 1, 0)]] & \
+                ~WHITESPACE[buf[np.minimum(starts, len(buf) - 1)]]
+        ok = clean & (newline - first == self.n_columns - 1)
+
+        bounds = {}
+        rows = np.flatnonzero(ok)
+        for name, k in self.index.items():
+            if k == 0: field_start = starts[rows]
+            else: field_start = separators[first[rows] + k - 1] + 1
+            if k == self.n_columns - 1: field_end = line_ends[rows]
+            else: field_end = separators[first[rows] + k]
+            bounds[name] = (field_start, field_end)
+        return starts, ends, rows, bounds
+
+    def assemble(self, fields, n):
+        """Fixed-length records of rows, grouped by lengths of fields"""
+        out = np.empty((n, RECORD_LENGTH), dtype=np.uint8)
+        key = np.zeros(n, dtype=np.int64)
+        for chars, length in fields:
+            key = key * 32 + length
+        order = np.argsort(key)
+        key = key[order]
+        begin = 0
+        for end in np.append(np.flatnonzero(key[1:] != key[:-1]) + 1, n):
+            if end == begin: continue
+            rows = order[begin:end]
+            block = np.empty((len(rows), RECORD_LENGTH), dtype=np.uint8)
+            position = 0
+            for chars, length in fields:
+                size = length[rows[0]]
+                block[:, position:position + size] = \
+                    chars.take(rows, axis=0)[:, -size:]
+                position += size
+            block[:, position:-1] = 42
+            block[:, -1] = 10
+            out[rows] = block
+            begin = end
+        return out.tobytes()
+
+    def convert(self, chunk):
+        """Convert a chunk of whole raw lines to fixed-length records"""
+        if len(chunk) < RECORD_LENGTH: # too short for windows of fields
+            return b''.join(filter(None, [self.reader.reformat(line)
+                for line in io.BytesIO(chunk)]))
+        buf = np.frombuffer(chunk, dtype=np.uint8)
+        starts, ends, rows, bounds = self.split(buf)
+
+        # 0: dropped, 1: vectorized, 2: line by line
+        status = np.full(len(starts), 2, dtype=np.int8)
+
+        # checking and compact data, as reformat
+        zero = np.zeros(len(rows), dtype=bool)
+        for name in self.COORDINATES:
+            start, end = bounds[name]
+            zero |= (end - start == 1) & \
+                    (buf[np.minimum(start, len(buf) - 1)] == 48)
+        status[rows[zero]] = 0
+
+        ok = ~zero
+        fields = []
+        for name in self.FIELDS:
+            start, end = bounds[name]
+            if name.endswith('datetime'):
+                seconds, valid = parse_datetime(buf, start, end)
+                negative, value, decimals = seconds < 0, np.abs(seconds), 0
+            else:
+                decimals = self.DECIMALS[name]
+                width = int((end - start).max()) if len(start) else 1
+                width = max(min(width, self.FIELD_WIDTH), 1)
+                negative, mantissa, scale, valid = \
+                    parse_decimal(buf, start, end, width)
+                value, exact = fixed_point(mantissa, scale, decimals)
+                valid &= exact
+            ok &= valid
+            fields.append((value, negative, decimals))
+
+        # record must fit with the padding, otherwise reformat decides
+        fields = [format_fixed(value[ok], negative[ok], decimals)
+                  for value, negative, decimals in fields]
+        fit = sum([length for _, length in fields]) <= RECORD_LENGTH - 1
+        if not fit.all():
+            ok[ok] = fit
+            fields = [(chars[fit], length[fit]) for chars, length in fields]
+        status[rows[ok]] = 1
+        records = self.assemble(fields, int(ok.sum()))
+
+        fallbacks = np.flatnonzero(status == 2)
+        self.fallbacks += len(fallbacks)
+        if not len(fallbacks): return records
+
+        # splice line by line results into vectorized records in order
+        output, done = [], 0
+        converted = np.cumsum(status == 1)
+        for i in fallbacks:
+            upto = converted[i]
+            output.append(records[done * RECORD_LENGTH:upto * RECORD_LENGTH])
+            done = upto
+            line = self.reader.reformat(chunk[starts[i]:ends[i] + 1])
+            if line: output.append(line)
+        output.append(records[done * RECORD_LENGTH:])
+        return b''.join(output)
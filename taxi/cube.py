@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# District Cube: Trips by District, Weekday and Hour
+#
+# Pickups by pickup district and the hour of the week of pickup, and
+# dropoffs by dropoff district and the hour of the week of dropoff, in a
+# flat array of 2 * N * 168 counters at
+#
+#   (kind * N + district number) * 168 + weekday * 24 + hour
+#
+# kind 0 of pickups and 1 of dropoffs, districts numbered as in
+# odmatrix.py. BASE_DATE is a midnight, so the hour of the week of seconds
+# since BASE_DATE is their hours plus those of the weekday of BASE_DATE,
+# modulo 168: the columnar mapper indexes a whole row group with numpy, and
+# slices such as Brooklyn pickups by hour on weekends are sums over the
+# cube, in memory.
+#
+# StatDB keeps nonzero counters, one item per district under the hash key
+# '<color>#cube<index>', of attributes 'p<hour of week>' of pickups and
+# 'r<hour of week>' of dropoffs, at most 336 of them.
+
+from __future__ import print_function
+
+from collections import Counter
+
+from common import *
+from odmatrix import DistrictCounters
+
+__all__ = ['DistrictCube', 'HOURS', 'WEEKDAYS', 'WEEKENDS']
+
+HOURS = 7 * 24                          # hours of a week
+BASE_HOUR = BASE_DATE.weekday() * 24    # hour of the week of BASE_DATE
+WEEKDAYS = [0, 1, 2, 3, 4]              # Monday is 0, as datetime's
+WEEKENDS = [5, 6]
+
+class DistrictCube(DistrictCounters):
+    """Pickups and dropoffs by district index, None of out of every
+    district, weekday and hour, in a flat array of counters"""
+
+    KINDS = ['pickups', 'dropoffs']
+
+    def length(self):
+        return len(self.KINDS) * self.size * HOURS
+
+    def add(self, pickup, dropoff, pickup_time, dropoff_time):
+        """Count a trip of times in seconds since BASE_DATE"""
+        numbers = self.numbers
+        i = numbers[pickup] * HOURS + (pickup_time // 3600 + BASE_HOUR) % HOURS
+        j = (self.size + numbers[dropoff]) * HOURS + \
+            (dropoff_time // 3600 + BASE_HOUR) % HOURS
+        try:
+            self.counts[i] += 1
+        except TypeError:   # HOWTO: None, the first trip counted
+            self.counts = self.zeros()
+            self.counts[i] += 1
+        self.counts[j] += 1
+
+    def add_rows(self, located, pickup_times, dropoff_times=None):
+        """Count trips at once, of lists of (pickup, dropoff) districts and
+        of times, dropoffs only if their times are given"""
+        import numpy
+        numbers = self.numbers
+        # HOWTO: index arithmetic over whole arrays, then one bincount
+        pickups = numpy.array([numbers[p] for p, d in located], 'l')
+        times = numpy.array(pickup_times, 'l')
+        index = pickups * HOURS + (times // 3600 + BASE_HOUR) % HOURS
+        if dropoff_times is not None:
+            dropoffs = numpy.array([numbers[d] for p, d in located], 'l')
+            times = numpy.array(dropoff_times, 'l')
+            index = numpy.concatenate([index, (self.size + dropoffs) * HOURS +
+                (times // 3600 + BASE_HOUR) % HOURS])
+        if not len(index): return
+        if self.counts is None: self.counts = self.zeros()
+        counts = numpy.frombuffer(self.counts, self.counts.typecode)
+        counts += numpy.bincount(index, minlength=len(counts))
+
+    def items(self):
+        """(kind, district, hour of week, count) of nonzero counters"""
+        for i in self.nonzero():
+            row, hour = divmod(i, HOURS)
+            kind, number = divmod(row, self.size)
+            yield self.KINDS[kind], self.indexes[number], hour, self.counts[i]
+
+    def put(self, kind, district, hour, count):
+        if self.counts is None: self.counts = self.zeros()
+        row = self.KINDS.index(kind) * self.size + self.numbers[district]
+        self.counts[row * HOURS + hour] = count
+
+    def slice(self, kind, districts=None, weekdays=None):
+        """numpy array of trips by district number, weekday and hour, of
+        districts of a list of indexes and of weekdays, all by default"""
+        import numpy
+        cube = numpy.zeros((self.size, 7, 24), 'l')
+        if self.counts is not None:
+            counts = numpy.frombuffer(self.counts, self.counts.typecode)
+            start = self.KINDS.index(kind) * self.size * HOURS
+            cube = counts[start:start + self.size * HOURS].reshape(
+                self.size, 7, 24)
+        if districts is not None:
+            cube = cube[[self.numbers[index] for index in districts]]
+        if weekdays is not None:
+            cube = cube[:, weekdays]
+        return cube
+
+    def hours(self, kind, districts=None, weekdays=None):
+        """Trips by hour of the day, of districts and weekdays"""
+        return self.slice(kind, districts, weekdays).sum(axis=(0, 1)).tolist()
+
+    def districts(self, kind, weekdays=None):
+        """Counter of district => trips of weekdays"""
+        trips = self.slice(kind, None, weekdays).sum(axis=(1, 2)).tolist()
+        return Counter(dict([(index, count) for index, count in
+                             zip(self.indexes, trips) if count]))
@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Segmented Parallel HTTP Download of Raw TLC Files
+
+from __future__ import print_function
+
+import BaseHTTPServer
+import Queue
+import SimpleHTTPServer
+import SocketServer
+import httplib
+import json
+import logging
+import os
+import os.path
+import random
+import re
+import shutil
+import threading
+import time
+import urllib2
+
+from common import *
+
+__all__ = ['SegmentedDownloader']
+
+logging.basicConfig()
+logger = logging.getLogger(os.path.basename(__file__))
+
+def parse_argv():
+    o = Options()
+    o.add('--src', metavar='URI', type=str,
+        default='http://s3.amazonaws.com/nyc-tlc/trip+data/',
+        help="data source directory")
+    o.add('--dst', metavar='DIR', type=str,
+        default='.', help="download directory")
+    o.add('--segments', metavar='NUM', type=int,
+        default=8, help="concurrent range requests")
+    o.add('--segment-size', metavar='NUM', type=int, dest='segment_size',
+        default=SegmentedDownloader.SEGMENT_SIZE,
+        help="bytes per range request")
+    o.add('--serve', metavar='DIR', type=str,
+        default=None, help="serve a directory with Range support instead")
+    o.add('--port', metavar='NUM', type=int,
+        default=8000, help="port of --serve")
+    o.add('--fail-rate', metavar='RATIO', type=float, dest='fail_rate',
+        default=0.0, help="ratio of responses --serve cuts short")
+
+    opts = o.load()
+    logger.setLevel(opts.verbose)
+    return opts
+
+class SegmentedDownloader:
+    """Download one URL with concurrent HTTP Range requests
+
+    The file is cut into segments of `segment_size` bytes that `segments`
+    threads fetch into their offsets of a preallocated staging file,
+    `<path>.part`, renamed to `path` once complete. A segment whose
+    connection fails or ends early is requested again from the first
+    missing byte, up to `retries` times with a growing delay. Servers
+    that do not report a size or ignore Range get a single stream,
+    requested again whole when it ends before its Content-Length.
+
+    Complete segments are journaled in `<path>.part.done`, so a failed or
+    killed download of the same, unchanged, file only fetches the
+    segments it is missing.
+    """
+
+    SEGMENT_SIZE = 16 * 1024 * 1024
+    BUF_SIZE = 1024 * 1024
+
+    def __init__(self, segments=8, segment_size=SEGMENT_SIZE, retries=5,
+                 timeout=60):
+        self.segments = segments
+        self.segment_size = segment_size
+        self.retries = retries
+        self.timeout = timeout
+        self.retried = 0
+        self.resumed = 0        # segments of an interrupted download
+        self.lock = threading.Lock()
+
+    def head(self, url):
+        """Size of url if the server accepts Range requests, else None, and
+        its ETag or Last-Modified time"""
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        headers = urllib2.urlopen(request, timeout=self.timeout).info()
+        size = headers.get('Content-Length')
+        version = headers.get('ETag') or headers.get('Last-Modified')
+        if size is None or headers.get('Accept-Ranges') != 'bytes':
+            return None, version
+        return int(size), version
+
+    def retry(self, attempt, what, e):
+        """Count a retry of what failed with e, after a growing delay"""
+        if attempt == self.retries: raise e
+        with self.lock: self.retried += 1
+        logger.info('%s => retry: %s' % (what, e))
+        time.sleep(min(2 ** attempt * 0.1, 10))
+
+    def fetch(self, url, path, start, end):
+        """Write bytes [start, end) of url at the same offset of path"""
+        for attempt in range(self.retries + 1):
+            try:
+                request = urllib2.Request(url)
+                request.add_header('Range', 'bytes=%d-%d' % (start, end - 1))
+                response = urllib2.urlopen(request, timeout=self.timeout)
+                if response.getcode() != 206:
+                    raise IOError('%s ignored Range' % url)
+                with open(path, 'r+b') as f:
+                    f.seek(start)
+                    while start < end:
+                        data = response.read(min(self.BUF_SIZE, end - start))
+                        if not data: break
+                        f.write(data)
+                        start += len(data)
+                if start == end: return
+                raise IOError('connection closed %d bytes early' % \
+                    (end - start))
+            except (IOError, httplib.HTTPException) as e:
+                self.retry(attempt, '%s [%d, %d)' % (url, start, end), e)
+
+    def stream(self, url, path):
+        """Write url to path with a single request"""
+        for attempt in range(self.retries + 1):
+            try:
+                response = urllib2.urlopen(url, timeout=self.timeout)
+                size = response.info().get('Content-Length')
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(response, f, self.BUF_SIZE)
+                    done = f.tell()
+                # HOWTO: a connection closed early is not an error of read
+                if size is None or done == int(size): return
+                raise IOError('connection closed %d bytes early' % \
+                    (int(size) - done))
+            except (IOError, httplib.HTTPException) as e:
+                self.retry(attempt, url, e)
+
+    def resume(self, journal, header):
+        """Starts of the segments already in the staging file of an
+        interrupted download with the same header, None if there is none"""
+        try:
+            with open(journal, 'r') as f:
+                if f.readline() != header + '\n': return None
+                # the last line is partial if a kill interrupted its write
+                return set([int(line) for line in f if line.endswith('\n')])
+        except (IOError, ValueError):
+            return None
+
+    def clean(self, path):
+        """Remove what an interrupted download of path keeps to resume"""
+        for name in [path + '.part', path + '.part.done']:
+            if os.path.exists(name): os.remove(name)
+
+    def download(self, url, path):
+        size, version = self.head(url)
+        staging, journal = path + '.part', path + '.part.done'
+        if size is None or self.segments <= 1:
+            self.stream(url, staging)
+            os.rename(staging, path)
+            return path
+
+        header = json.dumps([url, size, version, self.segment_size])
+        done = self.resume(journal, header)
+        if done is None or not os.path.isfile(staging) or \
+           os.path.getsize(staging) != size:
+            done = set()
+            with open(staging, 'wb') as f: f.truncate(size)
+            with open(journal, 'w') as f: f.write(header + '\n')
+        self.resumed = len(done)
+        if done:
+            logger.info('%s => resume: %d segments already downloaded' % \
+                (url, len(done)))
+        ranges = Queue.Queue()
+        for start in range(0, size, self.segment_size):
+            if start in done: continue
+            ranges.put((start, min(start + self.segment_size, size)))
+        errors = []
+        completed = open(journal, 'a')
+        def worker():
+            while not errors:
+                try:
+                    start, end = ranges.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.fetch(url, staging, start, end)
+                    with self.lock:
+                        completed.write('%d\n' % start)
+                        completed.flush()
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(self.segments)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads: t.join()
+        completed.close()
+        if errors: raise errors[0] # keep the segments to resume
+        os.rename(staging, path)
+        os.remove(journal)
+        return path
+
+class RangeRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    """Serve files with single byte range support, a local stand-in of S3
+
+    A `fail_rate` ratio of responses is cut short to exercise retries.
+    """
+
+    fail_rate = 0.0
+    range = None
+
+    def send_head(self):
+        match = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.send_head(self)
+
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1) + 1, size)
+        if start >= end:
+            self.send_error(416, 'Requested Range Not Satisfiable')
+            return None
+        f = open(path, 'rb')
+        f.seek(start)
+        self.range = (start, end)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', 'bytes %d-%d/%d' % \
+            (start, end - 1, size))
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return f
+
+    def end_headers(self):
+        if not self.headers.get('Range'):
+            self.send_header('Accept-Ranges', 'bytes')
+        SimpleHTTPServer.SimpleHTTPRequestHandler.end_headers(self)
+
+    def copyfile(self, source, outputfile):
+        if self.range is not None:
+            n = self.range[1] - self.range[0]
+        elif hasattr(source, 'fileno'):
+            n = os.fstat(source.fileno()).st_size
+        else: # a directory listing
+            return SimpleHTTPServer.SimpleHTTPRequestHandler.copyfile(
+                self, source, outputfile)
+        if random.random() < self.fail_rate: n = random.randrange(n)
+        while n > 0:
+            data = source.read(min(n, SegmentedDownloader.BUF_SIZE))
+            if not data: break
+            outputfile.write(data)
+            n -= len(data)
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+                          BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+def serve(directory, port, fail_rate=0.0):
+    os.chdir(directory)
+    RangeRequestHandler.fail_rate = fail_rate
+    httpd = ThreadingHTTPServer(('', port), RangeRequestHandler)
+    print('serving %s on port %d' % (directory, port))
+    httpd.serve_forever()
+
+if __name__ == '__main__':
+    opts = parse_argv()
+    if opts.serve:
+        serve(opts.serve, opts.port, opts.fail_rate)
+    else:
+        name = '%s_tripdata_%s-%02d.csv' % (opts.color, opts.year, opts.month)
+        d = SegmentedDownloader(opts.segments, opts.segment_size)
+        elapsed = time.time()
+        path = d.download('%s/%s' % (opts.src.strip('/'), name),
+                          os.path.join(opts.dst, name))
+        elapsed = time.time() - elapsed
+        size = os.path.getsize(path)
+        print('%s: %d bytes in %.2f s, %.1f MB/s, %d retries, '
+              '%d segments resumed' % (path, size, elapsed,
+              size / 1e6 / max(elapsed, 1e-9), d.retried, d.resumed))
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Block-Compressed and Columnar Record Formats
+#
+# Records are cut into blocks of `block_records` records, each compressed
+# on its own with zlib, followed by a footer of block offsets:
+#
+#   block 0 | block 1 | ... | footer (JSON) | footer length | MAGIC
+#
+# The footer length is 8 bytes, big-endian. A record range [start, end)
+# maps to blocks start / block_records to (end - 1) / block_records, so a
+# reader fetches the footer and then only the blocks of its range.
+#
+# The columnar format cuts records into row groups the same way, but a
+# row group is one compressed chunk per field, of typed values:
+#
+#   group 0: pickup_time | ... | districts | group 1: ... | footer | ...
+#
+# so a reader fetches only the chunks of the columns it needs and maps
+# values without parsing text.
+
+from __future__ import print_function
+
+import array
+import collections
+import json
+import struct
+import sys
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from common import RECORD_LENGTH
+
+__all__ = ['BLOCK_RECORDS', 'COLUMNS', 'RECORD_WRITERS', \
+           'BlockWriter', 'BlockFile', 'ColumnWriter', 'ColumnFile', \
+           'count_records']
+
+TRAILER = struct.Struct('>Q8s')
+BLOCK_RECORDS = 16384   # 1.3MB of records, about 0.25MB compressed
+
+# name, array typecode or string length, of the columns of the columnar
+# format. Numbers keep the values of the record text exactly.
+COLUMNS = [
+    ('pickup_time', 'i'),
+    ('dropoff_time', 'i'),
+    ('pickup_longitude', 'd'),
+    ('pickup_latitude', 'd'),
+    ('dropoff_longitude', 'd'),
+    ('dropoff_latitude', 'd'),
+    ('distance', 'd'),
+    ('fare', 'd'),
+    ('districts', 5)    # '#' and district codes of geo.NYCDistrictCode
+]
+TAG_OFFSET = RECORD_LENGTH - 6
+
+def read_footer(store, key, magic):
+    """Footer of a block-compressed or columnar object and its bytes"""
+    size = store.size(key)
+    length, found = TRAILER.unpack(
+        store.read_range(key, size - TRAILER.size, size).read())
+    if found != magic:
+        raise IOError('%s/%s is not of format %s' % (store.uri, key, magic))
+    footer = json.loads(store.read_range(key,
+        size - TRAILER.size - length, size - TRAILER.size).read())
+    return footer, TRAILER.size + length
+
+def prefetch(pool, func, args, depth):
+    """Yield func(arg) of args in order, with `depth` calls in flight"""
+    # keep a few blocks in flight, a whole month would not fit in memory
+    args = iter(args)
+    pending = collections.deque()
+    while True:
+        while len(pending) < depth:
+            arg = next(args, None)
+            if arg is None: break
+            pending.append(pool.apply_async(func, (arg,)))
+        if not pending: break
+        yield pending.popleft().get()
+
+class BlockWriter:
+    """File-like writer compressing records into blocks of a file object"""
+
+    MAGIC = 'TAXIZB01'
+
+    def __init__(self, fout, block_records=BLOCK_RECORDS, level=6):
+        self.fout = fout
+        self.block_records = block_records
+        self.level = level
+        self.buf = []
+        self.buffered = 0
+        self.offsets = [0]
+        self.records = 0
+        self.size = 0           # compressed bytes written
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buffered += len(data)
+        block_size = self.block_records * RECORD_LENGTH
+        if self.buffered < block_size: return
+        data = ''.join(self.buf)
+        n = len(data) - len(data) % block_size
+        for start in range(0, n, block_size):
+            self.write_block(data[start:start + block_size])
+        self.buf, self.buffered = [data[n:]], len(data) - n
+
+    def write_block(self, data):
+        block = zlib.compress(data, self.level)
+        self.fout.write(block)
+        self.size += len(block)
+        self.offsets.append(self.size)
+        self.records += len(data) / RECORD_LENGTH
+
+    def footer(self):
+        return {
+            'codec': 'zlib',
+            'block_records': self.block_records,
+            'records': self.records,
+            'offsets': self.offsets
+        }
+
+    def close(self):
+        """Write the last, short, block and the footer"""
+        data = ''.join(self.buf)
+        if data: self.write_block(data)
+        self.buf, self.buffered = [], 0
+        footer = json.dumps(self.footer())
+        self.fout.write(footer + TRAILER.pack(len(footer), self.MAGIC))
+        self.size += len(footer) + TRAILER.size
+
+class ColumnWriter(BlockWriter):
+    """File-like writer of records into row groups of typed columns
+
+    A block of records is a row group, its offsets are those of the first
+    column of each group.
+    """
+
+    MAGIC = 'TAXICL01'
+
+    def __init__(self, fout, block_records=BLOCK_RECORDS, level=6):
+        BlockWriter.__init__(self, fout, block_records, level)
+        self.chunks = []        # chunk offsets of each row group
+        self.tagged = []        # all records of each group have districts
+
+    def write_block(self, data):
+        lines = data.splitlines()
+        fields = zip(*[line.split(',', 8) for line in lines])
+        offsets = [self.size]
+        for i, (name, kind) in enumerate(COLUMNS):
+            if name == 'districts':
+                values = ''.join([line[TAG_OFFSET:TAG_OFFSET + kind]
+                                  for line in lines])
+                self.tagged.append(values[::kind].count('#') == len(lines))
+            else:
+                convert = int if kind == 'i' else float
+                values = array.array(kind, map(convert, fields[i])).tostring()
+            chunk = zlib.compress(values, self.level)
+            self.fout.write(chunk)
+            self.size += len(chunk)
+            offsets.append(self.size)
+        self.chunks.append(offsets)
+        self.offsets.append(self.size)
+        self.records += len(lines)
+
+    def footer(self):
+        footer = BlockWriter.footer(self)
+        footer.update({
+            'byteorder': sys.byteorder,
+            'columns': COLUMNS,
+            'chunks': self.chunks,
+            'tagged': self.tagged
+        })
+        return footer
+
+class BlockFile:
+    """Block-compressed object of a store, its footer is read at once"""
+
+    THREADS = 4     # concurrent fetch and decompression of blocks
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        footer, self.transferred = read_footer(store, key, BlockWriter.MAGIC)
+        self.block_records = footer['block_records']
+        self.records = footer['records']
+        self.offsets = footer['offsets']
+
+    def read_block(self, n):
+        start, end = self.offsets[n], self.offsets[n + 1]
+        data = self.store.read_range(self.key, start, end).read()
+        # HOWTO: zlib releases the GIL, so threads decompress in parallel
+        return len(data), zlib.decompress(data)
+
+    def open_range(self, start, end, threads=THREADS):
+        return BlockRange(self, start, min(end, self.records), threads)
+
+class BlockRange:
+    """File-like reader of records [start, end) of a BlockFile
+
+    Blocks of the range are fetched and decompressed by `threads` threads,
+    up to twice as many ahead of the reader, and read in order.
+    """
+
+    def __init__(self, block_file, start, end, threads):
+        self.file = block_file
+        self.pool = None
+        self.blocks = iter([])
+        self.buf = ''
+        self.pos = 0
+        self.skip = 0
+        self.remain = max(end - start, 0) * RECORD_LENGTH
+        self.transferred = 0    # compressed bytes of blocks fetched
+        if self.remain == 0: return
+
+        first = start / block_file.block_records
+        last = (end - 1) / block_file.block_records
+        self.pool = ThreadPool(min(threads, last - first + 1))
+        self.blocks = prefetch(self.pool, block_file.read_block,
+                               range(first, last + 1), 2 * threads)
+        self.skip = (start - first * block_file.block_records) * RECORD_LENGTH
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remain: size = self.remain
+        while len(self.buf) - self.pos < size:
+            block = next(self.blocks, None)
+            if block is None: break
+            transferred, data = block
+            self.transferred += transferred
+            self.buf = self.buf[self.pos:] + data[self.skip:]
+            self.pos, self.skip = 0, 0
+        # HOWTO: slice at a position, records are read 80 bytes at a time
+        data = self.buf[self.pos:self.pos + size]
+        self.pos += len(data)
+        self.remain -= len(data)
+        return data
+
+    def close(self):
+        if self.pool:
+            # HOWTO: terminate waits for pool threads polling every 0.1s,
+            # close returns at once and lets blocks in flight finish
+            self.pool.close()
+            self.pool = None
+
+class ColumnFile:
+    """Columnar object of a store, its footer is read at once"""
+
+    THREADS = 4     # concurrent fetch and decompression of chunks
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        footer, self.transferred = read_footer(store, key,
+                                               ColumnWriter.MAGIC)
+        self.block_records = footer['block_records']
+        self.records = footer['records']
+        self.offsets = footer['offsets']
+        self.chunks = footer['chunks']
+        self.tagged = footer['tagged']
+        self.columns = dict([(name, (i, kind)) for i, (name, kind)
+                             in enumerate(footer['columns'])])
+        self.swap = footer['byteorder'] != sys.byteorder
+
+    def read_chunk(self, chunk):
+        group, name = chunk
+        i, kind = self.columns[name]
+        start, end = self.chunks[group][i], self.chunks[group][i + 1]
+        data = zlib.decompress(self.store.read_range(self.key, start,
+                                                     end).read())
+        if not isinstance(kind, int):
+            values = array.array(str(kind))
+            values.fromstring(data)
+            if self.swap: values.byteswap()
+        else:
+            values = [data[j:j + kind] for j in range(0, len(data), kind)]
+        return end - start, values
+
+    def group_names(self, group, names, untagged):
+        if self.tagged[group]: return names
+        return names + [name for name in untagged if name not in names]
+
+    def read_columns(self, start, end, names, untagged=(), threads=THREADS):
+        """Yield {name: values} of records [start, end), by row group,
+        with the `untagged` columns too of groups of untagged records"""
+        end = min(end, self.records)
+        if start >= end: return
+        first = start / self.block_records
+        last = (end - 1) / self.block_records
+        chunks = [(group, name) for group in range(first, last + 1)
+                  for name in self.group_names(group, names, untagged)]
+        pool = ThreadPool(min(threads, len(chunks)))
+        try:
+            values = prefetch(pool, self.read_chunk, chunks,
+                              2 * threads * len(names))
+            for group in range(first, last + 1):
+                offset = group * self.block_records
+                lo, hi = max(start - offset, 0), end - offset
+                columns = {}
+                for name in self.group_names(group, names, untagged):
+                    transferred, chunk = next(values)
+                    self.transferred += transferred
+                    columns[name] = chunk[lo:hi]
+                yield columns
+        finally:
+            pool.close()
+
+# file-like writer of each format but plain
+RECORD_WRITERS = {
+    'zblock': BlockWriter,
+    'columnar': ColumnWriter
+}
+
+def count_records(store, key, record_format):
+    if record_format == 'zblock': return BlockFile(store, key).records
+    if record_format == 'columnar': return ColumnFile(store, key).records
+    return store.size(key) / RECORD_LENGTH
@@ -7,9 +7,11 @@ from __future__ import print_function
 
 import json
 import os.path
+import string
 import sys
 
 import shapely.geometry
+import shapely.prepared
 
 from collections import OrderedDict
 
@@ -106,3 +108,69 @@ class NYCGeoPolygon:
     def load_boroughs(cls):
         cwd = os.path.dirname(__file__)
         return cls.load(os.path.join(cwd, cls.NYC_BOROUGHS_JSON))
+
+class NYCDistrictCode:
+    """Two-character district codes kept in the padding of records
+
+    A converted record tagged at conversion time ends with '#', the code
+    of its pickup district and the code of its dropoff district before
+    the newline, so that mappers need no point-in-polygon test. NOWHERE
+    codes a point outside of every district. Codes number the district
+    indexes of NYC_DISTRICTS_JSON in sorted order.
+    """
+
+    ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+    NOWHERE = '--'
+    RECORD_LENGTH = 80
+    OFFSET = RECORD_LENGTH - 6  # '#', two codes and the newline
+
+    def __init__(self, districts=None):
+        self.districts = districts or NYCGeoPolygon.load_districts()
+        self.prepared = None    # not picklable, prepared on first locate
+        base = len(self.ALPHABET)
+        indexes = sorted([d.index for d in self.districts])
+        self.codes = dict([(index, self.ALPHABET[i / base] + \
+            self.ALPHABET[i % base]) for i, index in enumerate(indexes)])
+        self.indexes = dict([(code, index)
+            for index, code in self.codes.items()])
+
+    def locate(self, longitude, latitude):
+        """Index of the first district, in search order, containing a
+        point, None if no district does"""
+        if self.prepared is None:
+            # HOWTO: prepared geometries make repeated contains() faster
+            self.prepared = [(d.polygon.bounds,
+                              shapely.prepared.prep(d.polygon), d.index)
+                             for d in self.districts]
+        point = None
+        for (x0, y0, x1, y1), polygon, index in self.prepared:
+            if not (x0 <= longitude <= x1 and y0 <= latitude <= y1): continue
+            if point is None: point = shapely.geometry.Point(longitude, latitude)
+            if polygon.contains(point): return index
+        return None
+
+    def tag(self, record):
+        """Record with district codes, unchanged if its padding is short"""
+        if record[self.OFFSET:-1] != '*****': return record
+        fields = record.split(',', 6)
+        pickup = self.locate(float(fields[2]), float(fields[3]))
+        dropoff = self.locate(float(fields[4]), float(fields[5]))
+        return record[:self.OFFSET] + '#' + \
+            self.codes.get(pickup, self.NOWHERE) + \
+            self.codes.get(dropoff, self.NOWHERE) + '\n'
+
+    def tag_records(self, records):
+        n = self.RECORD_LENGTH
+        return ''.join([self.tag(records[i:i + n])
+                        for i in range(0, len(records), n)])
+
+    def read(self, record):
+        """(pickup, dropoff) district indexes of a tagged record, None if
+        the record is not tagged"""
+        return self.decode(record[self.OFFSET:self.OFFSET + 5])
+
+    def decode(self, tag):
+        """(pickup, dropoff) district indexes of the '#' and codes of a
+        record, the districts column of the columnar format"""
+        if tag[0] != '#': return None
+        return self.indexes.get(tag[1:3]), self.indexes.get(tag[3:5])
@@ -21,8 +21,11 @@ from bokeh.models.renderers import GlyphRenderer
 from bokeh.io import curdoc
 
 from common import *
+from cube import WEEKDAYS, WEEKENDS
 from geo import NYCBorough, NYCGeoPolygon
 from mapred import StatDB
+from query import Predicate
+from sketch import QUANTILES
 from tasks import TaskManager
 
 logging.basicConfig()
@@ -31,7 +34,16 @@ def parse_argv():
     o = Options()
     o.add('--purge', dest='purge', action='store_true', default=False,
         help='purge data before load')
-    return o.load()
+    o.add('--where', metavar='EXPR', type=str, action='append',
+        dest='where', default=None,
+        help='show and submit results of a query, see mapred.py --where')
+    opts = o.load()
+    if opts.where:
+        try:
+            Predicate(opts.where)
+        except ValueError as e:
+            fatal(e)
+    return opts
 
 class InteractivePlot:
     def __init__(self, opts):
@@ -47,6 +59,8 @@ class InteractivePlot:
         }
 
         self.tasks = TaskManager(opts)
+        self.where = opts.where
+        self.where_key = Predicate(opts.where).key if opts.where else None
 
         self.districts = None
         self.districts_xs = []
@@ -55,6 +69,10 @@ class InteractivePlot:
 
         self.selected_type = 'Pickups'
         self.selected_borough = 0
+        self.selected_pickup = None     # district index of flows shown
+        self.flows = None
+        self.selected_days = 'All Days'
+        self.cube = None                # DistrictCube of slices shown
         self.selected_color = 'green'
         self.selected_year = 2016
         self.selected_month = 1
@@ -67,7 +85,17 @@ class InteractivePlot:
         if time.time() - self.last_query['timestamp'] < 2: return
 
         year, mont = int(year), int(month)
-        self.data = self.db.get(color, year, month)
+        self.data = self.db.get(color, year, month, self.where_key)
+        self.flows = None
+        if self.selected_pickup:
+            self.flows = self.db.get_flows(color, year, month,
+                self.selected_pickup, self.where_key)
+        # slices of the cube, of the districts of the selected borough
+        self.cube = None
+        if self.districts and (self.selected_borough or
+                               self.selected_days != 'All Days'):
+            self.cube = self.db.get_cube(color, year, month, self.where_key,
+                                         self.selected_districts())
         self.last_query['color'] = color
         self.last_query['year'] = year
         self.last_query['month'] = month
@@ -104,10 +132,7 @@ class InteractivePlot:
         self.hot_map.patches('x', 'y', source=self.hot_map_source,
             fill_color={'field': 'rate', 'transform': color_mapper},
             fill_alpha=0.7, line_color="white", line_width=0.5)
-        self.hot_map.title.text = "%s %s/%s, %s" % \
-                (self.selected_type,
-                 self.selected_year, self.selected_month,
-                 NYCBorough.BOROUGHS[self.selected_borough])
+        self.hot_map.title.text = self.hot_map_title()
 
         hover = self.hot_map.select_one(HoverTool)
         hover.point_policy = "follow_mouse"
@@ -117,13 +142,44 @@ class InteractivePlot:
             ("Coordinates", "($x, $y)"),
         ]
 
+    def selected_districts(self):
+        """Indexes of the districts of the selected borough, None of all"""
+        if not self.selected_borough: return None
+        return [district.index for district in self.districts
+                if district.region == self.selected_borough]
+
+    def selected_weekdays(self):
+        return {'Weekdays': WEEKDAYS,
+                'Weekends': WEEKENDS}.get(self.selected_days)
+
+    def hot_map_title(self):
+        if self.flows is not None:
+            selected = 'Flows from %s' % self.selected_pickup
+        else:
+            selected = self.selected_type
+        return "%s %s/%s, %s%s%s" % \
+                (selected,
+                 self.selected_year, self.selected_month,
+                 NYCBorough.BOROUGHS[self.selected_borough],
+                 ', %s' % self.selected_days.lower() \
+                    if self.selected_weekdays() else '',
+                 ', where %s' % self.where_key if self.where_key else '')
+
     def hot_map_update(self):
+        trips = None    # trips of the selected weekdays, by district
+        if self.cube is not None and self.selected_weekdays():
+            trips = self.cube.districts(self.selected_type.lower(),
+                                        self.selected_weekdays())
         rates = []
         for district in self.districts:
             rate = 0
             borough = self.selected_borough
             if borough == 0 or borough == district.region:
-                if self.selected_type == 'Pickups':
+                if self.flows is not None:
+                    rate = self.flows[district.index]
+                elif trips is not None:
+                    rate = trips[district.index]
+                elif self.selected_type == 'Pickups':
                     rate = self.data.pickups[district.index]
                 else:
                     rate = self.data.dropoffs[district.index]
@@ -135,10 +191,7 @@ class InteractivePlot:
             name=self.districts_names,
             rate=rates,
         )
-        self.hot_map.title.text = "%s %s/%s, %s" % \
-                (self.selected_type,
-                 self.selected_year, self.selected_month,
-                 NYCBorough.BOROUGHS[self.selected_borough])
+        self.hot_map.title.text = self.hot_map_title()
 
     def trip_hour_init(self, width=620, height=350, webgl=True):
         self.trip_hour = figure(webgl=webgl, toolbar_location=None,
@@ -158,7 +211,42 @@ class InteractivePlot:
             tooltips=[("Trips", "@hour")]))
 
     def trip_hour_update(self):
-        self.trip_hour_source.data=dict(x=range(24), hour=self.data.get_hour())
+        if self.cube is None:
+            self.trip_hour_source.data=dict(x=range(24),
+                                            hour=self.data.get_hour())
+            self.trip_hour.title.text = 'Hour'
+            return
+
+        # e.g. Brooklyn pickups by hour on weekends, a slice of the cube
+        self.trip_hour_source.data=dict(x=range(24),
+            hour=self.cube.hours(self.selected_type.lower(),
+                                 self.selected_districts(),
+                                 self.selected_weekdays()))
+        self.trip_hour.title.text = 'Hour, %s %s%s' % \
+            (NYCBorough.BOROUGHS[self.selected_borough],
+             self.selected_type.lower(),
+             ' on %s' % self.selected_days.lower() \
+                if self.selected_weekdays() else '')
+
+    def trip_day_init(self, width=620, height=200, webgl=True):
+        days = self.data.get_days()
+        self.trip_day = figure(webgl=webgl, toolbar_location=None,
+            width=width, height=height, title='Day')
+        self.trip_day_source = ColumnDataSource(data=dict(
+            x=range(1, len(days) + 1), day=days))
+        vbar = self.trip_day.vbar(width=0.6, bottom=0, x='x', top='day',
+            source=self.trip_day_source, fill_alpha=0.7,
+            line_color="white", color='#8E44AD')
+        self.trip_day.y_range.start = 0
+        self.trip_day.xaxis.major_tick_line_color = None
+        self.trip_day.xaxis.minor_tick_line_color = None
+
+        self.trip_day.add_tools(HoverTool(renderers=[vbar],
+            tooltips=[("Day", "@x"), ("Trips", "@day")]))
+
+    def trip_day_update(self):
+        days = self.data.get_days()
+        self.trip_day_source.data=dict(x=range(1, len(days) + 1), day=days)
 
     def trip_distance_init(self, width=310, height=350, webgl=True):
         def ticker():
@@ -208,6 +296,28 @@ class InteractivePlot:
     def trip_fare_update(self):
         self.trip_fare_source.data=dict(x=range(6), fare=self.data.get_fare())
 
+    def percentiles_html(self):
+        def cells(values, format_str):
+            return ''.join(['<td>%s</td>' % ('-' if v is None else \
+                format_str % v) for v in values])
+
+        trip_times = [t / 60.0 if t is not None else None
+                      for t in self.data.get_trip_time_quantiles()]
+        return '<table width="100%%"><tr><th></th>%s</tr>' \
+            '<tr><th>Distance (miles)</th>%s</tr>' \
+            '<tr><th>Trip time (minutes)</th>%s</tr>' \
+            '<tr><th>Fare (US dollars)</th>%s</tr></table>' % \
+            (''.join(['<th>p%g</th>' % (q * 100) for q in QUANTILES]),
+             cells(self.data.get_distance_quantiles(), '%.2f'),
+             cells(trip_times, '%.1f'),
+             cells(self.data.get_fare_quantiles(), '%.2f'))
+
+    def percentiles_init(self, width=620):
+        self.percentiles = Div(text=self.percentiles_html(), width=width)
+
+    def percentiles_update(self):
+        self.percentiles.text = self.percentiles_html()
+
     def resource_usage_init(self, width=740, height=120):
         data_len = 4
         self.resource_usage_source = ColumnDataSource(data=dict(
@@ -274,8 +384,10 @@ class InteractivePlot:
 
             self.hot_map_update()
             self.trip_hour_update()
+            self.trip_day_update()
             self.trip_distance_update()
             self.trip_fare_update()
+            self.percentiles_update()
             self.tasks_stat_update()
             # self.resource_usage_update()
 
@@ -288,6 +400,8 @@ class InteractivePlot:
             borough.label = borough.value
             self.selected_year = int(year.value)
             self.selected_month = int(month.value)
+            self.selected_pickup = districts.get(flows.value)
+            self.selected_days = days.value
 
         def on_submit():
             self.logger.debug('submit (%s, %s, %s, %s, %s)' % \
@@ -298,7 +412,8 @@ class InteractivePlot:
             self.tasks.create_tasks(
                 self.selected_color,
                 self.selected_year,
-                self.selected_month)
+                self.selected_month,
+                where=self.where)
 
         cwd = os.path.dirname(__file__)
         desc = Div(text=open(
@@ -328,21 +443,36 @@ class InteractivePlot:
             options=[str(m) for m in range(1, 13)])
         month.on_change('value', lambda attr, old, new: on_select())
 
+        days = Select(title="Days:", value=self.selected_days,
+            options=['All Days', 'Weekdays', 'Weekends'])
+        days.on_change('value', lambda attr, old, new: on_select())
+
         submit = Button(label="Submit", button_type="success")
         submit.on_click(on_submit)
 
-        controls = [color, pickup, borough, year, month, submit]
-
         self.query(self.selected_color, self.selected_year, self.selected_month)
         self.hot_map_init()
         self.trip_hour_init()
+        self.trip_day_init()
         self.trip_distance_init()
         self.trip_fare_init()
+        self.percentiles_init()
         self.tasks_stat_init()
         self.resource_usage_init()
 
+        # trips out of a district, by dropoff district, in the hot map
+        districts = dict([(str(d), d.index) for d in self.districts])
+        flows = Select(title="Flows from:", value='None',
+            options=['None'] + [str(d) for d in sorted(self.districts,
+                                                      key=lambda d: d.index)])
+        flows.on_change('value', lambda attr, old, new: on_select())
+
+        controls = [color, pickup, borough, year, month, days, flows,
+                    submit]
+
         rightdown_row = row([self.trip_distance, self.trip_fare])
-        right_column = column([self.trip_hour, rightdown_row])
+        right_column = column([self.trip_hour, self.trip_day, rightdown_row,
+                               self.percentiles])
         inputs = widgetbox(*controls, width=140, sizing_mode="fixed")
         l = layout([
             [desc],
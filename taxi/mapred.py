@@ -5,30 +5,44 @@
 from __future__ import print_function
 
 import argparse
+import bisect
+import calendar
+import collections
 import copy
+import cProfile
 import datetime
 import decimal
+import glob
 import io
 import json
 import logging
 import multiprocessing
 import os.path
+import pstats
+import resource
 import sys
 import time
 
-import boto3
 import botocore
 
-from collections import Counter
-from boto3.dynamodb.conditions import Key, Attr
+from collections import Counter, defaultdict
 
+from backends import get_backend
 from common import *
-from geo import NYCBorough, NYCGeoPolygon
-from tasks import TaskManager
+from cube import DistrictCube
+from formats import BlockFile, ColumnFile, COLUMNS
+from geo import NYCBorough, NYCDistrictCode, NYCGeoPolygon
+from odmatrix import ODMatrix
+from query import LOCATED, Predicate, scan_predicate
+from sketch import DISTANCE_SKETCH, FARE_SKETCH, TRIP_TIME_SKETCH, QUANTILES
+from tasks import TaskManager, TaskHeartbeat
+from zonemap import ZoneMap
 
 logging.basicConfig()
 logger = logging.getLogger(os.path.basename(__file__))
 
+STREAM_CHUNK = 10000    # records per chunk of stdin stream
+
 def parse_argv():
     o = Options()
     o.add('--src', metavar='URI', type=str,
@@ -37,6 +51,25 @@ def parse_argv():
         default=0, help="start record index")
     o.add('-e', '--end',  metavar='NUM', type=int,
         default=4 * 1024 ** 3, help="end record index")
+    o.add('--from', metavar='YYYY-MM-DD[THH]', type=parse_time,
+        dest='time_from', default=None,
+        help="first pickup hour, of a month sorted by raw2aws.py --sort")
+    o.add('--to', metavar='YYYY-MM-DD[THH]', type=parse_time,
+        dest='time_to', default=None,
+        help="pickup hour to stop at, of a month sorted by raw2aws.py --sort")
+    o.add('--where', metavar='EXPR', type=str, action='append',
+        dest='where', default=None,
+        help="map only records matching all of these expressions, e.g. "
+             "\"pickup_borough == 'Manhattan' and hour < 4 and fare > 25\", "
+             "skipping blocks ruled out by zone maps, see query.py")
+    o.add('--query', metavar='EXPR', type=str, action='append',
+        dest='query', default=None,
+        help="also map records matching EXPR as a query of its own, in the "
+             "same scan, once per --query")
+    o.add('--columns', metavar='NAME', type=str, nargs='+',
+        dest='columns', default=None,
+        help="read only these columns of the columnar format and count "
+             "what they tell, e.g. 'pickup_longitude pickup_latitude'")
     o.add('-r', '--report', action='store_true',
         default=False, help="report results")
     o.add('-p', '--procs', type=int, dest='nprocs',
@@ -45,14 +78,47 @@ def parse_argv():
         default=False, help="worker mode")
     o.add('--sleep', type=int,
         default=10, help="worker sleep time if no task")
+    o.add('--profile', metavar='DIR', type=str,
+        default=None, help="profile mappers into directory")
+    o.add('--profile-every', metavar='NUM', type=int, dest='profile_every',
+        default=10, help="profile one of every NUM tasks in worker mode")
 
     opts = o.load()
 
     if opts.start < 0 or opts.start > opts.end:
         fatal("invalid range [%d, %d]" % (opts.start, opts.end))
 
-    opts.end = min(get_file_length(
-        opts.src, opts.color, opts.year, opts.month), opts.end)
+    # queries mapped in one scan, each a list of --where expressions,
+    # the first that of --where or [] of all records
+    opts.queries = [opts.where or []] + [[q] for q in opts.query or []]
+    try:
+        for where in opts.queries:
+            if where: Predicate(where)
+    except ValueError as e:
+        fatal(e)
+
+    if opts.columns:
+        if opts.record_format != 'columnar' or opts.src == '-':
+            fatal("--columns needs a columnar file:// or s3:// source")
+        names = [name for name, _ in COLUMNS]
+        for name in opts.columns:
+            if name not in names:
+                fatal('unknown column %s, one of %s' % \
+                    (name, ', '.join(names)))
+
+    if opts.src != '-':
+        opts.end = min(get_file_length(opts.src, opts.color, opts.year,
+            opts.month, get_backend(opts), opts.record_format), opts.end)
+
+    if opts.time_from or opts.time_to:
+        if opts.src == '-': fatal("--from/--to need a file:// or s3:// source")
+        index = TimeIndex.load(get_backend(opts).store(opts.src),
+            opts.color, opts.year, opts.month)
+        if index is None:
+            fatal("no time index of %s, convert with raw2aws.py --sort" % \
+                get_file_name(opts.color, opts.year, opts.month))
+        first, last = index.range(opts.time_from, opts.time_to)
+        opts.start, opts.end = max(opts.start, first), min(opts.end, last)
 
     logger.setLevel(opts.verbose)
     return opts
@@ -61,125 +127,214 @@ class RecordReader(io.IOBase):
     DATA_STDIN = 1
     DATA_FILE = 2
     DATA_S3 = 3
+    DATA_BLOCK = 4
+    DATA_COLUMN = 5
 
-    def __init__(self):
+    def __init__(self, backend=None, record_format='plain'):
         self.data = None
         self.start = 0
         self.end = 0
         self.data_type = -1
 
-        self.s3 = boto3.resource('s3')
-        self.client = boto3.client('s3')
+        self.backend = backend or get_backend(None)
+        self.record_format = record_format
 
         self.path = ''
         self.proc = multiprocessing.current_process().name
 
-    def open(self, color, year, month, source, start, end):
+    def open(self, color, year, month, source, start, end, predicate=None):
+        self.color, self.year, self.month = color, year, month
         self.start = start
         self.end = end
         self.skip = None
-        filename = get_file_name(color, year, month)
-
-        if source.startswith('file://'):
+        self.predicate = predicate  # query.Predicate to skip blocks of
+        self.ranges = [(start, end)]
+        self.transferred = 0
+        self.filename = get_file_name(color, year, month, self.record_format)
+
+        if source == '-':
+            self.data_type = self.DATA_STDIN
+            self.path = '-'
+            self.data = sys.stdin
+            self.skip = self.start # stdin cannot seek
+
+        elif self.record_format == 'zblock':
+            # fetch and decompress only the blocks of [start, end)
+            self.data_type = self.DATA_BLOCK
+            self.bucket = self.backend.store(source)
+            self.path = '%s/%s' % (self.bucket.uri, self.filename)
+            self.block_file = BlockFile(self.bucket, self.filename)
+            self.transferred = self.block_file.transferred
+
+        elif self.record_format == 'columnar':
+            # fetch and decompress only the columns read of [start, end)
+            self.data_type = self.DATA_COLUMN
+            self.bucket = self.backend.store(source)
+            self.path = '%s/%s' % (self.bucket.uri, self.filename)
+            self.column_file = ColumnFile(self.bucket, self.filename)
+
+        elif source.startswith('file://'):
             self.data_type = self.DATA_FILE
             directory = os.path.realpath(source[7:])
-            path = '%s/%s' % (directory, filename)
+            path = '%s/%s' % (directory, self.filename)
             self.path = 'file://' + path
 
             self.data = open(path, 'r')
-            self.data.seek(RECORD_LENGTH * self.start)
 
         elif source.startswith('s3://'):
             self.data_type = self.DATA_S3
-            bucket = self.s3.Bucket(source[5:])
-
-            # HOWTO: read object by range
-            obj = bucket.Object(filename)
-            self.path = 's3://%s/%s' %(bucket.name, filename)
-
-            bytes_range = 'bytes=%d-%d' % \
-                (self.start * RECORD_LENGTH, \
-                 self.end * RECORD_LENGTH - 1)
-            self.data = obj.get(Range=bytes_range)['Body']
+            self.bucket = self.backend.store(source)
+            self.path = '%s/%s' % (self.bucket.uri, self.filename)
 
         logger.info("%s [%d, %d) => %s" % \
             (self.path, self.start, self.end, self.proc))
+
+        if predicate and self.data_type != self.DATA_STDIN:
+            # skip blocks whose zone map rules out the predicate
+            zonemap = ZoneMap.load(self.backend.store(source),
+                                   color, year, month)
+            if zonemap: self.ranges = zonemap.ranges(predicate, start, end)
+            logger.info("%s [%d, %d) => %d records in %d ranges may match" % \
+                (self.path, self.start, self.end,
+                 sum([e - s for s, e in self.ranges]), len(self.ranges)))
         return self
 
+    def seek_range(self, start, end):
+        """Position data at the first record of [start, end)"""
+        if self.data_type == self.DATA_FILE:
+            self.data.seek(RECORD_LENGTH * start)
+            return
+        if self.data is not None:
+            self.data.close()
+            if self.data_type == self.DATA_BLOCK:
+                self.transferred += self.data.transferred
+        if self.data_type == self.DATA_BLOCK:
+            self.data = self.block_file.open_range(start, end)
+        else:
+            self.data = self.bucket.read_range(self.filename,
+                start * RECORD_LENGTH, end * RECORD_LENGTH)
+            self.transferred += (end - start) * RECORD_LENGTH
+
     def readline(self):
-        if self.data_type == self.DATA_S3:
+        if self.data_type in [self.DATA_S3, self.DATA_BLOCK]:
             # HOWTO: fixed length makes read very easy
             return self.data.read(RECORD_LENGTH)
         return self.data.readline()
 
     def readlines(self):
-        start = self.start
-        skip = 0
-        while start < self.end:
-            line = self.readline()
-            if skip < self.skip: skip += 1; continue # for stdin read
-            start += 1
-            if not line: break
-            yield line
+        for start, end in self.ranges:
+            if self.data_type != self.DATA_STDIN: self.seek_range(start, end)
+            skip = 0
+            while start < end:
+                line = self.readline()
+                if skip < self.skip: skip += 1; continue # for stdin read
+                start += 1
+                if not line: break
+                yield line
+
+    def readcolumns(self, names, untagged=()):
+        """Yield {name: values} of row groups of the columnar format, with
+        the `untagged` columns too of groups of records not geocoded"""
+        for start, end in self.ranges:
+            for columns in self.column_file.read_columns(start, end, names,
+                                                         untagged):
+                yield columns
+
+    def readchunks(self, size):
+        """Yield (color, year, month, records) of up to `size` records, a
+        marker record of raw2aws.py --markers starts another month"""
+        month = (self.color, self.year, self.month)
+        lines = []
+        for line in self.readlines():
+            if line.startswith('#'):
+                if lines: yield month + (''.join(lines),)
+                month, lines = parse_marker(line), []
+                continue
+            lines.append(line)
+            if len(lines) == size:
+                yield month + (''.join(lines),)
+                lines = []
+        if lines: yield month + (''.join(lines),)
 
     def close(self):
-        self.data.close()
+        if self.data_type is None: return # IOBase closes again on delete
+        if self.data_type == self.DATA_BLOCK and self.data is not None:
+            self.transferred += self.data.transferred
+        if self.data_type == self.DATA_COLUMN:
+            self.transferred = self.column_file.transferred
+        if self.data_type in [self.DATA_S3, self.DATA_BLOCK,
+                              self.DATA_COLUMN]:
+            logger.info("%s [%d, %d) => %d bytes transferred" % \
+                (self.path, self.start, self.end, self.transferred))
+        if self.data is not None and self.data is not sys.stdin:
+            self.data.close()
+        self.data, self.data_type = None, None
 
 class StatDB:
     def __init__(self, opts):
-        self.ddb = boto3.resource('dynamodb',
-            region_name=opts.region, endpoint_url=opts.ddb_endpoint)
-        self.table = self.ddb.Table(opts.ddb_table_name)
-        try:
-            assert self.table.table_status == 'ACTIVE'
-        except botocore.exceptions.ClientError as e:
-            if e.response['Error']['Code'] == 'ResourceNotFoundException':
-                logger.warning("table %s does not exist" % self.table.table_name)
-            logger.debug("create table %s/%s" % \
-                (opts.ddb_endpoint, self.table.table_name))
-            self.create_table()
-
-    def create_table(self):
-        self.table = self.ddb.create_table(
-            TableName='taxi',
-            KeySchema=[
-                {
-                    'AttributeName': 'color',
-                    'KeyType': 'HASH'   # partition key
-                },
-                {
-                    'AttributeName': 'date',
-                    'KeyType': 'RANGE'  # sort key
-                }
-            ],
-            AttributeDefinitions=[
-                {
-                    'AttributeName': 'color',
-                    'AttributeType': 'S'
-                },
-                {
-                    'AttributeName': 'date',
-                    'AttributeType': 'N'
-                },
-
-            ],
-            ProvisionedThroughput={
-                'ReadCapacityUnits': 2,
-                'WriteCapacityUnits': 10
-            }
-        )
-
-    def append(self, stat):
+        self.table = get_backend(opts).table(opts.ddb_table_name)
+        if not self.table.exists():
+            logger.warning("table %s does not exist" % self.table.name)
+            logger.debug("create table %s" % self.table.uri)
+            self.table.create()
+
+    @staticmethod
+    def key(color, year, month, query=None):
+        """Item key of a month, or of results of a --where query of it
+        under the hash key '<color>?<query.Predicate.key>'"""
+        if query: color = '%s?%s' % (color, query)
+        return {'color': color, 'date': year * 100 + month}
+
+    SHARDS = ['od', 'cube']   # items of districts of an item, see below
+
+    @staticmethod
+    def shard_key(key, shard, district):
+        """Item key of a district shard of the month or query item `key`,
+        under the hash key '<color>#<shard><district index>', such as
+        '<color>#od<pickup index>' of trips out of a pickup district"""
+        return {'color': '%s#%s%d' % (key['color'], shard, district or 0),
+                'date': key['date']}
+
+    def append(self, stat, query=None):
+        key = self.key(stat.color, stat.year, stat.month, query)
+        self.table.add(key, self.encode(stat))
+        # origin-destination matrix, sharded by pickup district
+        for pickup, values in self.encode_od(stat.od).items():
+            self.table.add(self.shard_key(key, 'od', pickup), values)
+        # district cube, sharded by district
+        for district, values in self.encode_cube(stat.cube).items():
+            self.table.add(self.shard_key(key, 'cube', district), values)
+
+    @classmethod
+    def encode_od(cls, od):
+        """Nonzero counters of an ODMatrix, pickup => item attributes"""
+        items = defaultdict(dict)
+        for pickup, dropoff, count in od.items():
+            items[pickup]['m%d' % (dropoff or 0)] = count
+        return items
+
+    @classmethod
+    def encode_cube(cls, cube):
+        """Nonzero counters of a DistrictCube, district => item attributes"""
+        prefixes = {'pickups': 'p', 'dropoffs': 'r'}
+        items = defaultdict(dict)
+        for kind, district, hour, count in cube.items():
+            items[district]['%s%d' % (prefixes[kind], hour)] = count
+        return items
+
+    @classmethod
+    def encode(cls, stat):
+        """Flatten a TaxiStat into item attributes"""
         def add_values(counter, prefix):
             for key, count in counter.items():
-                values[':%s%s' % (prefix, key)] = count
+                values['%s%s' % (prefix, key)] = count
 
         values = {}
 
         # use one letter to save bytes, thus write/read units
         # must not overlap with 'color' and 'date'
-        values[':l'] = stat.total
-        values[':i'] = stat.invalid
+        values['l'] = stat.total
+        values['i'] = stat.invalid
         add_values(stat.pickups,   'p')
         add_values(stat.dropoffs,  'r')
         add_values(stat.hour,      'h')
@@ -188,43 +343,45 @@ class StatDB:
         add_values(stat.fare,      'f')
         add_values(stat.borough_pickups,  'k')
         add_values(stat.borough_dropoffs, 'o')
-
-        # HOWTO: contrurct update expression
-        expr = ','.join([k[1:] + k for k in values.keys()])
-
-        self.table.update_item(
-            Key={'color': stat.color, 'date': stat.year * 100 + stat.month},
-            UpdateExpression='add ' + expr,
-            ExpressionAttributeValues=values
-        )
-
-    def get(self, color, year, month):
-        def add_stat(counter, prefix):
-            for key, val in values.items():
-                if key.startswith(prefix):
-                    counter[int(key[1:])] = int(val)
-
+        add_values(stat.trip_time_sketch, 'T')
+        add_values(stat.distance_sketch,  'S')
+        add_values(stat.fare_sketch,      'F')
+        add_values(stat.day,              'D')
+        return values
+
+    @classmethod
+    def decode(cls, values, stat):
+        """Fill a TaxiStat from item attributes"""
+        # HOWTO: one pass over attributes, by the prefix of their counter
+        counters = {
+            'p': stat.pickups,
+            'r': stat.dropoffs,
+            'h': stat.hour,
+            't': stat.trip_time,
+            's': stat.distance,
+            'f': stat.fare,
+            'k': stat.borough_pickups,
+            'o': stat.borough_dropoffs,
+            'T': stat.trip_time_sketch,
+            'S': stat.distance_sketch,
+            'F': stat.fare_sketch,
+            'D': stat.day
+        }
+        stat.total = values['l']
+        stat.invalid = values['i']
+        for key, val in values.items():
+            counter = counters.get(key[0]) if len(key) > 1 else None
+            if counter is not None: counter[int(key[1:])] = int(val)
+        return stat
+
+    def get(self, color, year, month, query=None):
+        """TaxiStat of a month, without its origin-destination matrix and
+        district cube, which get_flows and get_cube read"""
         stat = TaxiStat(color, year, month)
         try:
-            response = self.table.get_item(
-                Key={
-                    'color': color,
-                    'date': year * 100 + month
-                }
-            )
-
-            values = response['Item']
-
-            stat.total = values['l']
-            stat.invalid = values['i']
-            add_stat(stat.pickups,   'p')
-            add_stat(stat.dropoffs,  'r')
-            add_stat(stat.hour,      'h')
-            add_stat(stat.trip_time, 't')
-            add_stat(stat.distance,  's')
-            add_stat(stat.fare,      'f')
-            add_stat(stat.borough_pickups,  'k')
-            add_stat(stat.borough_dropoffs, 'o')
+            values = self.table.get(self.key(color, year, month, query))
+            if values is None: raise KeyError
+            self.decode(values, stat)
         except botocore.exceptions.ClientError as e:
             logger.warning(e.response['Error']['Message'])
         except KeyError:
@@ -232,22 +389,62 @@ class StatDB:
         finally:
             return stat
 
+    def get_flows(self, color, year, month, pickup, query=None):
+        """Counter of dropoff district => trips out of a pickup district"""
+        flows = Counter()
+        try:
+            key = self.shard_key(self.key(color, year, month, query), 'od',
+                                 pickup)
+            for name, count in (self.table.get(key) or {}).items():
+                if name.startswith('m'):
+                    flows[int(name[1:]) or None] = int(count)
+        except botocore.exceptions.ClientError as e:
+            logger.warning(e.response['Error']['Message'])
+        return flows
+
+    def get_cube(self, color, year, month, query=None, districts=None):
+        """DistrictCube of a month, of a list of district indexes only if
+        given, one item each"""
+        kinds = {'p': 'pickups', 'r': 'dropoffs'}
+        cube = DistrictCube()
+        if districts is None: districts = cube.indexes
+        try:
+            key = self.key(color, year, month, query)
+            for district in districts:
+                values = self.table.get(self.shard_key(key, 'cube', district))
+                for name, count in (values or {}).items():
+                    if name[0] in kinds:
+                        cube.put(kinds[name[0]], district, int(name[1:]),
+                                 int(count))
+        except botocore.exceptions.ClientError as e:
+            logger.warning(e.response['Error']['Message'])
+        return cube
+
     def purge(self):
-        logger.warning('%s => purge' % self.table.table_arn)
+        logger.warning('%s => purge' % self.table.uri)
+        ODMatrix.load_numbers()
         for color in ['yellow', 'green']:
-            response = self.table.query(
-                KeyConditionExpression=Key('color').eq(color))
-            for item in response['Items']:
-                self.table.delete_item(Key={
-                    'color': item['color'],
-                    'date':  item['date']
-                })
+            shards = [color] + ['%s#%s%d' % (color, shard, district or 0)
+                for shard in self.SHARDS for district in ODMatrix.indexes]
+            for shard in shards:
+                for key in self.table.keys(shard):
+                    self.table.delete(key)
 
 class TaxiStat(object):
-    def __init__(self, color=None, year=0, month=0):
+    # Counter attributes, which TaxiStats add
+    COUNTERS = ['pickups', 'dropoffs', 'hour', 'trip_time', 'distance',
+                'fare', 'borough_pickups', 'borough_dropoffs',
+                'trip_time_sketch', 'distance_sketch', 'fare_sketch', 'day']
+
+    def __init__(self, color=None, year=0, month=0, where=None):
         self.color = color
         self.year = year
         self.month = month
+        # query.Predicate of the records counted, None of all records
+        self.where = Predicate(where) if where else None
+        self.reset()
+
+    def reset(self):
         self.total = 0                      # number of total records
         self.invalid = 0                    # number of invalid records
         self.pickups = Counter()            # district -> # of pickups
@@ -258,10 +455,100 @@ class TaxiStat(object):
         self.fare = Counter()               # fare distribution
         self.borough_pickups  = Counter()   # borough -> # of pickups
         self.borough_dropoffs = Counter()   # borough -> # of dropoffs
+        # quantile sketches, bucket -> count, see sketch.py
+        self.trip_time_sketch = Counter()
+        self.distance_sketch = Counter()
+        self.fare_sketch = Counter()
+        self.od = ODMatrix()                # trips by (pickup, dropoff)
+        self.cube = DistrictCube()          # by district, weekday and hour
+        self.day = Counter()                # day since BASE_DATE -> trips
+
+    def __add__(self, x):
+        if self is x: return self
+        self.total += x.total
+        self.invalid += x.invalid
+        # HOWTO: update adds counts in place, + copies both counters, and
+        # empty counters, such as boroughs before finish(), are skipped
+        for name in self.COUNTERS:
+            counter = getattr(x, name)
+            if counter: getattr(self, name).update(counter)
+        # arrays of None counts, of no trips, add nothing
+        self.od += x.od
+        self.cube += x.cube
+        return self
+
+    @property
+    def query(self):
+        """Key of the query of this statistics in StatDB, None of a month"""
+        return self.where.key if self.where else None
+
+    def count(self, pickup_district, dropoff_district, pickup_time,
+              trip_time, trip_distance, fare_amount):
+        """Count a record of located districts, None if not located, and
+        pickup time in seconds since BASE_DATE"""
+        self.total += 1
+        if pickup_district is None and dropoff_district is None:
+            self.invalid += 1
+            return
+
+        if pickup_district:  self.pickups[pickup_district] += 1
+        if dropoff_district: self.dropoffs[dropoff_district] += 1
+        self.od.add(pickup_district, dropoff_district)
+        self.cube.add(pickup_district, dropoff_district, pickup_time,
+                      pickup_time + trip_time)
+        # HOWTO: BASE_DATE is a midnight, so hours are those of seconds
+        self.hour[pickup_time // 3600 % 24] += 1
+        self.day[pickup_time // 86400] += 1
+
+        if   trip_distance >= 20: self.distance[20] += 1
+        elif trip_distance >= 10: self.distance[10] += 1
+        elif trip_distance >= 5:  self.distance[5]  += 1
+        elif trip_distance >= 2:  self.distance[2]  += 1
+        elif trip_distance >= 1:  self.distance[1]  += 1
+        else:                     self.distance[0]  += 1
+
+        if   trip_time >= 3600:   self.trip_time[3600] += 1
+        elif trip_time >= 2700:   self.trip_time[2700] += 1
+        elif trip_time >= 1800:   self.trip_time[1800] += 1
+        elif trip_time >= 900:    self.trip_time[900]  += 1
+        elif trip_time >= 600:    self.trip_time[600]  += 1
+        elif trip_time >= 300:    self.trip_time[300]  += 1
+        else:                     self.trip_time[0]    += 1
+
+        if   fare_amount >= 100:  self.fare[100] += 1
+        elif fare_amount >= 50:   self.fare[50]  += 1
+        elif fare_amount >= 25:   self.fare[25]  += 1
+        elif fare_amount >= 10:   self.fare[10]  += 1
+        elif fare_amount >= 5:    self.fare[5]   += 1
+        else:                     self.fare[0]   += 1
+
+        # HOWTO: LogSketch.bucket inlined, this is per record
+        bisect_right = bisect.bisect_right
+        self.trip_time_sketch[
+            bisect_right(TRIP_TIME_SKETCH.bounds, trip_time)] += 1
+        self.distance_sketch[
+            bisect_right(DISTANCE_SKETCH.bounds, trip_distance)] += 1
+        self.fare_sketch[bisect_right(FARE_SKETCH.bounds, fare_amount)] += 1
+
+    def finish(self):
+        """Aggregate boroughs' pickups and dropoffs from districts'"""
+        for index, count in self.pickups.items():
+            self.borough_pickups[index/10000] += count
+            self.borough_pickups[0] += count
+        for index, count in self.dropoffs.items():
+            self.borough_dropoffs[index/10000] += count
+            self.borough_dropoffs[0] += count
 
     def get_hour(self):
         return [self.hour[i] for i in range(24)]
 
+    def get_days(self):
+        """Trips by day of the month, from the first"""
+        if not self.year: return []
+        first = (datetime.datetime(self.year, self.month, 1) - BASE_DATE).days
+        days = calendar.monthrange(self.year, self.month)[1]
+        return [self.day[first + i] for i in range(days)]
+
     def get_trip_time(self):
         return [self.trip_time[i] \
             for i in [0, 300, 600, 900, 1800, 2700, 3600]]
@@ -272,25 +559,67 @@ class TaxiStat(object):
     def get_fare(self):
         return [self.fare[i] for i in [0, 5, 10, 25, 50, 100]]
 
+    def get_trip_time_quantiles(self, quantiles=QUANTILES):
+        """Seconds of trip time quantiles, None if no trip was counted"""
+        return TRIP_TIME_SKETCH.quantiles(self.trip_time_sketch, quantiles)
+
+    def get_distance_quantiles(self, quantiles=QUANTILES):
+        return DISTANCE_SKETCH.quantiles(self.distance_sketch, quantiles)
+
+    def get_fare_quantiles(self, quantiles=QUANTILES):
+        return FARE_SKETCH.quantiles(self.fare_sketch, quantiles)
+
 class NYCTaxiStat(TaxiStat):
+    """Statistics of a month, or of the records of its first query, and
+    the TaxiStat of every other query in `stats`
+
+    A shared scan: records are read and parsed once, located once, and
+    counted by each query that matches them.
+    """
+
+    PROGRESS_INTERVAL = 10000   # records between progress updates
+    progress = None             # shared counter set by mapper initializer
+
+    # columns read of the columnar format, and of untagged records
+    COLUMNS = ['pickup_time', 'dropoff_time', 'distance', 'fare',
+               'districts']
+    COORDINATES = ['pickup_longitude', 'pickup_latitude',
+                   'dropoff_longitude', 'dropoff_latitude']
+
+    TOP_FLOWS = 5   # origin-destination pairs reported
+
+    # lower bounds of the buckets of trip time, distance and fare
+    TRIP_TIMES = [0, 300, 600, 900, 1800, 2700, 3600]
+    DISTANCES = [0, 1, 2, 5, 10, 20]
+    FARES = [0, 5, 10, 25, 50, 100]
+
     def __init__(self, opts):
-        super(NYCTaxiStat, self).__init__(opts.color, opts.year, opts.month)
+        self.stats = [self]     # statistics of each query, this one first
+        queries = opts.queries
+        super(NYCTaxiStat, self).__init__(opts.color, opts.year, opts.month,
+                                          queries[0])
+        self.stats += [TaxiStat(opts.color, opts.year, opts.month, where)
+                       for where in queries[1:]]
         self.opts = opts
-        self.reader = RecordReader()
+        self.reader = RecordReader(get_backend(opts), opts.record_format)
         self.elapsed = 0
+        self.load_elapsed = time.time()
         self.districts = NYCGeoPolygon.load_districts()
+        self.codes = NYCDistrictCode(self.districts)
+        self.load_elapsed = time.time() - self.load_elapsed
         self.path = ''
+        # queries ruling records out before they are located
+        self.prefilter = any([stat.where and not stat.where.located
+                              for stat in self.stats])
+
+    def reset(self):
+        super(NYCTaxiStat, self).reset()
+        for stat in self.stats[1:]: stat.reset()
 
     def __add__(self, x):
         if self is x: return self
-        self.total += x.total
-        self.invalid += x.invalid
-        self.pickups += x.pickups
-        self.dropoffs += x.dropoffs
-        self.hour += x.hour
-        self.trip_time += x.trip_time
-        self.distance += x.distance
-        self.fare += x.fare
+        super(NYCTaxiStat, self).__add__(x)
+        for stat, other in zip(self.stats[1:], x.stats[1:]): stat += other
         self.elapsed = max(self.elapsed, x.elapsed)
         return self
 
@@ -321,169 +650,590 @@ class NYCTaxiStat(TaxiStat):
         trip_distance = float(trip_distance)
         fare_amount = float(fare_amount)
 
-        pickup_district, dropoff_district = None, None
-
-        # Note: district in particular order, see geo.py
-        for district in self.districts:
-            if pickup_district is None and \
-               (pickup_longitude, pickup_latitude) in district:
-                pickup_district = district.index
-            if dropoff_district is None and \
-               (dropoff_longitude, dropoff_latitude) in district:
-                dropoff_district = district.index
-            if pickup_district and dropoff_district: break
-
-        self.total += 1
+        # records all queries rule out are neither counted nor located
+        stats = self.stats
+        fields = (pickup_datetime, dropoff_datetime,
+                  pickup_longitude, pickup_latitude,
+                  dropoff_longitude, dropoff_latitude,
+                  trip_distance, fare_amount, pickup_hour, trip_time)
+        if self.prefilter:
+            stats = [stat for stat in stats if not stat.where or
+                     stat.where.located or self.matches(stat.where, fields)]
+            if not stats: return None
+
+        # districts located by raw2aws.py --geocode
+        located = self.codes.read(line)
+        if located:
+            pickup_district, dropoff_district = located
+        else:
+            pickup_district, dropoff_district = self.locate(
+                (pickup_longitude, pickup_latitude),
+                (dropoff_longitude, dropoff_latitude))
         if pickup_district is None and dropoff_district is None:
             logger.debug("(%f, %f) >> (%f, %f) => unable to locate" % \
                 (pickup_longitude, pickup_latitude, \
                  dropoff_longitude, dropoff_latitude))
-            self.invalid += 1
-            return None
-
-        if pickup_district:  self.pickups[pickup_district] += 1
-        if dropoff_district: self.dropoffs[dropoff_district] += 1
-        self.hour[pickup_hour] += 1
-
-        if   trip_distance >= 20: self.distance[20] += 1
-        elif trip_distance >= 10: self.distance[10] += 1
-        elif trip_distance >= 5:  self.distance[5]  += 1
-        elif trip_distance >= 2:  self.distance[2]  += 1
-        elif trip_distance >= 1:  self.distance[1]  += 1
-        else:                     self.distance[0]  += 1
-
-        if   trip_time >= 3600:   self.trip_time[3600] += 1
-        elif trip_time >= 2700:   self.trip_time[2700] += 1
-        elif trip_time >= 1800:   self.trip_time[1800] += 1
-        elif trip_time >= 900:    self.trip_time[900]  += 1
-        elif trip_time >= 600:    self.trip_time[600]  += 1
-        elif trip_time >= 300:    self.trip_time[300]  += 1
-        else:                     self.trip_time[0]    += 1
 
-        if   fare_amount >= 100:  self.fare[100] += 1
-        elif fare_amount >= 50:   self.fare[50]  += 1
-        elif fare_amount >= 25:   self.fare[25]  += 1
-        elif fare_amount >= 10:   self.fare[10]  += 1
-        elif fare_amount >= 5:    self.fare[5]   += 1
-        else:                     self.fare[0]   += 1
+        for stat in stats:
+            if stat.where and stat.where.located and not self.matches(
+                stat.where, fields, pickup_district, dropoff_district):
+                continue
+            stat.count(pickup_district, dropoff_district, pickup_datetime,
+                       trip_time, trip_distance, fare_amount)
+
+    def matches(self, where, fields, pickup_district=None,
+                dropoff_district=None):
+        """True if a query.Predicate holds for the parsed fields, pickup
+        hour and trip time of a record and its districts"""
+        pickup_time, hour, trip_time = fields[0], fields[8], fields[9]
+        pickup_district = pickup_district or 0
+        dropoff_district = dropoff_district or 0
+        return where.match(*(fields[:8] + (hour,
+            (pickup_time // 86400 + BASE_DATE.weekday()) % 7, trip_time,
+            pickup_district / 100, dropoff_district / 100,
+            pickup_district / 10000, dropoff_district / 10000)))
+
+    def locate(self, pickup, dropoff):
+        """(pickup, dropoff) districts of points, a None point or one out
+        of every district is located in None"""
+        pickup_district, dropoff_district = None, None
+        # Note: district in particular order, see geo.py
+        for district in self.districts:
+            if pickup_district is None and pickup and pickup in district:
+                pickup_district = district.index
+            if dropoff_district is None and dropoff and dropoff in district:
+                dropoff_district = district.index
+            if (pickup_district or not pickup) and \
+               (dropoff_district or not dropoff): break
+        return pickup_district, dropoff_district
+
+    def search_columns(self, columns, names=None):
+        """Count a row group of {name: values} of the columnar format as
+        search does records, but only for the statistics the columns of
+        `names`, all of them by default, tell: districts need the districts
+        or coordinate columns, so without them no record is invalid. Other
+        columns are read for queries only"""
+        names = set(names or columns)
+        n = len(columns.values()[0])
+        located = [None] * n    # districts of rows, located once if needed
+
+        def locate(rows):
+            missing = [i for i in rows if located[i] is None]
+            for i, districts in zip(missing,
+                                    self.locate_rows(columns, missing)):
+                located[i] = districts
+            return [located[i] for i in rows]
+
+        for stat in self.stats:
+            rows = range(n)
+            if stat.where:
+                rows = self.select(stat.where, columns,
+                    locate(rows) if stat.where.located else None)
+            self.count_rows(stat, columns, names, rows, locate)
+
+    def count_rows(self, stat, columns, names, rows, locate):
+        """Count rows of a row group into the TaxiStat of a query"""
+        def values(name):
+            column = columns[name]
+            return [column[i] for i in rows]
+
+        def count(counter, edges, values):
+            for value in values:
+                counter[edges[max(bisect.bisect_right(edges, value) - 1,
+                                  0)]] += 1
+
+        stat.total += len(rows)
+        located = None  # districts of valid rows, if known
+        if 'districts' in names or names.intersection(self.COORDINATES):
+            valid, located = [], []
+            for i, districts in zip(rows, locate(rows)):
+                pickup_district, dropoff_district = districts
+                if pickup_district is None and dropoff_district is None:
+                    stat.invalid += 1
+                    continue
+                if pickup_district:  stat.pickups[pickup_district] += 1
+                if dropoff_district: stat.dropoffs[dropoff_district] += 1
+                stat.od.add(pickup_district, dropoff_district)
+                valid.append(i)
+                located.append(districts)
+            rows = valid
+
+        if 'pickup_time' in names:
+            pickup_times = values('pickup_time')
+            # HOWTO: BASE_DATE is a midnight, so hours are those of seconds
+            for t in pickup_times:
+                stat.hour[t // 3600 % 24] += 1
+                stat.day[t // 86400] += 1
+            dropoff_times = None
+            if 'dropoff_time' in names:
+                dropoff_times = values('dropoff_time')
+                trip_times = [d - p for p, d in zip(pickup_times,
+                                                    dropoff_times)]
+                count(stat.trip_time, self.TRIP_TIMES, trip_times)
+                TRIP_TIME_SKETCH.count(stat.trip_time_sketch, trip_times)
+            if located is not None:
+                stat.cube.add_rows(located, pickup_times, dropoff_times)
+        if 'distance' in names:
+            distances = values('distance')
+            count(stat.distance, self.DISTANCES, distances)
+            DISTANCE_SKETCH.count(stat.distance_sketch, distances)
+        if 'fare' in names:
+            fares = values('fare')
+            count(stat.fare, self.FARES, fares)
+            FARE_SKETCH.count(stat.fare_sketch, fares)
+
+    def locate_rows(self, columns, rows):
+        """(pickup, dropoff) districts of rows of a row group, by their
+        district codes or else their coordinates"""
+        def points(lon, lat):
+            if lon not in columns or lat not in columns:
+                return lambda i: None
+            lons, lats = columns[lon], columns[lat]
+            return lambda i: (lons[i], lats[i])
+
+        tags = columns.get('districts')
+        pickup = points('pickup_longitude', 'pickup_latitude')
+        dropoff = points('dropoff_longitude', 'dropoff_latitude')
+        located = []
+        for i in rows:
+            districts = tags and self.codes.decode(tags[i])
+            if not districts:
+                districts = self.locate(pickup(i), dropoff(i))
+            located.append(districts)
+        return located
+
+    def select(self, where, columns, located=None):
+        """Rows of a row group matching a query.Predicate, of all its rows
+        located if the predicate needs districts"""
+        import numpy
+
+        def array(name):
+            # HOWTO: numpy shares the memory of array.array columns
+            return numpy.frombuffer(columns[name], columns[name].typecode)
 
-    def report(self):
+        values = {}
+        for name in where.names:
+            if name in columns:
+                values[name] = array(name)
+            elif name == 'hour':
+                values[name] = array('pickup_time') // 3600 % 24
+            elif name == 'weekday':
+                values[name] = (array('pickup_time') // 86400 + \
+                    BASE_DATE.weekday()) % 7
+            elif name == 'trip_time':
+                values[name] = array('dropoff_time') - array('pickup_time')
+            else:
+                pickup, divisor = name.startswith('pickup'), \
+                    100 if name.endswith('district') else 10000
+                values[name] = numpy.array([(d[0 if pickup else 1] or 0) / \
+                    divisor for d in located], dtype=int)
+        return numpy.flatnonzero(where.mask(values)).tolist()
+
+    def report(self, stat=None):
+        """Print the statistics of a query, of the first by default"""
+        stat = stat or self
         width = 50
-        report_date = datetime.datetime(self.opts.year, self.opts.month, 1)
+        report_date = datetime.datetime(self.year, self.month, 1)
         title = " NYC %s Cab, %s " %\
-            (self.opts.color.capitalize(), report_date.strftime('%B %Y'))
+            (self.color.capitalize(), report_date.strftime('%B %Y'))
         print(title.center(width, '='))
+        if stat.where: print('where %s' % stat.where.key)
 
         format_str = "%14s: %16s %16s"
         print(format_str % ('Borough', 'Pickups', 'Dropoffs'))
         for index, name in NYCBorough.BOROUGHS.items():
             print(format_str % (name,
-                                self.borough_pickups[index],
-                                self.borough_dropoffs[index]))
+                                stat.borough_pickups[index],
+                                stat.borough_dropoffs[index]))
 
         print(" Pickup Time ".center(width, '-'))
         format_str = "%14s: %33s"
         for hour in range(24):
-            if hour in self.hour:
+            if hour in stat.hour:
                 hour_str = '%d:00 ~ %d:59' % (hour, hour)
-                print(format_str % (hour_str, self.hour[hour]))
+                print(format_str % (hour_str, stat.hour[hour]))
+
+        print(" Pickup Day ".center(width, '-'))
+        weekdays = Counter()
+        for day, count in stat.day.items():
+            weekdays[(day + BASE_DATE.weekday()) % 7] += count
+        for weekday in range(7):
+            if weekday in weekdays:
+                print(format_str % (calendar.day_name[weekday],
+                                    weekdays[weekday]))
+        if stat.day:
+            day, count = max(stat.day.items(), key=lambda item: item[1])
+            day = BASE_DATE + datetime.timedelta(days=day)
+            print(format_str % ('Busiest',
+                                '%s: %d' % (day.strftime('%Y-%m-%d'), count)))
 
         print(" Trip Distance (miles) ".center(width, '-'))
         format_str = "%14s: %33s"
-        print(format_str % ('0 ~ 1',   self.distance[0]))
-        print(format_str % ('1 ~ 2',   self.distance[1]))
-        print(format_str % ('2 ~ 5',   self.distance[2]))
-        print(format_str % ('5 ~ 10',  self.distance[5]))
-        print(format_str % ('10 ~ 20', self.distance[10]))
-        print(format_str % ('> 20',    self.distance[20]))
+        print(format_str % ('0 ~ 1',   stat.distance[0]))
+        print(format_str % ('1 ~ 2',   stat.distance[1]))
+        print(format_str % ('2 ~ 5',   stat.distance[2]))
+        print(format_str % ('5 ~ 10',  stat.distance[5]))
+        print(format_str % ('10 ~ 20', stat.distance[10]))
+        print(format_str % ('> 20',    stat.distance[20]))
 
         print(" Trip Time (minutes) ".center(width, '-'))
         format_str = "%14s: %33s"
-        print(format_str % ('0 ~ 5',   self.trip_time[0]))
-        print(format_str % ('5 ~ 10',  self.trip_time[300]))
-        print(format_str % ('10 ~ 15', self.trip_time[600]))
-        print(format_str % ('15 ~ 30', self.trip_time[900]))
-        print(format_str % ('30 ~ 45', self.trip_time[1800]))
-        print(format_str % ('45 ~ 60', self.trip_time[2700]))
-        print(format_str % ('> 60',    self.trip_time[3600]))
+        print(format_str % ('0 ~ 5',   stat.trip_time[0]))
+        print(format_str % ('5 ~ 10',  stat.trip_time[300]))
+        print(format_str % ('10 ~ 15', stat.trip_time[600]))
+        print(format_str % ('15 ~ 30', stat.trip_time[900]))
+        print(format_str % ('30 ~ 45', stat.trip_time[1800]))
+        print(format_str % ('45 ~ 60', stat.trip_time[2700]))
+        print(format_str % ('> 60',    stat.trip_time[3600]))
 
         print(" Fare (dollars) ".center(width, '-'))
         format_str = "%14s: %33s"
-        print(format_str % ('0 ~ 5',    self.fare[0]))
-        print(format_str % ('5 ~ 10',   self.fare[5]))
-        print(format_str % ('10 ~ 25',  self.fare[10]))
-        print(format_str % ('25 ~ 50',  self.fare[25]))
-        print(format_str % ('50 ~ 100', self.fare[50]))
-        print(format_str % ('> 100',    self.fare[100]))
+        print(format_str % ('0 ~ 5',    stat.fare[0]))
+        print(format_str % ('5 ~ 10',   stat.fare[5]))
+        print(format_str % ('10 ~ 25',  stat.fare[10]))
+        print(format_str % ('25 ~ 50',  stat.fare[25]))
+        print(format_str % ('50 ~ 100', stat.fare[50]))
+        print(format_str % ('> 100',    stat.fare[100]))
+
+        print(" Percentiles ".center(width, '-'))
+        format_str = "%14s: %10s %10s %10s"
+        print(format_str % ('', 'Miles', 'Minutes', 'Dollars'))
+        for q, distance, trip_time, fare in zip(QUANTILES,
+                stat.get_distance_quantiles(), stat.get_trip_time_quantiles(),
+                stat.get_fare_quantiles()):
+            print(format_str % ('p%g' % (q * 100),
+                '-' if distance is None else '%.2f' % distance,
+                '-' if trip_time is None else '%.1f' % (trip_time / 60.0),
+                '-' if fare is None else '%.2f' % fare))
+
+        print(" Top Flows (districts) ".center(width, '-'))
+        format_str = "%14s: %33s"
+        flows = sorted(stat.od.items(), key=lambda item: -item[2])
+        for pickup, dropoff, count in flows[:self.TOP_FLOWS]:
+            print(format_str % ('%s > %s' % (pickup or '-', dropoff or '-'),
+                                count))
 
         print(''.center(width, '='))
         print("Done, %d/%d records in %.2f seconds by %d processes." %\
-            (self.total-self.invalid, self.total, self.elapsed, self.opts.nprocs))
+            (stat.total-stat.invalid, stat.total, self.elapsed, self.opts.nprocs))
+
+    def update_progress(self, count):
+        if self.progress is None: return
+        with self.progress.get_lock():
+            self.progress.value += count
+
+    def finish(self):
+        for stat in self.stats: TaxiStat.finish(stat)
 
     def run(self):
         self.elapsed = time.time()
 
         try:
+            # blocks are skipped only if every query rules them out
             with self.reader.open(\
                 self.opts.color, self.opts.year, self.opts.month, \
-                self.opts.src, self.opts.start, self.opts.end) as fin:
+                self.opts.src, self.opts.start, self.opts.end, \
+                scan_predicate([stat.where for stat in self.stats])) as fin:
                 self.path = fin.path
-                for line in fin.readlines(): self.search(line)
+                if fin.data_type == fin.DATA_COLUMN:
+                    return self.run_columns(fin)
+                for i, line in enumerate(fin.readlines(), 1):
+                    self.search(line)
+                    if i % self.PROGRESS_INTERVAL == 0:
+                        self.update_progress(self.PROGRESS_INTERVAL)
         except KeyboardInterrupt as e:
             return
 
-        # aggregate boroughs' pickups and dropoffs
-        for index, count in self.pickups.items():
-            self.borough_pickups[index/10000] += count
-            self.borough_pickups[0] += count
-        for index, count in self.dropoffs.items():
-            self.borough_dropoffs[index/10000] += count
-            self.borough_dropoffs[0] += count
+        self.finish()
+        self.elapsed = time.time() - self.elapsed
 
+    def run_columns(self, fin):
+        names, untagged = self.opts.columns, ()
+        # coordinates locate records not geocoded by raw2aws.py --geocode
+        if not names: names, untagged = self.COLUMNS, self.COORDINATES
+        read = list(names)
+        for stat in self.stats:
+            if not stat.where: continue
+            read += [name for name in stat.where.columns if name not in read]
+            if stat.where.located: untagged = self.COORDINATES
+        try:
+            for columns in fin.readcolumns(read, untagged):
+                self.search_columns(columns, names)
+                # progress of records scanned, queries may match none
+                self.update_progress(len(columns[read[0]]))
+        except KeyboardInterrupt as e:
+            return
+
+        self.finish()
         self.elapsed = time.time() - self.elapsed
 
 def start_process(opts):
+    if opts.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
     p = NYCTaxiStat(opts)
     p.run()
+
+    if opts.profile:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(opts.profile, '%s-%d.prof' % \
+            (multiprocessing.current_process().name, os.getpid())))
+
+    # peak resident set size of this mapper in KB
+    p.max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
     return p
 
-def start_multiprocess(opts):
-    def init():
+def collapse_profile(stats, path):
+    """Write stats as collapsed stacks for flamegraph.pl
+
+    cProfile only records caller -> callee edges, so the time of a function
+    is split among its callers in proportion to the edge cumulative time.
+    """
+    def label(func):
+        filename, line, name = func
+        return ('%s:%d:%s' % (os.path.basename(filename), line, name)) \
+            .replace(';', ':').replace(' ', '_')
+
+    callees = defaultdict(dict)
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        for caller, edge in callers.items():
+            callees[caller][func] = edge[3]
+
+    stacks = Counter()
+    total = max(stats.total_tt, 1e-9)
+
+    def walk(func, stack, visiting, weight):
+        stack = stack + [label(func)]
+        cc, nc, tt, ct, callers = stats.stats[func]
+        stacks[';'.join(stack)] += tt * weight
+        for callee, edge_ct in callees[func].items():
+            callee_ct = stats.stats[callee][3]
+            if callee in visiting or callee_ct <= 0: continue
+            if edge_ct * weight < total * 1e-4: continue    # prune tiny paths
+            visiting.add(callee)
+            walk(callee, stack, visiting, weight * edge_ct / callee_ct)
+            visiting.remove(callee)
+
+    for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+        if not callers: walk(func, [], set([func]), 1.0)
+
+    with open(path, 'w') as f:
+        for stack, seconds in sorted(stacks.items()):
+            usecs = int(seconds * 1e6)
+            if usecs > 0: f.write('%s %d\n' % (stack, usecs))
+
+def merge_profiles(directory):
+    paths = sorted(glob.glob(os.path.join(directory, 'mapper*.prof')))
+    if not paths: return
+
+    with open(os.path.join(directory, 'report.txt'), 'w') as f:
+        stats = pstats.Stats(*paths, stream=f)
+        f.write('Merged %d profiles: %s\n' % \
+            (len(paths), ' '.join([os.path.basename(p) for p in paths])))
+        stats.sort_stats('cumulative').print_stats(50)
+        stats.sort_stats('tottime').print_stats(50)
+    stats.dump_stats(os.path.join(directory, 'merged.prof'))
+    collapse_profile(stats, os.path.join(directory, 'collapsed.txt'))
+    logger.info('%d profiles => %s/report.txt' % (len(paths), directory))
+
+def start_multiprocess(opts, progress=None):
+    def init(progress):
         _, idx = multiprocessing.current_process().name.split('-')
         multiprocessing.current_process().name = 'mapper%02d' % int(idx)
+        NYCTaxiStat.progress = progress
 
     db = StatDB(opts)
+    if opts.profile and not os.path.isdir(opts.profile):
+        os.makedirs(opts.profile)
+
+    elapsed = time.time()
+    if opts.start >= opts.end:
+        # e.g. a --from/--to slice of no records, nothing is appended
+        logger.warning('no records in [%d, %d)' % (opts.start, opts.end))
+        opts = copy.copy(opts)
+        opts.nprocs = 0
+        master = NYCTaxiStat(opts)
+        master.timings = dict([(name, 0.0) for name in
+                               ['pool', 'map', 'load', 'reduce', 'wall']])
+        master.mappers_rss = []
+        if opts.report:
+            for stat in master.stats: master.report(stat)
+        return master
 
     tasks = []
-    for start, end in TaskManager.cut(opts.start, opts.end, opts.nprocs):
+    # no more mappers than records, as in create_tasks
+    n = max(min(opts.nprocs, opts.end - opts.start), 1)
+    # HOWTO: cut takes an inclusive end, records are [start, end)
+    parts = TaskManager.cut(opts.start, opts.end - 1, n)
+    for start, end in parts:
         opts_copy = copy.deepcopy(opts)
         opts_copy.start, opts_copy.end = start, end
+        opts_copy.nprocs = len(parts)
         tasks.append(opts_copy)
 
     try:
-        procs = multiprocessing.Pool(processes=opts.nprocs, initializer=init)
+        procs = multiprocessing.Pool(processes=len(tasks), initializer=init,
+            initargs=(progress,))
+        pool_elapsed = time.time() - elapsed
         results = procs.map(start_process, tasks)
     except Exception as e:
         fatal(e)
     finally:
         procs.close()
         procs.join()
+    map_elapsed = time.time() - elapsed - pool_elapsed
+    if opts.profile: merge_profiles(opts.profile)
 
+    reduce_elapsed = time.time()
     master = results[0]
     for res in results:
         logger.info('%r => reducer' % res)
         master += res
-    db.append(master)
+    if opts.columns: # what a few columns tell is not the whole month
+        logger.info('%r => columns %s, not appended' % \
+            (master, ' '.join(opts.columns)))
+    else:
+        for stat in master.stats:
+            # nor is a filtered month, kept under its query
+            if stat.where:
+                logger.info('%r => where %s' % (master, stat.query))
+            db.append(stat, stat.query)
+    reduce_elapsed = time.time() - reduce_elapsed
+
+    # where the time goes, for scaling benchmarks
+    master.timings = {
+        'pool': pool_elapsed,
+        'map': map_elapsed,
+        'load': max([res.load_elapsed for res in results]),
+        'reduce': reduce_elapsed,
+        'wall': time.time() - elapsed
+    }
+    master.mappers_rss = [res.max_rss for res in results]
+
+    if opts.report:
+        for stat in master.stats: master.report(stat)
+
+    return master
+
+stream_mapper = None    # NYCTaxiStat of a stream mapper process
+
+def map_chunk(args):
+    """TaxiStat of each query of a chunk of streamed records of one month"""
+    color, year, month, records = args
+    mapper = stream_mapper
+    mapper.reset()
+    lines = records.splitlines()
+    for line in lines: mapper.search(line)
+    mapper.update_progress(len(lines))
+    return [TaxiStat(color, year, month) + stat for stat in mapper.stats]
+
+class StreamMapper:
+    """Search chunks of streamed records of one month on a pool of mappers
+
+    `map` takes chunks of whole records, `write` takes records in pieces
+    of any size and cuts them into chunks of STREAM_CHUNK records. At most
+    two chunks per mapper are in flight, so the producer waits for slow
+    mappers. `finish` reduces the month and returns its NYCTaxiStat.
+    """
+
+    def __init__(self, opts, nprocs, progress=None):
+        def init(opts, progress):
+            global stream_mapper
+            _, idx = multiprocessing.current_process().name.split('-')
+            multiprocessing.current_process().name = 'mapper%02d' % int(idx)
+            NYCTaxiStat.progress = progress
+            stream_mapper = NYCTaxiStat(opts)
+
+        self.nprocs = nprocs
+        self.master = NYCTaxiStat(opts)
+        self.month = None
+        self.pending = collections.deque()
+        self.buf, self.buffered = [], 0
+        self.procs = multiprocessing.Pool(processes=nprocs, initializer=init,
+            initargs=(opts, progress))
+
+    def start(self, color, year, month):
+        self.month = (color, year, month)
+        for stat in self.master.stats:
+            stat.color, stat.year, stat.month = self.month
+        self.master.reset()
+        self.master.elapsed = time.time()
+
+    def reduce(self):
+        for stat, result in zip(self.master.stats,
+                                self.pending.popleft().get()):
+            TaxiStat.__add__(stat, result)
+
+    def map(self, records):
+        self.pending.append(self.procs.apply_async(map_chunk,
+                                                   (self.month + (records,),)))
+        while len(self.pending) > 2 * self.nprocs: self.reduce()
+
+    def write(self, data):
+        self.buf.append(str(data))
+        self.buffered += len(data)
+        if self.buffered < STREAM_CHUNK * RECORD_LENGTH: return
+        data = ''.join(self.buf)
+        n = len(data) / RECORD_LENGTH * RECORD_LENGTH
+        self.map(data[:n])
+        self.buf, self.buffered = [data[n:]], len(data) - n
+
+    def finish(self):
+        if self.buffered: self.map(''.join(self.buf))
+        self.buf, self.buffered = [], 0
+        while self.pending: self.reduce()
+        self.master.finish()
+        self.master.elapsed = time.time() - self.master.elapsed
+        self.month = None
+        logger.info('%s-%d-%02d => %d records' % (self.master.color,
+            self.master.year, self.master.month, self.master.total))
+        return self.master
+
+    def close(self):
+        self.procs.terminate()
+        self.procs.join()
 
-    if opts.report: master.report()
+def start_stream(opts, progress=None):
+    """Map records streamed on stdin, month by month
 
-    return True
+    As soon as a marker record announces the next month, the chunks in
+    flight are reduced and the finished month is appended to StatDB,
+    e.g. for
+
+        raw2aws.py --dst - --markers ... | mapred.py --src - -p 4
+    """
+    def publish(master):
+        for stat in master.stats:
+            db.append(stat, stat.query)
+            if opts.report: master.report(stat)
+
+    db = StatDB(opts)
+    mapper = StreamMapper(opts, opts.nprocs, progress)
+    try:
+        with RecordReader(get_backend(opts)).open(opts.color, opts.year,
+                opts.month, '-', opts.start, opts.end) as fin:
+            for args in fin.readchunks(STREAM_CHUNK):
+                if args[:3] != mapper.month:
+                    if mapper.month: publish(mapper.finish())
+                    mapper.start(*args[:3])
+                mapper.map(args[3])
+        if mapper.month: publish(mapper.finish())
+    except KeyboardInterrupt as e:
+        return
+    finally:
+        mapper.close()
 
 def start_worker(opts):
     task_manager = TaskManager(opts)
     if not opts.debug: opts.nprocs = multiprocessing.cpu_count()
     nth_task = 0
 
+    # HOWTO: keep task invisible in short increments while mappers progress
+    progress = multiprocessing.Value('L', 0)
+    interval = int(opts.heartbeat_interval)
+    profile_dir = opts.profile
+
     while True:
         task = task_manager.retrieve_task(delete=False)
         if task:
@@ -493,8 +1243,23 @@ def start_worker(opts):
             opts.month = task.month
             opts.start = task.start
             opts.end = task.end
-            if start_multiprocess(opts):
+            opts.queries = task.queries
+            # worker falls behind on this task, requeue it in smaller parts
+            if task_manager.split_task(task): continue
+            # profile a sample of tasks to keep the overhead low
+            opts.profile = None
+            if profile_dir and nth_task % opts.profile_every == 0:
+                opts.profile = os.path.join(profile_dir, 'task-%05d' % nth_task)
+            elapsed = time.time()
+            heartbeat = TaskHeartbeat(task_manager, task, interval, progress)
+            heartbeat.start()
+            try:
+                succeeded = start_multiprocess(opts, progress)
+            finally:
+                heartbeat.stop()
+            if succeeded:
                 logger.info("task %r => succeeded" % task)
+                task_manager.record_throughput(task, time.time() - elapsed)
                 task_manager.delete_task(task)
             nth_task += 1
         else:
@@ -503,6 +1268,7 @@ def start_worker(opts):
 
 def main(opts):
     if opts.worker: start_worker(opts)
+    elif opts.src == '-': start_stream(opts)
     else: start_multiprocess(opts)
 
 if __name__ == '__main__':
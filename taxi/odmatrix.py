@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Origin-Destination Matrix: Trips by Pickup and Dropoff District
+#
+# Districts of geo.py are numbered 0 ... N - 2 in the order of their
+# indexes, and N - 1 stands for out of every district, so a trip counts in
+# a flat array of N * N counters at
+#
+#   pickup number * N + dropoff number
+#
+# which a mapper increments once per record, and which mappers add as
+# arrays. StatDB keeps nonzero counters only, one item per pickup district
+# under the hash key '<color>#od<pickup index>', of attributes
+# 'm<dropoff index>', 0 the index of out of every district. Items stay far
+# below DynamoDB limits, and the flows out of a district are one item.
+#
+# The array is allocated on the first trip counted, so that TaxiStats of
+# StatDB or of queries that match nothing carry no matrix. DistrictCounters
+# numbers districts and merges and pickles arrays, for cube.py as well.
+
+from __future__ import print_function
+
+import array
+import zlib
+
+from collections import Counter
+
+from geo import NYCGeoPolygon
+
+__all__ = ['DistrictCounters', 'ODMatrix']
+
+class DistrictCounters(object):
+    """Flat array of counters by district number, of `length()` counters
+    once allocated, None before"""
+
+    indexes = None  # district index of each number, None last
+    numbers = None  # district index => number
+
+    def __init__(self):
+        self.load_numbers()
+        self.size = len(self.indexes)
+        self.counts = None
+
+    @classmethod
+    def load_numbers(cls):
+        """Number districts, once for all arrays of a process"""
+        if DistrictCounters.indexes is not None: return
+        indexes = sorted([d.index for d in NYCGeoPolygon.load_districts()])
+        DistrictCounters.indexes = indexes + [None]
+        DistrictCounters.numbers = dict([(index, i) for i, index in
+                                         enumerate(DistrictCounters.indexes)])
+
+    def length(self):
+        raise NotImplementedError
+
+    def zeros(self):
+        return array.array('l', [0]) * self.length()
+
+    def __iadd__(self, x):
+        if x.counts is None: return self
+        if self.counts is None: self.counts = self.zeros()
+        import numpy
+        # HOWTO: numpy adds in place in the memory of array.array
+        counts = numpy.frombuffer(self.counts, self.counts.typecode)
+        counts += numpy.frombuffer(x.counts, x.counts.typecode)
+        return self
+
+    def nonzero(self):
+        """Offsets of nonzero counters"""
+        if self.counts is None: return []
+        import numpy
+        counts = numpy.frombuffer(self.counts, self.counts.typecode)
+        return numpy.flatnonzero(counts).tolist()
+
+    # HOWTO: counters are mostly zeros, results of mappers pickle small
+    def __getstate__(self):
+        if self.counts is None: return self.size, None
+        return self.size, zlib.compress(self.counts.tostring(), 1)
+
+    def __setstate__(self, state):
+        self.load_numbers()
+        self.size, data = state
+        self.counts = None
+        if data is None: return
+        self.counts = array.array('l')
+        self.counts.fromstring(zlib.decompress(data))
+
+class ODMatrix(DistrictCounters):
+    """Trips by (pickup, dropoff) district index, None of out of every
+    district, in a flat array of counters"""
+
+    def length(self):
+        return self.size * self.size
+
+    def add(self, pickup, dropoff, count=1):
+        numbers = self.numbers
+        i = numbers[pickup] * self.size + numbers[dropoff]
+        try:
+            self.counts[i] += count
+        except TypeError:   # HOWTO: None, the first trip counted
+            self.counts = self.zeros()
+            self.counts[i] += count
+
+    def items(self):
+        """(pickup, dropoff, count) of nonzero counters"""
+        for i in self.nonzero():
+            yield (self.indexes[i / self.size], self.indexes[i % self.size],
+                   self.counts[i])
+
+    def flows(self, pickup):
+        """Counter of dropoff => trips from a pickup district"""
+        if self.counts is None: return Counter()
+        start = self.numbers[pickup] * self.size
+        return Counter(dict([(index, count) for index, count in
+            zip(self.indexes, self.counts[start:start + self.size]) if count]))
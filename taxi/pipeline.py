@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Pipelined Read, Convert and Multipart Upload of Raw Taxi Trips
+
+from __future__ import print_function
+
+import collections
+import hashlib
+import multiprocessing
+import Queue
+import threading
+import time
+
+__all__ = ['MultipartUpload', 'UploadPipeline']
+
+def timed(args):
+    """Run `func(arg)` in a pool process, also return its busy seconds"""
+    func, arg = args
+    elapsed = time.time()
+    result = func(arg)
+    return result, time.time() - elapsed
+
+class Stage:
+    """Bytes, items and busy seconds of one pipeline stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.lock = threading.Lock()
+
+    def add(self, nbytes, elapsed):
+        with self.lock:
+            self.items += 1
+            self.bytes += nbytes
+            self.busy += elapsed
+
+    def __str__(self):
+        return "%8s: %5d items %10.1f MB %8.2f s busy %8.1f MB/s" % \
+            (self.name, self.items, self.bytes / 1e6, self.busy,
+             self.bytes / 1e6 / max(self.busy, 1e-9))
+
+class MultipartUpload:
+    """Upload blocks of bytes, in order, as one S3 object
+
+    The calling thread gathers blocks into parts of `part_size` bytes that
+    `threads` uploader threads send to S3 with a multipart upload, at most
+    `queue_depth` parts are queued. Output that fits in one part is sent
+    with a single put_object.
+
+    A failed upload is left unfinished on S3. The next upload of the same
+    key resumes it: conversion is deterministic, so parts listed by S3
+    whose ETag is the MD5 of the part about to be sent are not sent again.
+    """
+
+    def __init__(self, part_size=8 * 1024 * 1024, threads=4, queue_depth=4,
+                 checksum=None):
+        self.part_size = part_size
+        self.threads = threads
+        self.queue_depth = queue_depth
+        self.checksum = checksum    # updated with every uploaded block
+        self.stages = [Stage('upload')]
+        self.elapsed = 0.0
+        self.error = None
+        self.completed = {}         # part number => ETag of resumed upload
+        self.resumed = 0
+
+    def fail(self, e):
+        if self.error is None: self.error = e
+
+    def find_upload(self, client, bucket, key):
+        """Id and completed parts of the latest unfinished upload of key"""
+        uploads = client.list_multipart_uploads(Bucket=bucket, Prefix=key)
+        uploads = [u for u in uploads.get('Uploads', []) if u['Key'] == key]
+        if not uploads: return None, {}
+        upload_id = max(uploads, key=lambda u: u['Initiated'])['UploadId']
+        completed = {}
+        # HOWTO: list_parts returns at most 1000 parts per call
+        paginator = client.get_paginator('list_parts')
+        for page in paginator.paginate(Bucket=bucket, Key=key,
+                                       UploadId=upload_id):
+            for part in page.get('Parts', []):
+                completed[part['PartNumber']] = part['ETag']
+        return upload_id, completed
+
+    def upload_parts(self, client, parts, etags):
+        upload = self.stages[-1]
+        while True:
+            part = parts.get()
+            if part is None: break
+            if self.error is not None: continue # drain after a failure
+            number, data = part
+            etag = '"%s"' % hashlib.md5(data).hexdigest()
+            if self.completed.get(number) == etag:
+                etags[number] = etag
+                with upload.lock: self.resumed += 1
+                continue
+            try:
+                elapsed = time.time()
+                response = client.upload_part(Bucket=self.bucket, Key=self.key,
+                    UploadId=self.upload_id, PartNumber=number, Body=data)
+                upload.add(len(data), time.time() - elapsed)
+                etags[number] = response['ETag']
+            except Exception as e:
+                self.fail(e)
+
+    def upload(self, client, bucket, key, blocks, extra_args=None):
+        extra_args = extra_args or {}
+        self.bucket, self.key, self.upload_id = bucket, key, None
+        self.elapsed = time.time()
+        resume_id, self.completed = self.find_upload(client, bucket, key)
+
+        parts = Queue.Queue(self.queue_depth)
+        etags = {}
+        threads = [threading.Thread(target=self.upload_parts,
+                                    args=(client, parts, etags))
+                   for i in range(self.threads)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        buf, size, number = [], 0, 0
+        try:
+            for block in blocks:
+                if self.error is not None: break
+                if self.checksum: self.checksum.update(block)
+                buf.append(block)
+                size += len(block)
+                if size < self.part_size: continue
+                data = ''.join(buf)
+                if self.upload_id is None and resume_id is not None:
+                    self.upload_id = resume_id
+                elif self.upload_id is None:
+                    self.upload_id = client.create_multipart_upload(
+                        Bucket=bucket, Key=key, **extra_args)['UploadId']
+                while len(data) >= self.part_size:
+                    number += 1
+                    parts.put((number, data[:self.part_size]))
+                    data = data[self.part_size:]
+                buf, size = [data], len(data)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            for t in threads: parts.put(None)
+            for t in threads: t.join()
+
+        data = ''.join(buf)
+        if self.error is None and self.upload_id is None:
+            elapsed = time.time()
+            client.put_object(Bucket=bucket, Key=key, Body=data, **extra_args)
+            self.stages[-1].add(len(data), time.time() - elapsed)
+            if resume_id is not None: # output shrank to a single part
+                client.abort_multipart_upload(Bucket=bucket, Key=key,
+                                              UploadId=resume_id)
+        elif self.error is None:
+            try:
+                if data: # the last part may be short
+                    number += 1
+                    elapsed = time.time()
+                    etags[number] = client.upload_part(Bucket=bucket, Key=key,
+                        UploadId=self.upload_id, PartNumber=number,
+                        Body=data)['ETag']
+                    self.stages[-1].add(len(data), time.time() - elapsed)
+                client.complete_multipart_upload(Bucket=bucket, Key=key,
+                    UploadId=self.upload_id, MultipartUpload={'Parts': [
+                        {'PartNumber': n, 'ETag': etags[n]}
+                        for n in sorted(etags)]})
+            except Exception as e:
+                self.fail(e)
+
+        if self.error is not None: raise self.error # keep parts to resume
+        self.elapsed = time.time() - self.elapsed
+        return self
+
+    def report(self):
+        """Lines of per-stage throughput, busy time is summed over workers"""
+        lines = [str(stage) for stage in self.stages]
+        if self.resumed:
+            lines.append("%8s: %5d parts already uploaded" % \
+                ('resume', self.resumed))
+        lines.append("%8s: %31s %8.2f s" % ('wall', '', self.elapsed))
+        return lines
+
+class UploadPipeline(MultipartUpload):
+    """Read, convert and upload one month in concurrent stages
+
+    A reader thread cuts the raw source into line aligned chunks, a pool
+    of `procs` processes converts them with `convert` and the calling
+    thread uploads converted blocks, in source order, as a MultipartUpload.
+    Stages are connected by queues of `queue_depth` items, so the slowest
+    stage sets the pace instead of the whole month piling up in memory.
+    """
+
+    def __init__(self, reader, convert, procs=1, queue_depth=4,
+                 part_size=8 * 1024 * 1024, threads=4, checksum=None):
+        MultipartUpload.__init__(self, part_size, threads, queue_depth,
+                                 checksum)
+        self.reader = reader
+        self.convert = convert
+        self.procs = procs
+        self.stages = [Stage('read'), Stage('convert')] + self.stages
+
+    def read_chunks(self, chunks):
+        read = self.stages[0]
+        r = self.reader
+        try:
+            # the reader caps records as they are gathered, see
+            # convert_blocks
+            while self.error is None and not r.full():
+                elapsed = time.time()
+                chunk = r.read_chunk(r.CHUNK_SIZE)
+                if not chunk: break
+                read.add(len(chunk), time.time() - elapsed)
+                chunks.put(r.task(chunk))
+        except Exception as e:
+            self.fail(e)
+        finally:
+            chunks.put(None)
+
+    def convert_blocks(self, pool, chunks):
+        """Yield converted blocks in source order"""
+        convert = self.stages[1]
+        pending = collections.deque()
+        eof = False
+        while True:
+            while not eof and len(pending) < self.queue_depth:
+                args = chunks.get()
+                if args is None:
+                    eof = True
+                else:
+                    pending.append(pool.apply_async(timed,
+                                                    ((self.convert, args),)))
+            if not pending or self.reader.full(): break
+            block, elapsed = pending.popleft().get()
+            convert.add(len(block), elapsed)
+            yield self.reader.capped(block)
+
+    def upload(self, client, bucket, key, extra_args=None):
+        # HOWTO: fork the pool before any thread is started
+        pool = multiprocessing.Pool(processes=self.procs)
+        chunks = Queue.Queue(self.queue_depth)
+        reader = threading.Thread(target=self.read_chunks, args=(chunks,))
+        reader.daemon = True
+        reader.start()
+        try:
+            return MultipartUpload.upload(self, client, bucket, key,
+                self.convert_blocks(pool, chunks), extra_args)
+        finally:
+            pool.terminate()
+            pool.join()
+            while reader.is_alive(): # unblock the reader after a failure
+                try:
+                    chunks.get_nowait()
+                except Queue.Empty:
+                    reader.join(0.1)
+
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Ad-hoc Queries: Filter Expressions of Record Fields and Derived Values
+#
+# mapred.py --where takes an expression of record fields and of values
+# derived from them, such as
+#
+#   pickup_borough == 'Manhattan' and hour < 4 and fare > 25
+#   weekday in ('Sat', 'Sun') and trip_time >= 3600
+#   pickup_time >= 2016-01-04T13 and not pickup_district == 105
+#
+# The expression is parsed by Python, checked node by node against the
+# little that is allowed (comparisons, and/or/not, arithmetic, names and
+# constants) and compiled once into a function of a record's values, or
+# into a numpy mask of a row group of the columnar format. Several
+# --where expressions must all hold, several --query make queries of their
+# own, mapped in the same scan. Names, constants and operators:
+#
+#   pickup_time dropoff_time    seconds since BASE_DATE, or dates
+#   pickup_longitude ...        coordinates, distance and fare of records
+#   hour weekday trip_time      pickup hour, pickup weekday (Monday is 0,
+#                               or 'Mon' ...) and seconds of the trip
+#   pickup_district ...         community district, e.g. 105, 0 if unknown
+#   pickup_borough ...          borough, e.g. 1 or 'Manhattan', 0 if unknown
+#
+#   < <= > >= == != in not in and or not + - * /
+
+from __future__ import print_function
+
+import ast
+import re
+
+from common import *
+from zonemap import FIELDS
+
+__all__ = ['LOCATED', 'NAMES', 'Predicate', 'query_key', 'scan_predicate']
+
+# arguments of a compiled predicate, record fields first
+NAMES = [
+    'pickup_time', 'dropoff_time',
+    'pickup_longitude', 'pickup_latitude',
+    'dropoff_longitude', 'dropoff_latitude',
+    'distance', 'fare',
+    'hour', 'weekday', 'trip_time',
+    'pickup_district', 'dropoff_district',
+    'pickup_borough', 'dropoff_borough'
+]
+LOCATED = NAMES[11:]    # names of districts located by mappers
+
+# columns of the columnar format that derived names are computed from
+DERIVED = {
+    'hour': ['pickup_time'],
+    'weekday': ['pickup_time'],
+    'trip_time': ['pickup_time', 'dropoff_time']
+}
+for name in LOCATED: DERIVED[name] = ['districts']
+
+WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+BOROUGHS = {    # names of geo.NYCBorough.BOROUGHS, without importing shapely
+    'manhattan': 1,
+    'bronx': 2,
+    'brooklyn': 3,
+    'queens': 4,
+    'staten island': 5
+}
+
+KEY, RECORD, BATCH = 0, 1, 2   # sources emitted of an expression
+
+# operator => (source of a key or record, source of a batch of rows)
+BOOLOPS = {ast.And: (' and ', ' & '), ast.Or: (' or ', ' | ')}
+BINOPS = {ast.Add: ' + ', ast.Sub: ' - ', ast.Mult: ' * '}
+CMPOPS = {
+    ast.Lt: ' < ', ast.LtE: ' <= ', ast.Gt: ' > ', ast.GtE: ' >= ',
+    ast.Eq: ' == ', ast.NotEq: ' != ', ast.In: ' in ', ast.NotIn: ' not in '
+}
+
+# comparisons a zone map can rule out, name OP value
+BOUNDS = {
+    ast.Lt: lambda low, high, value: low < value,
+    ast.LtE: lambda low, high, value: low <= value,
+    ast.Gt: lambda low, high, value: high > value,
+    ast.GtE: lambda low, high, value: high >= value,
+    ast.Eq: lambda low, high, value: low <= value <= high
+}
+FLIPPED = {ast.Lt: ast.Gt, ast.LtE: ast.GtE, ast.Gt: ast.Lt,
+           ast.GtE: ast.LtE, ast.Eq: ast.Eq}
+
+DATE = re.compile(r'''(?<![\w'"])(\d{4}-\d{2}-\d{2}(?:T\d{2})?)(?![\w'"])''')
+ASSIGN = re.compile(r'(?<![<>=!])=(?!=)')
+
+def truediv(a, b):
+    """a / b of a record as numpy divides row groups, by zero too"""
+    if b: return float(a) / b
+    return float('nan') if a == 0 else float('inf') * (1 if a > 0 else -1)
+
+def parse_constant(name, value):
+    """Number of a string constant compared with `name`"""
+    try:
+        if name in ['pickup_time', 'dropoff_time']:
+            return int((parse_time(value) - BASE_DATE).total_seconds())
+        if name == 'weekday':
+            return WEEKDAYS.index(value[:3].lower())
+        if name in ['pickup_borough', 'dropoff_borough']:
+            return BOROUGHS[value.lower()]
+    except Exception:
+        pass
+    raise ValueError("invalid %s: '%s'" % (name, value))
+
+class Predicate:
+    """Conjunction of --where expressions, compiled once
+
+    `match` tests the values of one record, in NAMES order, `mask` the
+    values of a row group, of the names in `names` computed from the
+    columns in `columns`, and `may_match` the field bounds of a zone map.
+    `key` is the canonical expression that results of the query are
+    stored under in StatDB.
+    """
+
+    def __init__(self, terms):
+        self.terms = terms      # as given, to pass on to workers
+        self.names = set()      # names the expression reads
+        keys, sources, batches, self.trees = [], [], [], []
+        for term in terms:
+            # HOWTO: bare dates and '=' of the first --where syntax
+            text = ASSIGN.sub('==', DATE.sub(r"'\1'", term.strip()))
+            try:
+                tree = ast.parse(text, mode='eval').body
+            except SyntaxError:
+                raise ValueError('invalid expression: %s' % term)
+            keys.append(self.emit(tree, KEY))
+            sources.append(self.emit(tree, RECORD))
+            batches.append(self.emit(tree, BATCH))
+            self.trees.append(tree)
+        if not self.names:
+            raise ValueError('expression of no name: %s' % \
+                ' and '.join(terms))
+        self.names = sorted(self.names, key=NAMES.index)
+        self.located = bool(set(self.names).intersection(LOCATED))
+        self.columns = sorted(set(sum([DERIVED.get(name, [name])
+                                       for name in self.names], [])))
+        self.key = ' and '.join(['(%s)' % s if len(keys) > 1 else s
+                                 for s in keys])
+        self.match = eval('lambda %s: %s' % (', '.join(NAMES),
+            ' and '.join(['(%s)' % s for s in sources])), {'truediv': truediv})
+        self.batch = ' & '.join(['(%s)' % s for s in batches])
+        self.batch_function = None
+
+    def emit(self, node, mode, name=None):
+        """Source of a node, checked, of the KEY, a RECORD or a BATCH of
+        rows; `name` is the field that string constants are compared with"""
+        batch = mode == BATCH
+        if isinstance(node, ast.BoolOp):
+            return BOOLOPS[type(node.op)][batch].join(['(%s)' % \
+                self.emit(value, mode) for value in node.values])
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.Not):
+            return '%s(%s)' % ('~' if batch else 'not ',
+                               self.emit(node.operand, mode))
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return '-(%s)' % self.emit(node.operand, mode, name)
+        if isinstance(node, ast.BinOp) and type(node.op) in BINOPS:
+            return '(%s%s%s)' % (self.emit(node.left, mode),
+                BINOPS[type(node.op)], self.emit(node.right, mode))
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div):
+            return ('(%s / %s)' if mode == KEY else 'truediv(%s, %s)') % \
+                (self.emit(node.left, mode), self.emit(node.right, mode))
+        if isinstance(node, ast.Compare):
+            return self.emit_compare(node, mode)
+        if isinstance(node, ast.Name):
+            if node.id not in NAMES:
+                raise ValueError('unknown name %s, one of %s' % \
+                    (node.id, ', '.join(NAMES)))
+            self.names.add(node.id)
+            return node.id
+        if isinstance(node, ast.Num):
+            return repr(node.n)
+        if isinstance(node, ast.Str):
+            if name is None:
+                raise ValueError("no field to compare '%s' with" % node.s)
+            return repr(parse_constant(name, node.s))
+        raise ValueError('unsupported expression: %s' % \
+            type(node).__name__)
+
+    def emit_compare(self, node, mode):
+        batch = mode == BATCH
+        operands = [node.left] + node.comparators
+        # a name on either side gives string constants their meaning
+        names = [o.id for o in operands if isinstance(o, ast.Name)]
+        name = names[0] if names else None
+        terms = []
+        for left, op, right in zip(operands, node.ops, operands[1:]):
+            if type(op) not in CMPOPS:
+                raise ValueError('unsupported comparison: %s' % \
+                    type(op).__name__)
+            if isinstance(op, (ast.In, ast.NotIn)):
+                if not isinstance(right, (ast.Tuple, ast.List)):
+                    raise ValueError("'in' takes a list of constants")
+                values = [self.emit(v, mode, name) for v in right.elts]
+                if batch:
+                    terms.append('%s(isin(%s, [%s]))' % \
+                        ('~' if isinstance(op, ast.NotIn) else '',
+                         self.emit(left, mode), ', '.join(values)))
+                else:
+                    terms.append('%s%s(%s%s)' % (self.emit(left, mode),
+                        CMPOPS[type(op)], ', '.join(values),
+                        ',' if len(values) == 1 else ''))
+                continue
+            terms.append('%s%s%s' % (self.emit(left, mode, name),
+                CMPOPS[type(op)], self.emit(right, mode, name)))
+        if len(terms) == 1: return terms[0]
+        return (' & ' if batch else ' and ').join(['(%s)' % t for t in terms])
+
+    def mask(self, columns):
+        """Boolean numpy array of the rows of {name: array} that match"""
+        if self.batch_function is None:
+            import numpy
+            # HOWTO: & | ~ of numpy arrays bind tighter than comparisons,
+            # so every comparison is emitted in parentheses
+            self.batch_function = eval('lambda %s: %s' % \
+                (', '.join(self.names), self.batch),
+                {'isin': numpy.in1d, 'truediv': numpy.true_divide})
+            self.errstate = numpy.errstate(divide='ignore', invalid='ignore')
+        with self.errstate:
+            return self.batch_function(**columns)
+
+    # HOWTO: compiled functions do not pickle, mappers compile their own
+    def __getstate__(self):
+        return self.terms
+
+    def __setstate__(self, terms):
+        self.__init__(terms)
+
+    def may_match(self, lows, highs):
+        """False if no record within the field bounds can match"""
+        return all([self.bounded(tree, lows, highs) for tree in self.trees])
+
+    def bounded(self, node, lows, highs):
+        if isinstance(node, ast.BoolOp):
+            results = [self.bounded(value, lows, highs)
+                       for value in node.values]
+            return all(results) if isinstance(node.op, ast.And) \
+                else any(results)
+        if not isinstance(node, ast.Compare): return True
+        operands = [node.left] + node.comparators
+        for left, op, right in zip(operands, node.ops, operands[1:]):
+            if isinstance(right, ast.Name) and type(op) in FLIPPED:
+                left, right, op = right, left, FLIPPED[type(op)]()
+            if not isinstance(left, ast.Name) or left.id not in FIELDS:
+                continue
+            name = left.id
+            if isinstance(op, ast.In) and \
+               isinstance(right, (ast.Tuple, ast.List)):
+                values = [self.constant(v, name) for v in right.elts]
+                if None not in values and not any([lows[name] <= v <= \
+                    highs[name] for v in values]): return False
+                continue
+            value = self.constant(right, name)
+            if type(op) in BOUNDS and value is not None and \
+               not BOUNDS[type(op)](lows[name], highs[name], value):
+                return False
+        return True
+
+    def constant(self, node, name):
+        if isinstance(node, ast.Num): return node.n
+        if isinstance(node, ast.Str): return parse_constant(name, node.s)
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            value = self.constant(node.operand, name)
+            if value is not None: return -value
+        return None
+
+    def __str__(self):
+        return self.key
+
+class AnyPredicate:
+    """Predicates of queries sharing a scan, a block is read for all of
+    them if any of them may match"""
+
+    def __init__(self, predicates):
+        self.predicates = predicates
+
+    def may_match(self, lows, highs):
+        return any([p.may_match(lows, highs) for p in self.predicates])
+
+    def __str__(self):
+        return ' or '.join(['(%s)' % p.key for p in self.predicates])
+
+def scan_predicate(predicates):
+    """What zone maps test of a scan for all of `predicates`, None if one
+    of them is None, i.e. selects all records"""
+    if not predicates or None in predicates: return None
+    if len(predicates) == 1: return predicates[0]
+    return AnyPredicate(predicates)
+
+def query_key(where):
+    """StatDB key of results of --where expressions, None of a month"""
+    return Predicate(where).key if where else None
@@ -7,21 +7,30 @@ from __future__ import print_function
 
 import argparse
 import calendar
+import collections
 import copy
 import datetime
 import dateutil
+import dateutil.parser
 import fileinput
+import hashlib
+import json
 import os.path
 import re
 import sys
 import io
-from urllib.request import urlopen
+import tempfile
+import urllib2
 import multiprocessing
 
-import bytebuffer
 import botocore
 import boto3
 
+from common import get_file_name, get_index_name, get_marker, load_config
+from common import get_zonemap_name, RECORD_FORMATS, TimeIndex
+from formats import RECORD_WRITERS
+from zonemap import ZoneMap
+
 
 MIN_DATE = {
     'yellow': datetime.datetime(2009, 1, 1),
@@ -69,7 +78,8 @@ def parse_argv():
         help="data destination directory")
 
     parser.add_argument("--max-lines", metavar='NUM', type=int,
-        dest='max_lines', default=sys.maxint, help="maximum lines")
+        dest='max_lines', default=sys.maxint,
+        help="maximum records converted per month")
 
     parser.add_argument("--buf-size", metavar='NUM', type=int,
         dest='read_buf_size', default=16 * 1024 * 1024,
@@ -83,6 +93,82 @@ def parse_argv():
         dest='procs', default=1,
         help="number of parallel process")
 
+    parser.add_argument("--engine", metavar='line|vector', type=str,
+        dest='engine', default='line',
+        help="convert line by line or in vectorized chunks (numpy)")
+
+    parser.add_argument("--split", action='store_true',
+        dest='split', default=False,
+        help="convert months one by one, each split into line aligned "
+             "byte ranges across --procs processes")
+
+    parser.add_argument("--pipeline", action='store_true',
+        dest='pipeline', default=False,
+        help="convert months one by one, reading, converting on --procs "
+             "processes and uploading parts to s3:// concurrently")
+
+    parser.add_argument("--queue-depth", metavar='NUM', type=int,
+        dest='queue_depth', default=4,
+        help="chunks or parts queued between upload stages")
+
+    parser.add_argument("--part-size", metavar='NUM', type=int,
+        dest='part_size', default=8 * 1024 * 1024,
+        help="multipart upload part size in bytes, parts of an "
+             "interrupted upload to s3:// are not uploaded again")
+
+    parser.add_argument("--upload-threads", metavar='NUM', type=int,
+        dest='upload_threads', default=4,
+        help="concurrent part uploads to s3://")
+
+    parser.add_argument("--markers", action='store_true',
+        dest='markers', default=False,
+        help="write a month marker record before the records of each "
+             "month to stdout, for mapred.py --src -")
+
+    parser.add_argument("--download-segments", metavar='NUM', type=int,
+        dest='download_segments', default=0,
+        help="download http(s) sources to a local file first, over this "
+             "many concurrent range requests")
+
+    parser.add_argument("--geocode", action='store_true',
+        dest='geocode', default=False,
+        help="store the codes of pickup and dropoff districts in the "
+             "padding of records for mapred.py")
+
+    parser.add_argument("--format", metavar='plain|zblock|columnar',
+        type=str, dest='record_format', default='plain',
+        help="write records as they are, in blocks compressed by zlib or "
+             "in row groups of typed columns, the record_format of "
+             "mapred.py configuration")
+
+    parser.add_argument("--sort", action='store_true',
+        dest='sort', default=False,
+        help="sort the records of each month by pickup time, in memory "
+             "of about twice their size, and write an index of hour "
+             "offsets for mapred.py --from/--to")
+
+    parser.add_argument("--zonemap", action='store_true',
+        dest='zonemap', default=False,
+        help="write the minimum and maximum of fields of every block of "
+             "records, for mapred.py --where to skip blocks")
+
+    parser.add_argument("--ingest", action='store_true',
+        dest='ingest', default=False,
+        help="also compute the statistics of mapred.py while converting "
+             "on --procs processes and append them to StatDB")
+
+    parser.add_argument("--config", type=str,
+        dest='config', default='config.ini',
+        help="configuration file of --ingest")
+
+    parser.add_argument("--debug", action='store_true',
+        dest='debug', default=False,
+        help="use the debug profile of the configuration file")
+
+    parser.add_argument("--force", action='store_true',
+        dest='force', default=False,
+        help="convert months again even if their manifest is up to date")
+
     parser.add_argument("--cross-account", action='store_true',
         dest='cross_account', default=False,
         help="enable cross-account copy")
@@ -103,7 +189,32 @@ def parse_argv():
              MAX_DATE[args.color].strftime('%Y-%m'),
              args.color))
 
+    if args.split and args.src == '-':
+        fatal('--split needs a file:// or http:// source')
+    if args.pipeline and not args.dst.startswith('s3://'):
+        fatal('--pipeline needs a s3:// destination')
+    if args.pipeline and args.split:
+        fatal('--pipeline and --split are exclusive')
+    if args.record_format not in RECORD_FORMATS:
+        fatal('unknown format: %s' % args.record_format)
+    if args.record_format != 'plain' and (args.pipeline or args.dst == '-'):
+        fatal('--format %s needs a file:// or s3:// destination without '
+              '--pipeline' % args.record_format)
+    if args.zonemap and args.dst == '-':
+        fatal('--zonemap needs a file:// or s3:// destination')
+    if args.pipeline and args.sort:
+        fatal('--pipeline and --sort are exclusive')
+    if args.markers and args.dst != '-':
+        fatal('--markers needs the - destination')
+    if args.part_size < 5 * 1024 * 1024:
+        fatal('--part-size must be at least 5 MiB') # S3 minimum
+
     args.tagging = eval(args.tagging.capitalize())
+    if args.ingest:
+        # the record_format of the configuration is that mapred.py reads
+        record_format = args.record_format
+        load_config(args, args.config, args.debug)
+        args.record_format = record_format
 
     return args
 
@@ -120,6 +231,66 @@ def get_date_range(start, end):
         yield current
         current = add_months(current, 1)
 
+class RingBuffer:
+    """Circular byte buffer backed by a bytearray and its memoryview
+
+    `write` copies data in once and `readinto` copies it out once; either
+    may wrap around the end of the array. A write that does not fit grows
+    the buffer to twice its capacity, or more, keeping the buffered data.
+    `copied` counts bytes copied, growth included.
+    """
+
+    def __init__(self, capacity):
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.head = 0   # offset of the first buffered byte
+        self.size = 0   # buffered bytes
+        self.copied = 0
+
+    def __len__(self):
+        return self.size
+
+    def capacity(self):
+        return len(self.buf)
+
+    def grow(self, capacity):
+        buf = bytearray(capacity)
+        size = self.readinto(buf)
+        self.buf, self.view, self.head, self.size = \
+            buf, memoryview(buf), 0, size
+
+    def write(self, data):
+        n = len(data)
+        if self.size + n > len(self.buf):
+            self.grow(max(2 * len(self.buf), self.size + n))
+        tail = (self.head + self.size) % len(self.buf)
+        if tail + n <= len(self.buf):
+            self.view[tail:tail + n] = data
+        else:
+            data = memoryview(data)
+            first = len(self.buf) - tail
+            self.view[tail:] = data[:first]
+            self.view[:n - first] = data[first:]
+        self.size += n
+        self.copied += n
+
+    def readinto(self, b):
+        b = memoryview(b)
+        n = min(len(b), self.size)
+        first = min(n, len(self.buf) - self.head)
+        b[:first] = self.view[self.head:self.head + first]
+        b[first:n] = self.view[:n - first]
+        self.head = (self.head + n) % len(self.buf)
+        self.size -= n
+        self.copied += n
+        return n
+
+    def read(self, size=-1):
+        if size < 0 or size > self.size: size = self.size
+        b = bytearray(size)
+        self.readinto(b)
+        return b
+
 class RawReader(io.IOBase):
     """A file-like raw HTTP data reader and pre-processor
     """
@@ -127,6 +298,7 @@ class RawReader(io.IOBase):
     START_DATE = datetime.datetime(2009,1,1)
     MAX_RECORD_LENGTH = 80
     DEFAULT_BUFFER_SIZE = 16 * 1024 * 1024 # 16MB
+    CHUNK_SIZE = 4 * 1024 * 1024 # raw bytes per vectorized conversion
 
     def __init__(self):
         self.data = None
@@ -134,20 +306,84 @@ class RawReader(io.IOBase):
         self.year = 2016
         self.month = 1
         self.buf = None
-        self.read_lines = 0
+        self.converted = 0      # records converted, at most max_lines
         self.max_lines = sys.maxint
+        self.dates = {}     # 'YYYY-MM-DD' -> seconds since START_DATE
+        self.times = {}     # ' HH:MM:SS' -> seconds since midnight
+        self.converter = None   # VectorConverter of vector engine
+        self.coder = None       # NYCDistrictCode of --geocode
+        self.blocks = None      # converted records of chunks or ranges
+        self.index = None       # TimeIndex of sorted records
+        self.pool = None        # processes of split mode
+        self.ranges = []
+        self.download_path = None
 
     def alloc_buf(self, size=None):
         if size is None: size = self.DEFAULT_BUFFER_SIZE
-        self.buf = bytebuffer.ByteBuffer.allocate(size)
-        self.buf.clear()
-        self.buf.flip()
+        self.buf = RingBuffer(size)
+
+    @classmethod
+    def columns(cls, color, year, month):
+        """Column names of a raw record, in the order reformat unpacks them"""
+        if color == 'green':
+            columns = ['vendor_id', 'pickup_datetime', 'dropoff_datetime',
+                'store_and_fwd_flag', 'rate_code', 'pickup_longitude',
+                'pickup_latitude', 'dropoff_longitude', 'dropoff_latitude',
+                'passenger_count', 'trip_distance', 'fare_amount', 'extra',
+                'mta_tax', 'tip_amount', 'tolls_amount', 'ehail_fee']
+            if year < 2015:
+                return columns + ['total_amount', 'payment_type',
+                    'trip_type', '', '']
+            elif year == 2015 and month < 7:
+                return columns + ['surcharge', 'total_amount',
+                    'payment_type', 'trip_type', '', '']
+            return columns + ['surcharge', 'total_amount', 'payment_type',
+                'trip_type']
+        elif color == 'yellow':
+            columns = ['vendor_id', 'pickup_datetime', 'dropoff_datetime',
+                'passenger_count', 'trip_distance', 'pickup_longitude',
+                'pickup_latitude', 'rate_code', 'store_and_fwd_flag',
+                'dropoff_longitude', 'dropoff_latitude', 'payment_type',
+                'fare_amount', 'extra', 'mta_tax', 'tip_amount',
+                'tolls_amount']
+            if year < 2015: return columns + ['total_amount']
+            return columns + ['surcharge', 'total_amount']
+
+    def delta_seconds(self, time):
+        """Seconds since START_DATE of a timestamp
+
+        TLC timestamps are 'YYYY-MM-DD HH:MM:SS', so the date and the time
+        of day are memoized separately and a conversion is two dictionary
+        lookups. Only validated parts are memoized, anything else goes to
+        the general-purpose dateutil parser.
+        """
+        try:
+            return self.dates[time[:10]] + self.times[time[10:]]
+        except KeyError:
+            pass
+
+        date, clock = time[:10], time[10:]
+        if len(date) == 10 and date[4] == '-' and date[7] == '-' and \
+           len(clock) == 9 and clock[0] == ' ' and \
+           clock[3] == ':' and clock[6] == ':':
+            year, month, day = date[:4], date[5:7], date[8:]
+            hour, minute, second = clock[1:3], clock[4:6], clock[7:]
+            if (year + month + day + hour + minute + second).isdigit() and \
+               int(hour) < 24 and int(minute) < 60 and int(second) < 60:
+                try:
+                    delta = datetime.datetime(
+                        int(year), int(month), int(day)) - self.START_DATE
+                    self.dates[date] = delta.days * 86400 + delta.seconds
+                    self.times[clock] = \
+                        int(hour) * 3600 + int(minute) * 60 + int(second)
+                    return self.dates[date] + self.times[clock]
+                except ValueError:
+                    pass    # not a valid date, let dateutil decide
+
+        delta = dateutil.parser.parse(time) - self.START_DATE
+        return int(delta.total_seconds())
 
     def reformat(self, line):
-        def delta_seconds(time):
-            delta = dateutil.parser.parse(time) - self.START_DATE
-            return int(delta.total_seconds())
-
         line = line.strip()
 
         pickup_datetime = None
@@ -203,8 +439,8 @@ class RawReader(io.IOBase):
                dropoff_longitude == '0' or dropoff_latitude == '0':
                return None
 
-            pickup_datetime = "%d" % delta_seconds(pickup_datetime)
-            dropoff_datetime = "%d" % delta_seconds(dropoff_datetime)
+            pickup_datetime = "%d" % self.delta_seconds(pickup_datetime)
+            dropoff_datetime = "%d" % self.delta_seconds(dropoff_datetime)
             pickup_longitude = "%.6f" % float(pickup_longitude)
             pickup_latitude = "%.6f" % float(pickup_latitude)
             dropoff_longitude = "%.6f" % float(dropoff_longitude)
@@ -212,7 +448,7 @@ class RawReader(io.IOBase):
             trip_distance = "%.2f" % float(trip_distance)
             fare_amount = "%.2f" % float(fare_amount)
 
-        except :
+        except Exception as e:
             warning("%s-%s-%02d: %s: d%s d%s f%s f%s f%s f%s f%s f%s" % \
                 (self.color, self.year, self.month, e,
                  pickup_datetime, dropoff_datetime,
@@ -232,14 +468,34 @@ class RawReader(io.IOBase):
             return None
         else:
             # make each record same length for offset seek
-            return line.ljust(self.MAX_RECORD_LENGTH - 1, '*') + '\n'
+            line = line.ljust(self.MAX_RECORD_LENGTH - 1, '*') + '\n'
+            if self.coder: line = self.coder.tag(line)
+            return line
 
-    def open(self, color, year, month, source, max_lines, buf_size):
+    def open(self, color, year, month, source, max_lines, buf_size,
+             engine='line', procs=1, segments=0, geocode=False, sort=False):
         self.color = color
         self.year = year
         self.month = month
         self.max_lines = max_lines
-        self.alloc_buf(min(buf_size, self.MAX_RECORD_LENGTH * max_lines))
+        self.converted = 0
+        self.engine = engine
+        self.geocode = geocode
+        self.alloc_buf(max(min(buf_size, self.MAX_RECORD_LENGTH * max_lines),
+                           self.MAX_RECORD_LENGTH))
+
+        if not geocode:
+            self.coder = None
+        elif self.coder is None:
+            # shapely is only required by --geocode
+            from geo import NYCDistrictCode
+            self.coder = NYCDistrictCode()
+
+        self.converter, self.blocks, self.index = None, None, None
+        if engine == 'vector':
+            # numpy is only required by the vector engine
+            from converter import VectorConverter
+            self.converter = VectorConverter(self)
 
         if source.startswith('http://') or source.startswith('https://'):
             filename = '%s/%s_tripdata_%s-%02d.csv' % \
@@ -252,7 +508,10 @@ class RawReader(io.IOBase):
             # self.data = obj.get()["Body"].read()
             # for line in self.data.split('\n'):
             #    print(line)
-            self.data = urlopen(filename)
+            if procs > 1 or segments > 0: # convert a local copy
+                self.data = open(self.download(filename, segments), 'r')
+            else:
+                self.data = urllib2.urlopen(filename)
         elif source.startswith('file://'):
             directory = os.path.realpath(source[7:])
             if not os.path.isdir(directory):
@@ -272,47 +531,183 @@ class RawReader(io.IOBase):
         # skip header and empty line
         self.data.readline(); self.data.readline()
 
+        if procs > 1: self.split(procs)
+        if self.converter or self.pool:
+            self.blocks = self.readblocks()
+        if sort: self.sort()
         return self
 
+    def sort(self):
+        """Convert the whole month, then read records by pickup time"""
+        # HOWTO: records are gathered in place, not through the ring buffer
+        data = bytearray()
+        for records in self.blocks or self.readlines(): data += records
+        records, self.index = TimeIndex.sort(self.color, self.year,
+                                             self.month, data)
+        del data
+        info(' sort: %d records' % self.index.records)
+        n = self.CHUNK_SIZE // self.MAX_RECORD_LENGTH
+        self.blocks = (records[i:i + n].tostring()
+                       for i in xrange(0, len(records), n))
+
+    @staticmethod
+    def stat(color, year, month, source):
+        """Identity of a raw source: uri, size and ETag or mtime"""
+        if source.startswith('http://') or source.startswith('https://'):
+            uri = '%s/%s_tripdata_%s-%02d.csv' % \
+                (source.strip('/'), color, year, month)
+            request = urllib2.Request(uri)
+            request.get_method = lambda: 'HEAD'
+            headers = urllib2.urlopen(request).info()
+            return {'uri': uri, 'size': int(headers.get('Content-Length', -1)),
+                    'etag': headers.get('ETag')}
+        elif source.startswith('file://'):
+            path = '%s/%s_tripdata_%s-%02d.csv' % \
+                (os.path.realpath(source[7:]), color, year, month)
+            if not os.path.isfile(path): return None
+            st = os.stat(path)
+            return {'uri': 'file://' + path, 'size': st.st_size,
+                    'mtime': int(st.st_mtime)}
+        return None # stdin
+
+    def download(self, url, segments):
+        f = tempfile.NamedTemporaryFile(prefix='raw2aws-', suffix='.csv',
+                                        delete=False)
+        f.close()
+        info(" download: %s => %s" % (url, f.name))
+        from download import SegmentedDownloader
+        d = SegmentedDownloader(max(segments, 1))
+        try:
+            d.download(url, f.name)
+        except:
+            # a temporary name is never downloaded again to resume
+            d.clean(f.name)
+            os.remove(f.name)
+            raise
+        self.download_path = f.name
+        return f.name
+
+    def split(self, procs):
+        """Cut the rest of the file into line aligned byte ranges"""
+        self.ranges = []
+        start, size = self.data.tell(), os.fstat(self.data.fileno()).st_size
+        while start < size:
+            self.data.seek(min(start + self.CHUNK_SIZE, size) - 1)
+            self.data.readline() # HOWTO: ranges end after a newline
+            end = self.data.tell()
+            self.ranges.append((self.color, self.year, self.month,
+                self.data.name, start, end, self.engine, self.geocode))
+            start = end
+        self.pool = multiprocessing.Pool(processes=procs)
+
+    def capped(self, records):
+        """Converted records up to max_lines records of the month
+
+        Every path of converted records goes through here, so max_lines
+        caps records whatever the engine, split mode and destination.
+        """
+        room = max(self.max_lines - self.converted, 0)
+        if len(records) > room * self.MAX_RECORD_LENGTH:
+            records = records[:room * self.MAX_RECORD_LENGTH]
+        self.converted += len(records) // self.MAX_RECORD_LENGTH
+        return records
+
+    def full(self):
+        return self.converted >= self.max_lines
+
+    def read_chunk(self, size):
+        """Read whole raw lines of about `size` bytes"""
+        if hasattr(self.data, 'read'):
+            chunk = self.data.read(size)
+            if chunk and not chunk.endswith('\n'):
+                chunk += self.data.readline()   # complete the last line
+        else:
+            lines, n = [], 0
+            while n < size:
+                line = self.data.readline()
+                if not line: break
+                lines.append(line)
+                n += len(line)
+            chunk = ''.join(lines)
+        return chunk
+
+    def readblocks(self):
+        """Yield records of raw chunks converted by the vector engine, or
+        of byte ranges converted by the processes of split mode"""
+        if self.pool:
+            for block in self.readranges(): yield block
+            return
+        while not self.full():
+            chunk = self.read_chunk(self.CHUNK_SIZE)
+            if not chunk: break
+            records = self.converter.convert(chunk)
+            if self.coder: records = self.coder.tag_records(records)
+            yield self.capped(records)
+
+    def task(self, chunk):
+        """Arguments of convert_chunk to convert raw lines elsewhere"""
+        return (self.color, self.year, self.month, chunk, self.engine,
+                self.geocode)
+
+    def readranges(self):
+        # keep a few ranges in flight, results are yielded in file order
+        ranges = iter(self.ranges)
+        pending = collections.deque()
+        while not self.full():
+            while len(pending) < 2 * self.pool._processes:
+                args = next(ranges, None)
+                if args is None: break
+                pending.append(self.pool.apply_async(convert_range, (args,)))
+            if not pending: break
+            yield self.capped(pending.popleft().get())
+
     def close(self):
         self.data.close()
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+        if self.download_path:
+            os.remove(self.download_path)
+            self.download_path = None
+
+    def fill(self, size=None):
+        """Buffer converted records up to `size` bytes, or until EOF"""
+        while size is None or len(self.buf) < size:
+            if self.blocks:
+                block = next(self.blocks, None)
+                if block is None: break # EOF
+                self.buf.write(block)
+                continue
+            if self.full(): break
+            line = self.data.readline()
+            if not line: break # EOF
+            line = self.reformat(line)
+            if line: self.buf.write(self.capped(line))
 
-    def read(self, size=None):
-        if size < 0: size = None # in case size = -1
-        if size > self.buf.get_capacity():
-            #TODO: risk of data loss if 2nd request size > 1st request size
-            self.alloc_buf(size * 2)
-
-        # HOWTO: http://tutorials.jenkov.com/java-nio/buffers.html
-        if self.buf.get_remaining() >= size:
-            return self.buf.get_bytes(size)
-        else: # not enough data, fill buffer
-            self.buf.compact()
-            while self.buf.get_remaining() >= self.MAX_RECORD_LENGTH:
-                line = self.data.readline()
-                self.read_lines += 1
-                if self.read_lines > self.max_lines: line = None
-                if not line: break # EOF
-                line = self.reformat(line)
-                if line: self.buf.put(bytearray(line))
-            self.buf.flip()
-            remaining = self.buf.get_remaining()
-            if remaining == 0: return bytearray()
-            if remaining < size: return self.buf.get_bytes()
-            return self.buf.get_bytes(size)
+    def read(self, size=-1):
+        if size is None or size < 0: size = None # in case size = -1
+        if size is None or len(self.buf) < size: self.fill(size)
+        return self.buf.read(-1 if size is None else size)
+
+    def readinto(self, b):
+        size = len(memoryview(b))
+        if len(self.buf) < size: self.fill(size)
+        return self.buf.readinto(b)
 
     def readline(self):
+        if self.full(): return ''
         line = self.data.readline()
         if not line: return ''
         line = self.reformat(line)
-        if line: return line
+        if line: return self.capped(line)
 
     def readlines(self):
-        while True:
+        while not self.full():
             line = self.data.readline()
             if not line: break
             line = self.reformat(line)
-            if line: yield line
+            if line: yield self.capped(line)
 
     def istty(self): return False
 
@@ -330,6 +725,30 @@ class RawReader(io.IOBase):
 
     def tell(self): raise io.UnsupportOperation # TODO
 
+class Checksum(object):
+    """Size and MD5 of the bytes passing through a file, also written to
+    `sinks` such as the StreamMapper of --ingest"""
+
+    def __init__(self, fobj=None, sinks=()):
+        self.fobj = fobj
+        self.sinks = sinks
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def update(self, data):
+        self.md5.update(data)
+        self.size += len(data)
+        for sink in self.sinks: sink.write(data)
+
+    def read(self, size=-1):
+        data = self.fobj.read(size)
+        self.update(data)
+        return data
+
+    def write(self, data):
+        self.update(data)
+        self.fobj.write(data)
+
 class Raw2AWS:
     def __init__(self, opts):
         self.opts = opts
@@ -337,8 +756,13 @@ class Raw2AWS:
         self.s3 = boto3.resource('s3')
         self.client = boto3.client('s3')
         self.reader = RawReader()
+        self.sinks = []
+        self.mapper = None  # StreamMapper of --ingest
+        self.statdb = None
 
     def output(self, fin, date):
+        """Write the records of a month, return checksums of the records
+        and of the bytes stored"""
         if self.opts.dst.startswith('file://'):
             path = os.path.realpath(self.opts.dst[7:])
 
@@ -347,13 +771,10 @@ class Raw2AWS:
             if not os.path.isdir(path):
                 fatal("%s is not a directory." % path)
 
-            filename = os.path.join(path, \
-                '%s-%s-%02d.csv' % (self.opts.color, date.year, date.month))
+            filename = os.path.join(path, self.get_key(date))
             info('write: file://%s' % filename)
             with open(filename, 'w') as fout:
-                for i, line in enumerate(fin.readlines()):
-                    if i >= self.opts.max_lines: break
-                    fout.write(line)
+                return self.write_stored(fin, fout)
 
         elif self.opts.dst.startswith('s3://'):
             bucket = self.s3.Bucket(self.opts.dst[5:])
@@ -368,18 +789,49 @@ class Raw2AWS:
                 if error_code == 404:
                     fatal("%s does not exists" % self.opts.dst)
 
-            key = '%s-%s-%02d.csv' % (self.opts.color, date.year, date.month)
-            obj = bucket.Object(key)
-            args, config = None, None
+            key = self.get_key(date)
+            checksum = stored = Checksum(None, self.sinks)
+            args = None
             try:
                 if self.opts.cross_account:
                     # HOWTO: cross-account copy
-                    # need both acl and multipart upload threshold
+                    # need acl on the object and on its multipart upload
                     # https://github.com/aws/aws-cli/issues/1674
-                    config = boto3.s3.transfer.TransferConfig(
-                        multipart_threshold=4 * (1024 ** 3))
                     args = {'ACL': 'bucket-owner-full-control'}
-                obj.upload_fileobj(fin, ExtraArgs=args, Config=config)
+                # both uploads resume an unfinished multipart upload of key
+                if self.opts.pipeline:
+                    from pipeline import UploadPipeline
+                    upload = UploadPipeline(fin, convert_chunk,
+                                            self.opts.procs,
+                                            self.opts.queue_depth,
+                                            self.opts.part_size,
+                                            self.opts.upload_threads,
+                                            checksum).upload(
+                        self.client, bucket.name, key, args)
+                elif self.opts.record_format in RECORD_WRITERS:
+                    from pipeline import MultipartUpload
+                    # HOWTO: blocks and their footer are written to a
+                    # temporary file first, the footer comes last
+                    with tempfile.TemporaryFile(prefix='raw2aws-') as spool:
+                        checksum, stored = self.write_stored(fin, spool)
+                        spool.seek(0)
+                        parts = iter(lambda: spool.read(self.opts.part_size),
+                                     '')
+                        upload = MultipartUpload(self.opts.part_size,
+                                                 self.opts.upload_threads,
+                                                 self.opts.queue_depth)
+                        upload.upload(self.client, bucket.name, key, parts,
+                                      args)
+                else:
+                    from pipeline import MultipartUpload
+                    upload = MultipartUpload(self.opts.part_size,
+                                             self.opts.upload_threads,
+                                             self.opts.queue_depth, checksum)
+                    # HOWTO: fin caps records at max_lines, see
+                    # RawReader.capped
+                    upload.upload(self.client, bucket.name, key,
+                                  fin.blocks or fin.readlines(), args)
+                for line in upload.report(): info(line)
             except botocore.exceptions.ClientError as e:
                 error_code = int(e.response['Error']['Code'])
                 fatal("%s" % error_code)
@@ -394,12 +846,36 @@ class Raw2AWS:
                         {'Key': 'year',  'Value': str(date.year) },
                         {'Key': 'month', 'Value': str(date.month) }
                     ]})
+            return checksum, stored
 
         elif self.opts.dst == '-':
-            for i, line in enumerate(fin.readlines()):
-                if i >= self.opts.max_lines: break
-                sys.stdout.write(line)
+            if self.opts.markers:
+                sys.stdout.write(get_marker(self.opts.color,
+                                            date.year, date.month))
+            checksum = Checksum(sys.stdout, self.sinks)
+            self.write_records(fin, checksum)
             sys.stdout.flush()
+            return checksum, checksum
+
+    def write_stored(self, fin, fout):
+        """Write the records of fin to fout in --record-format, return
+        checksums of the records and of the bytes stored"""
+        writer = RECORD_WRITERS.get(self.opts.record_format)
+        if writer is None:
+            checksum = Checksum(fout, self.sinks)
+            self.write_records(fin, checksum)
+            return checksum, checksum
+        stored = Checksum(fout)
+        fout = writer(stored)
+        checksum = Checksum(fout, self.sinks)
+        self.write_records(fin, checksum)
+        fout.close()
+        return checksum, stored
+
+    def write_records(self, fin, fout):
+        # HOWTO: fin caps records at max_lines, see RawReader.capped
+        for records in fin.blocks or fin.readlines():
+            fout.write(records)
 
     def run(self):
         try:
@@ -407,12 +883,159 @@ class Raw2AWS:
                 self.run_date(date)
         except KeyboardInterrupt as e:
             return
+        finally:
+            if self.mapper: self.mapper.close()
+
+    def start_ingest(self, date):
+        if self.mapper is None:
+            # mapred (shapely) is only required by --ingest
+            from mapred import StatDB, StreamMapper
+            opts = copy.copy(self.opts)
+            opts.year, opts.month = date.year, date.month
+            opts.nprocs = self.opts.procs
+            opts.queries = [[]]     # the whole month
+            self.statdb = StatDB(opts)
+            self.mapper = StreamMapper(opts, self.opts.procs)
+        self.mapper.start(self.opts.color, date.year, date.month)
+        self.sinks.append(self.mapper)
+
+    def get_key(self, date):
+        return get_file_name(self.opts.color, date.year, date.month,
+                             self.opts.record_format)
+
+    def load_manifest(self, key):
+        """Manifest of an output, None if missing or its output is gone"""
+        try:
+            if self.opts.dst.startswith('file://'):
+                path = os.path.join(os.path.realpath(self.opts.dst[7:]), key)
+                with open(path + '.manifest', 'r') as f:
+                    manifest = json.load(f)
+                size = os.path.getsize(path)
+            else:
+                bucket = self.opts.dst[5:]
+                obj = self.client.get_object(Bucket=bucket,
+                                             Key=key + '.manifest')
+                manifest = json.loads(obj['Body'].read())
+                size = self.client.head_object(Bucket=bucket,
+                                               Key=key)['ContentLength']
+        except (IOError, OSError, ValueError,
+                botocore.exceptions.ClientError):
+            return None
+        return manifest if manifest.get('size') == size else None
+
+    def save_sidecar(self, key, body):
+        """Write a time index or zone map next to the records"""
+        if self.opts.dst.startswith('file://'):
+            path = os.path.join(os.path.realpath(self.opts.dst[7:]), key)
+            with open(path + '.tmp', 'w') as f:
+                f.write(body)
+            os.rename(path + '.tmp', path)
+        else:
+            self.client.put_object(Bucket=self.opts.dst[5:], Key=key,
+                                   Body=body)
+
+    def save_manifest(self, key, manifest):
+        body = json.dumps(manifest, indent=2, sort_keys=True)
+        if self.opts.dst.startswith('file://'):
+            path = os.path.join(os.path.realpath(self.opts.dst[7:]),
+                                key + '.manifest')
+            # HOWTO: write to a temporary file then rename for atomic update
+            with open(path + '.tmp', 'w') as f:
+                f.write(body)
+            os.rename(path + '.tmp', path)
+        else:
+            self.client.put_object(Bucket=self.opts.dst[5:],
+                                   Key=key + '.manifest', Body=body)
 
     def run_date(self, date):
+        key = self.get_key(date)
+        source = RawReader.stat(self.opts.color, date.year, date.month,
+                                self.opts.src)
+        # a manifest records a complete output of an identified source
+        manifests = source is not None and self.opts.dst != '-'
+        manifest = self.load_manifest(key) if manifests else None
+        # StatDB adds what --ingest appends, so a month of a source is
+        # ingested once, as its manifest records, unless --force
+        ingested = bool(manifest and manifest['source'] == source and
+                        manifest.get('ingested', False))
+        ingest = self.opts.ingest and (self.opts.force or not ingested)
+        if self.opts.ingest and not ingest:
+            info('skip: %s is ingested already' % key)
+        if manifest and not self.opts.force and not ingest:
+            if manifest['source'] == source and \
+               manifest['max_lines'] == self.opts.max_lines and \
+               manifest.get('geocode', False) == self.opts.geocode and \
+               manifest.get('sort', False) == self.opts.sort and \
+               manifest.get('zonemap', False) == self.opts.zonemap:
+                info('skip: %s is up to date' % key)
+                return
+
+        self.sinks = []
+        if ingest: self.start_ingest(date)
+        zonemap = ZoneMap() if self.opts.zonemap else None
+        if zonemap: self.sinks.append(zonemap)
         with self.reader.open(self.opts.color, date.year, date.month,
                               self.opts.src, self.opts.max_lines,
-                              self.opts.read_buf_size) as fin:
-            self.output(fin, date)
+                              self.opts.read_buf_size,
+                              self.opts.engine,
+                              self.opts.procs if self.opts.split else 1,
+                              self.opts.download_segments,
+                              self.opts.geocode, self.opts.sort) as fin:
+            checksum, stored = self.output(fin, date)
+            index = fin.index
+        # sidecars are saved before the manifest that vouches for them
+        if index and self.opts.dst != '-':
+            self.save_sidecar(get_index_name(self.opts.color, date.year,
+                                             date.month), index.encode())
+        if zonemap:
+            self.save_sidecar(get_zonemap_name(self.opts.color, date.year,
+                date.month), zonemap.finish().encode())
+        # StatDB is appended before the manifest that records it
+        if ingest: self.statdb.append(self.mapper.finish())
+
+        if manifests:
+            self.save_manifest(key, {
+                'source': source,
+                'max_lines': self.opts.max_lines,
+                'geocode': self.opts.geocode,
+                'sort': self.opts.sort,
+                'zonemap': self.opts.zonemap,
+                'ingested': ingest or ingested,
+                'format': self.opts.record_format,
+                'records': checksum.size // RawReader.MAX_RECORD_LENGTH,
+                'size': stored.size,
+                'md5': stored.md5.hexdigest(),
+                'created': datetime.datetime.utcnow().isoformat()
+            })
+
+def convert_range(args):
+    """Convert the raw lines of a byte range of a local file (split mode)"""
+    color, year, month, path, start, end, engine, geocode = args
+    with open(path, 'r') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    return convert_chunk((color, year, month, chunk, engine, geocode))
+
+district_code = None    # NYCDistrictCode of a pool process, loaded once
+
+def convert_chunk(args):
+    """Convert whole raw lines in a pool process"""
+    global district_code
+    color, year, month, chunk, engine, geocode = args
+    reader = RawReader()
+    reader.color, reader.year, reader.month = color, year, month
+    if geocode:
+        if district_code is None:
+            from geo import NYCDistrictCode
+            district_code = NYCDistrictCode()
+        reader.coder = district_code
+    if engine == 'vector':
+        from converter import VectorConverter
+        records = VectorConverter(reader).convert(chunk)
+        if reader.coder: records = reader.coder.tag_records(records)
+        return records
+    return ''.join(filter(None, [reader.reformat(line)
+                                 for line in io.BytesIO(chunk)]))
 
 def start_process(args):
     r = Raw2AWS(args)
@@ -420,6 +1043,13 @@ def start_process(args):
 
 def main():
     args = parse_argv()
+    if args.split or args.pipeline: # one month at a time on all processes
+        return start_process(args)
+    if args.dst == '-': # months must not interleave on stdout
+        return start_process(args)
+    if args.ingest: # the mappers of a month are child processes
+        return start_process(args)
+
     tasks = []
 
     for date in get_date_range(args.start, args.end):
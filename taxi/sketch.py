@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Quantile Sketches: Percentiles of Fare, Distance and Trip Time
+#
+# A sketch counts values in buckets of logarithmic width, as DDSketch does:
+# bucket k >= 1 holds values in [low * gamma^(k-1), low * gamma^k), with
+# gamma = (1 + a) / (1 - a), and stands for the value of relative error at
+# most `a` to all of its values. So a quantile of any number of records is
+# known within `a`, e.g. the median fare within 1%, from bucket counts alone.
+# Bounds of buckets are computed once, so a value is bucketed by bisection,
+# without a logarithm per record.
+#
+# Bucket counts are plain counters: sketches merge by adding them, as
+# TaxiStat histograms do, and StatDB adds them to items the same way. The
+# range of values is fixed, values below are counted in bucket 0 and above
+# in the last one, so a sketch never has more than `size` buckets however
+# many records it counts.
+
+from __future__ import print_function
+
+import bisect
+import math
+
+__all__ = ['QUANTILES', 'LogSketch', 'DISTANCE_SKETCH', 'FARE_SKETCH',
+           'TRIP_TIME_SKETCH']
+
+ALPHA = 0.01                        # relative error of quantiles
+QUANTILES = [0.5, 0.9, 0.95, 0.99]  # quantiles reported
+
+class LogSketch:
+    """Buckets of counters of values in [low, high], within `alpha`
+
+    A sketch is a Counter of bucket => count, this class only maps values
+    to buckets and buckets to values.
+    """
+
+    def __init__(self, low, high, alpha=ALPHA):
+        self.low, self.high = low, high
+        self.gamma = (1 + alpha) / (1 - alpha)
+        n = int(math.ceil(math.log(float(high) / low) / math.log(self.gamma)))
+        # lower bounds of buckets 1..n, values below `low` are in bucket 0
+        self.bounds = [low * self.gamma ** k for k in range(n + 1)]
+        self.size = len(self.bounds) + 1
+
+    def bucket(self, value):
+        return bisect.bisect_right(self.bounds, value)
+
+    def value(self, bucket):
+        """Value of a bucket, of relative error alpha to the values in it"""
+        if bucket <= 0: return 0.0
+        return 2 * self.bounds[bucket - 1] * self.gamma / (self.gamma + 1)
+
+    def count(self, sketch, values):
+        bounds, bisect_right = self.bounds, bisect.bisect_right
+        for value in values: sketch[bisect_right(bounds, value)] += 1
+
+    def quantile(self, sketch, q):
+        """Value of quantile q of a sketch, None if it counted nothing"""
+        rank = q * (sum(sketch.values()) - 1)
+        seen = 0
+        for bucket in sorted(sketch):
+            seen += sketch[bucket]
+            if seen > rank: return self.value(bucket)
+        return None
+
+    def quantiles(self, sketch, qs=QUANTILES):
+        return [self.quantile(sketch, q) for q in qs]
+
+# HOWTO: ranges bound sketches to some 600 buckets each, of records much
+# sparser in practice
+FARE_SKETCH = LogSketch(0.01, 10000.0)      # dollars
+DISTANCE_SKETCH = LogSketch(0.01, 1000.0)   # miles
+TRIP_TIME_SKETCH = LogSketch(1, 86400)      # seconds
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Deterministic Synthetic Trips for Benchmarks
+
+from __future__ import print_function
+
+import calendar
+import datetime
+import os.path
+import random
+
+from common import *
+from formats import RECORD_WRITERS
+from raw2aws import RawReader
+
+__all__ = ['TripGenerator']
+
+def parse_argv():
+    o = Options()
+    o.add('--format', metavar='raw|records|zblock|columnar', type=str,
+        default='records',
+        help="raw TLC, converted, block-compressed or columnar records")
+    o.add('-n', '--records', metavar='NUM', type=int,
+        default=100000, help="number of trips")
+    o.add('--seed', metavar='NUM', type=int,
+        default=0, help="random seed")
+    o.add('--dst', metavar='DIR', type=str,
+        default='.', help="output directory")
+    return o.load()
+
+class TripGenerator:
+    """Random but reproducible trips shaped like NYC TLC data
+
+    The same (color, year, month, seed) always yields the same trips, as
+    raw TLC lines in the layout RawReader.reformat expects for that month
+    or as the fixed-length records it converts them to.
+    """
+
+    # (longitude, latitude, weight) of pickup hot spots
+    HOT_SPOTS = [
+        (-73.985, 40.758, 0.55),    # Midtown Manhattan
+        (-73.990, 40.725, 0.15),    # Lower Manhattan
+        (-73.950, 40.690, 0.10),    # Brooklyn
+        (-73.870, 40.770, 0.10),    # LaGuardia, Queens
+        (-73.900, 40.840, 0.05),    # Bronx
+        (-73.780, 40.645, 0.05),    # JFK, Queens
+    ]
+    ZERO_RATE = 0.01        # trips with zero coordinates, dropped by raw2aws
+    OUTLIER_RATE = 0.01     # trips outside of NYC, invalid for mapper
+
+    def __init__(self, color='green', year=2016, month=1, seed=0):
+        self.color = color
+        self.year = year
+        self.month = month
+        self.seed = seed
+        self.columns = RawReader.columns(color, year, month)
+        self.start = datetime.datetime(year, month, 1)
+        self.seconds = calendar.monthrange(year, month)[1] * 86400
+
+    def point(self, rand):
+        x = rand.random()
+        for longitude, latitude, weight in self.HOT_SPOTS:
+            x -= weight
+            if x < 0: break
+        return longitude + rand.gauss(0, 0.02), latitude + rand.gauss(0, 0.015)
+
+    def coordinate(self, rand, value):
+        # mix the short and long float notations seen in TLC data
+        if rand.random() < 0.5: return '%.6f' % value
+        return repr(round(value, 14))
+
+    def trips(self, n):
+        """Yield `n` trips as dicts of raw TLC column values"""
+        rand = random.Random('%s-%s-%s-%s' % \
+            (self.color, self.year, self.month, self.seed))
+        for i in range(n):
+            pickup = self.start + datetime.timedelta(
+                seconds=rand.randrange(self.seconds))
+            dropoff = pickup + datetime.timedelta(
+                seconds=int(rand.lognormvariate(6.5, 0.6)))
+            distance = rand.lognormvariate(0.7, 0.8)
+            fare = 2.5 + 2.5 * distance + rand.uniform(0, 3)
+
+            x = rand.random()
+            if x < self.ZERO_RATE:
+                coordinates = ['0', '0', '0', '0']
+            elif x < self.ZERO_RATE + self.OUTLIER_RATE:
+                coordinates = ['%.6f' % rand.uniform(-75, -74.5),
+                               '%.6f' % rand.uniform(41, 41.5),
+                               '%.6f' % rand.uniform(-75, -74.5),
+                               '%.6f' % rand.uniform(41, 41.5)]
+            else:
+                coordinates = []
+                for longitude, latitude in [self.point(rand), self.point(rand)]:
+                    coordinates.append(self.coordinate(rand, longitude))
+                    coordinates.append(self.coordinate(rand, latitude))
+
+            trip = dict([(name, '') for name in self.columns])
+            trip.update({
+                'vendor_id': str(rand.randint(1, 2)),
+                'pickup_datetime': pickup.strftime('%Y-%m-%d %H:%M:%S'),
+                'dropoff_datetime': dropoff.strftime('%Y-%m-%d %H:%M:%S'),
+                'store_and_fwd_flag': 'N',
+                'rate_code': '1',
+                'passenger_count': str(rand.randint(1, 4)),
+                'pickup_longitude': coordinates[0],
+                'pickup_latitude': coordinates[1],
+                'dropoff_longitude': coordinates[2],
+                'dropoff_latitude': coordinates[3],
+                'trip_distance': '%.2f' % distance,
+                'fare_amount': '%.1f' % fare,
+                'extra': '0.5',
+                'mta_tax': '0.5',
+                'tip_amount': '%.2f' % (fare * 0.15),
+                'tolls_amount': '0',
+                'surcharge': '0.3',
+                'total_amount': '%.2f' % (fare * 1.15 + 1.3),
+                'payment_type': '1',
+                'trip_type': '1',
+            })
+            yield trip
+
+    def raw_line(self, trip):
+        return ','.join([trip[name] for name in self.columns]) + '\r\n'
+
+    def record(self, trip):
+        """Converted record of a trip, None if raw2aws drops it"""
+        def delta_seconds(time):
+            delta = datetime.datetime.strptime(time, '%Y-%m-%d %H:%M:%S') - \
+                RawReader.START_DATE
+            return '%d' % (delta.days * 86400 + delta.seconds)
+
+        if '0' in [trip['pickup_longitude'], trip['pickup_latitude'],
+                   trip['dropoff_longitude'], trip['dropoff_latitude']]:
+            return None
+
+        line = ','.join([delta_seconds(trip['pickup_datetime']),
+                         delta_seconds(trip['dropoff_datetime']),
+                         '%.6f' % float(trip['pickup_longitude']),
+                         '%.6f' % float(trip['pickup_latitude']),
+                         '%.6f' % float(trip['dropoff_longitude']),
+                         '%.6f' % float(trip['dropoff_latitude']),
+                         '%.2f' % float(trip['trip_distance']),
+                         '%.2f' % float(trip['fare_amount']),
+                         ''])
+        return line.ljust(RECORD_LENGTH - 1, '*') + '\n'
+
+    def raw_lines(self, n):
+        """Header, empty line and `n` raw lines of a TLC file"""
+        yield ','.join([name for name in self.columns]) + '\r\n'
+        yield '\r\n'
+        for trip in self.trips(n):
+            yield self.raw_line(trip)
+
+    def records(self, n):
+        """Converted records of `n` trips, dropped trips excluded"""
+        for trip in self.trips(n):
+            record = self.record(trip)
+            if record: yield record
+
+    def write_raw(self, directory, n):
+        path = os.path.join(directory, '%s_tripdata_%s-%02d.csv' % \
+            (self.color, self.year, self.month))
+        with open(path, 'w') as f:
+            f.writelines(self.raw_lines(n))
+        return path
+
+    def write_records(self, directory, n, record_format='plain'):
+        path = os.path.join(directory,
+            get_file_name(self.color, self.year, self.month, record_format))
+        with open(path, 'w') as f:
+            writer = RECORD_WRITERS.get(record_format)
+            if writer: f = writer(f)
+            for record in self.records(n): f.write(record)
+            if writer: f.close()
+        return path
+
+if __name__ == '__main__':
+    opts = parse_argv()
+    g = TripGenerator(opts.color, opts.year, opts.month, opts.seed)
+    if opts.format == 'raw':
+        print(g.write_raw(opts.dst, opts.records))
+    elif opts.format in ('zblock', 'columnar'):
+        print(g.write_records(opts.dst, opts.records, opts.format))
+    else:
+        print(g.write_records(opts.dst, opts.records))
@@ -3,13 +3,17 @@
 
 # Tasks Management and Queuing
 
+import json
 import logging
 import sys
+import threading
+import time
 
-import boto3
-import botocore
-
+from backends import BACKEND_ERRORS, get_backend
 from common import *
+from formats import count_records
+from query import Predicate, query_key, scan_predicate
+from zonemap import ZoneMap
 
 logging.basicConfig()
 
@@ -17,6 +21,18 @@ def parse_argv():
     o = Options()
     o.add('--create-tasks', type=int, dest='create_tasks', metavar='NUM',
         default=-1, help='create tasks')
+    o.add('--from', metavar='YYYY-MM-DD[THH]', type=parse_time,
+        dest='time_from', default=None,
+        help='first pickup hour of created tasks, of a sorted month')
+    o.add('--to', metavar='YYYY-MM-DD[THH]', type=parse_time,
+        dest='time_to', default=None,
+        help='pickup hour to stop created tasks at, of a sorted month')
+    o.add('--where', metavar='EXPR', type=str, action='append',
+        dest='where', default=None,
+        help='created tasks map only matching records, see mapred.py')
+    o.add('--query', metavar='EXPR', type=str, action='append',
+        dest='query', default=None,
+        help='created tasks also map a query of their own, see mapred.py')
     o.add('--receive-tasks', type=int, dest='receive_tasks', metavar='NUM',
         default=0, help='receive tasks')
     o.add('--delete-after-receive', dest='delete_received', action='store_true',
@@ -30,7 +46,7 @@ def parse_argv():
 
 class Task:
     def __init__(self, color, year, month, start, end,
-            timeout=3600, sqs_id=None, sqs_handle=None):
+            timeout=3600, sqs_id=None, sqs_handle=None, queries=None):
         self.color = color
         self.year = year
         self.month = month
@@ -38,84 +54,293 @@ class Task:
         self.end = end
         self.timeout = timeout  # If not succeeded in 3600 seconds, expires
         self.status  = None
+        # queries of one scan, expressions of mapred.py --where each, []
+        # of the whole month
+        self.queries = queries or [[]]
 
         # for task retry
         self.sqs_id = sqs_id          # SQS message ID
         self.sqs_handle = sqs_handle  # SQS message handle
+        self.merged = []              # queued tasks merged into this one
 
     def encode(self):
         return self.__str__()
 
     @classmethod
     def decode(cls, message):
-        color, year, month, start, end, timeout = message.body.split(',')
+        fields = message.body.split(',', 6)
+        color, year, month, start, end, timeout = fields[:6]
+        queries = json.loads(fields[6]) if len(fields) > 6 else None
+        # a list of expressions is the one query of a task
+        if queries and not isinstance(queries[0], list): queries = [queries]
 
         return Task(color, int(year), int(month), int(start), int(end),
-            int(timeout), message.message_id, message.receipt_handle)
+            int(timeout), message.message_id, message.receipt_handle, queries)
+
+    def scan(self):
+        """Records read by the task, tasks of the same scan are merged"""
+        return (self.color, self.year, self.month, self.start, self.end)
+
+    def merge(self, task):
+        """Map the queries of a task in the scan of this one too"""
+        keys = [query_key(where) for where in self.queries]
+        for where in task.queries:
+            if query_key(where) not in keys:
+                self.queries.append(where)
+                keys.append(query_key(where))
+        self.merged.append(task)
 
     def __repr__(self):
-        return "%(color)s:%(year)s:%(month)s:[%(start)d,%(end)d):%(timeout)d" % \
+        r = "%(color)s:%(year)s:%(month)s:[%(start)d,%(end)d):%(timeout)d" % \
             (self.__dict__)
+        if self.queries != [[]]:
+            r += ':where %s' % ' | '.join([' and '.join(where) or '*'
+                                           for where in self.queries])
+        return r
 
     def __str__(self):
-        return "%(color)s,%(year)d,%(month)d,%(start)d,%(end)d,%(timeout)d" % \
+        s = "%(color)s,%(year)d,%(month)d,%(start)d,%(end)d,%(timeout)d" % \
             (self.__dict__)
+        # HOWTO: the predicate goes last, it may contain commas, and a
+        # single query is its list of expressions as it always was
+        if len(self.queries) > 1: s += ',' + json.dumps(self.queries)
+        elif self.queries[0]: s += ',' + json.dumps(self.queries[0])
+        return s
+
+class TaskHeartbeat(threading.Thread):
+    """Keep a retrieved task invisible while its mappers make progress
+
+    Every `interval` seconds the task visibility is extended by another
+    `task.timeout` seconds, as long as the shared `progress` counter has
+    moved within the last `task.timeout` seconds. A stalled or crashed
+    worker therefore releases its task after at most two timeouts.
+    """
+
+    def __init__(self, task_manager, task, interval, progress=None):
+        super(TaskHeartbeat, self).__init__(name='heartbeat')
+        self.daemon = True
+        self.task_manager = task_manager
+        self.task = task
+        self.interval = interval
+        self.progress = progress
+        self.stopped = threading.Event()
+        self.logger = task_manager.logger
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        last_value = self.progress.value if self.progress else 0
+        last_progress = time.time()
+
+        while not self.stopped.wait(self.interval):
+            if self.progress is not None:
+                value = self.progress.value
+                if value != last_value:
+                    last_value, last_progress = value, time.time()
+                elif time.time() - last_progress > self.task.timeout:
+                    self.logger.warning('%r => stalled at %d records' % \
+                        (self.task, value))
+                    continue
+            try:
+                self.task_manager.extend_task(self.task)
+            except BACKEND_ERRORS as e:
+                # HOWTO: keep beating, the next extension may succeed
+                self.logger.warning('%r => heartbeat failed: %s' % \
+                    (self.task, e))
+
+class ThroughputHistory:
+    """Recent worker throughput (records/sec) shared by all boxes
+
+    Samples are items of the table backend, of the hash key '#<name>'
+    and of the time of the sample in microseconds, so tasks are sized by
+    the rates of every worker wherever they are created.
+    """
+
+    MAX_SAMPLES = 32
+
+    def __init__(self, table, name):
+        self.table = table
+        self.color = '#' + name
+        self.samples = []
+        self.load()
+
+    def load(self):
+        """Read the latest MAX_SAMPLES samples, delete older ones"""
+        try:
+            keys = sorted(self.table.keys(self.color),
+                          key=lambda key: key['date'])
+            for key in keys[:-self.MAX_SAMPLES]: self.table.delete(key)
+            samples = []
+            for key in keys[-self.MAX_SAMPLES:]:
+                item = self.table.get(key)
+                if not item: continue
+                samples.append([int(key['date']) / 1000000,
+                    int(item['records']), int(item['ms']) / 1000.0])
+            self.samples = samples
+        except BACKEND_ERRORS as e:
+            logging.getLogger(self.__class__.__name__).warning(
+                '%s => load failed: %s' % (self.color, e))
+        return self
+
+    def add(self, records, seconds):
+        if records <= 0 or seconds <= 0: return
+        now = int(time.time() * 1000000)
+        try:
+            # HOWTO: samples of the same microsecond would add up, as rates
+            self.table.add({'color': self.color, 'date': now},
+                {'records': records, 'ms': max(int(seconds * 1000), 1)})
+        except BACKEND_ERRORS as e:
+            logging.getLogger(self.__class__.__name__).warning(
+                '%s => add failed: %s' % (self.color, e))
+        self.samples.append([now / 1000000, records, round(seconds, 3)])
+        self.samples = self.samples[-self.MAX_SAMPLES:]
+
+    def rate(self):
+        """Median records/sec of recent samples, None if no history"""
+        rates = sorted(float(n) / s for _, n, s in self.samples)
+        if not rates: return None
+        return rates[len(rates) / 2]
 
 class TaskManager:
+    MIN_RECORDS_PER_TASK = 1000
+    GATHER = 10             # queued tasks looked at for the same scan
+    OVERSIZE_FACTOR = 2     # split a task estimated to take this many times
+                            # longer than the target task duration
+
     def __init__(self, opts):
         self.opts = opts
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(self.opts.verbose)
 
-        self.sqs = boto3.resource('sqs', region_name=opts.region)
+        self.backend = get_backend(opts)
+        table = self.backend.table(self.opts.ddb_table_name)
+        if not table.exists(): table.create()
+        self.history = ThroughputHistory(table, self.opts.throughput_history)
+
         self.logger.debug('queue:%s' % self.opts.sqs_queue)
-        self.queue = self.sqs.Queue(self.opts.sqs_queue)
+        self.queue = self.backend.queue(self.opts.sqs_queue)
 
-        self.s3 = boto3.resource('s3')
         self.logger.debug('bucket:%s' % self.opts.bucket)
-        self.bucket = self.s3.Bucket(self.opts.bucket)
+        self.bucket = self.backend.store('s3://' + self.opts.bucket)
 
     @classmethod
     def cut(cls, start, end, N, nth=None):
-        """Cut a range [start, end] into N parts [nth, nth+1)"""
-        parts = range(start, end + 1, (end - start) / N)
-        parts[-1] = end + 1
+        """Cut a range [start, end] into N parts [nth, nth+1) of sizes in
+        proportion, which cover it, empty only if N exceeds its records"""
+        count = end - start + 1
+        parts = [start + i * count // N for i in range(N + 1)]
         if nth is None: return [[parts[i], parts[i+1]] for i in range(N)]
         return [parts[nth], parts[nth+1]]
 
-    def create_tasks(self, color, year, month, n_tasks=0):
+    def create_tasks(self, color, year, month, n_tasks=0,
+                     time_from=None, time_to=None, where=None, queries=None):
+        """Queue tasks of a month, or of the records picked up from
+        `time_from` until `time_to` of a month sorted by pickup time
+
+        Tasks of a `where` predicate cover only blocks its zone map does
+        not rule out. Tasks map `queries`, lists of expressions, too in
+        the same scan, of the blocks any query may match.
+        """
         if n_tasks < 0: return
 
-        try:
-            self.s3.meta.client.head_bucket(Bucket=self.bucket.name)
-        except botocore.exceptions.ClientError as e:
-            error_code = int(e.response['Error']['Code'])
-            if error_code == 404:
-                self.logger.critical('s3://%s does not exists' % self.bucket.name)
+        if not self.bucket.exists():
+            self.logger.critical('%s does not exists' % self.bucket.uri)
+            sys.exit(1)
+
+        key = get_file_name(color, year, month, self.opts.record_format)
+        n_records = count_records(self.bucket, key, self.opts.record_format)
+        ranges = [(0, n_records)]
+        if time_from or time_to:
+            index = TimeIndex.load(self.bucket, color, year, month)
+            if index is None:
+                self.logger.critical('%s/%s is not sorted by time' % \
+                    (self.bucket.uri, key))
                 sys.exit(1)
-
-        key = '%s-%s-%02d.csv' % (color, year, month)
-        obj = self.bucket.Object(key)
-        n_records = obj.content_length / RECORD_LENGTH
+            ranges = [index.range(time_from, time_to)]
+        queries = [where or []] + (queries or [])
+        predicate = scan_predicate([Predicate(where) if where else None
+                                    for where in queries])
+        if predicate:
+            zonemap = ZoneMap.load(self.bucket, color, year, month)
+            if zonemap is None:
+                self.logger.warning('%s/%s has no zone map' % \
+                    (self.bucket.uri, key))
+            else:
+                ranges = zonemap.ranges(predicate, *ranges[0])
+
+        n_selected = sum([end - start for start, end in ranges])
+        if n_selected == 0:
+            self.logger.info('no records of %s selected' % key)
+            return
         if n_tasks == 0:
-            n_tasks = (n_records / int(self.opts.records_per_task)) + 1
-
-        self.logger.debug('create tasks for s3://%s/%s (%d)' % \
-            (self.bucket.name, key, n_records))
-
-        for record_range in self.cut(0, n_records, n_tasks):
-            task = Task(color, year, month, record_range[0], record_range[1],
-                int(self.opts.task_timeout))
-            self.logger.debug('%r => create' % task)
+            n_tasks = (n_selected / self.records_per_task()) + 1
+
+        self.logger.debug('create tasks for %s/%s %d of %d in %d ranges' % \
+            (self.bucket.uri, key, n_selected, n_records, len(ranges)))
+
+        for start, end in ranges:
+            # tasks of ranges in proportion to their records
+            n = int(round(n_tasks * float(end - start) / n_selected))
+            n = max(min(n, end - start), 1)
+            # cut takes an inclusive end
+            for record_range in self.cut(start, end - 1, n):
+                task = Task(color, year, month, record_range[0],
+                    record_range[1], int(self.opts.task_timeout),
+                    queries=[list(where) for where in queries])
+                self.logger.debug('%r => create' % task)
+                if not self.opts.dryrun:
+                    self.queue.send_message(task.encode())
+
+    def records_per_task(self):
+        """Records that take a worker about `task_duration` seconds"""
+        rate = self.history.rate()
+        if rate is None: return int(self.opts.records_per_task)
+        return max(self.MIN_RECORDS_PER_TASK,
+                   int(rate * int(self.opts.task_duration)))
+
+    def record_throughput(self, task, seconds):
+        self.history.add(task.end - task.start, seconds)
+        self.logger.debug('%r => %.0f records/sec in %.2f seconds' % \
+            (task, (task.end - task.start) / seconds, seconds))
+
+    def estimate_duration(self, task):
+        rate = self.history.rate()
+        if rate is None: return None
+        return (task.end - task.start) / rate
+
+    def split_task(self, task):
+        """Requeue an oversized task as parts of `task_duration` seconds
+
+        Return True if the task was split and deleted, otherwise the caller
+        keeps working on the original task.
+        """
+        duration = self.estimate_duration(task)
+        target = int(self.opts.task_duration)
+        if duration is None or duration < self.OVERSIZE_FACTOR * target:
+            return False
+
+        n_parts = min(int(duration / target) + 1,
+                      (task.end - task.start) / self.MIN_RECORDS_PER_TASK)
+        if n_parts < 2: return False
+
+        self.logger.info('%r => split into %d (%.0f seconds estimated)' % \
+            (task, n_parts, duration))
+        # send parts before delete, so a crash in between only duplicates
+        for start, end in self.cut(task.start, task.end - 1, n_parts):
+            part = Task(task.color, task.year, task.month, start, end,
+                task.timeout, queries=task.queries)
+            self.logger.debug('%r => create' % part)
             if not self.opts.dryrun:
-                self.queue.send_message(MessageBody=task.encode())
+                self.queue.send_message(part.encode())
+        self.delete_task(task)
+        return True
 
     def retrieve_task(self, delete=False, **kwargs):
-        try:
-            message = self.queue.receive_messages(
-                MaxNumberOfMessages=1, WaitTimeSeconds=1)[0]
-        except IndexError as e:
+        message = self.queue.receive_message()
+        if message is None:
             self.logger.debug("no more task")
             return None
 
@@ -125,24 +350,40 @@ class TaskManager:
         # change task visiblity in case of failure and retry
         if delete:
             self.logger.debug('%r (%s) => delete' % (task, task.sqs_id))
-            message.delete()
+            self.queue.delete_message(task.sqs_id, task.sqs_handle)
         else:
             self.logger.debug('%r (%s) => hold' % (task, task.sqs_id))
-            message.change_visibility(VisibilityTimeout=task.timeout)
+            self.queue.change_visibility(task.sqs_handle, task.timeout)
+            self.gather_tasks(task)
 
         return task
 
+    def gather_tasks(self, task):
+        """Merge queued tasks of the same records into a held task, so N
+        queries of a month cost one scan. Up to GATHER queued tasks are
+        looked at, only those merged are received and held."""
+        scan = task.scan()
+        match = lambda message: Task.decode(message).scan() == scan
+        for message in self.queue.receive_matching(self.GATHER, match,
+                                                   task.timeout):
+            other = Task.decode(message)
+            task.merge(other)
+            self.logger.debug('%r (%s) => merge into %s' % \
+                (other, other.sqs_id, task.sqs_id))
+
+    def extend_task(self, task, timeout=None):
+        if timeout is None: timeout = task.timeout
+        self.logger.debug('%r (%s) => extend %ds' % (task, task.sqs_id, timeout))
+        for t in [task] + task.merged:
+            self.queue.change_visibility(t.sqs_handle, timeout)
+
     def delete_task(self, task):
         self.logger.debug('%r (%s) => delete' % (task, task.sqs_id))
-        self.queue.delete_messages(
-            Entries = [{'Id': task.sqs_id, 'ReceiptHandle': task.sqs_handle}])
+        for t in [task] + task.merged:
+            self.queue.delete_message(t.sqs_id, t.sqs_handle)
 
     def count_tasks(self):
-        self.queue.reload()
-        attr = self.queue.attributes
-        remain = int(attr['ApproximateNumberOfMessages'])
-        retry  = int(attr['ApproximateNumberOfMessagesNotVisible'])
-        return remain, retry
+        return self.queue.count()
 
     def purge_queue(self):
         self.logger.warning('%s => purge' % self.opts.sqs_queue)
@@ -152,7 +393,8 @@ class TaskManager:
         if self.opts.purge_queue: self.purge_queue()
 
         self.create_tasks(self.opts.color, self.opts.year, self.opts.month,
-            self.opts.create_tasks)
+            self.opts.create_tasks, self.opts.time_from, self.opts.time_to,
+            self.opts.where, [[q] for q in self.opts.query or []])
 
         if self.opts.count_tasks:
             print('Tasks remain: %d, retry: %d' % self.count_tasks())
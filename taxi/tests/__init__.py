@@ -0,0 +1,7 @@
+# All rights reserved.
+
+# Unit Tests
+#
+# HOWTO: run from taxi/, where the modules under test are importable:
+#
+#   python -m unittest discover -s tests -t .
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Microbenchmarks and the scaling benchmark on a few synthetic records
+
+from __future__ import print_function
+
+import json
+import logging
+import os
+import shutil
+import StringIO
+import sys
+import tempfile
+import unittest
+
+import bench
+
+class BenchTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        self.stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        logging.disable(logging.NOTSET)
+
+    def benchmark(self, *args):
+        argv = sys.argv
+        sys.argv = ['bench.py', '-n', '200', '--repeat', '1', '--baseline',
+                    os.path.join(self.tmpdir, 'baseline.json')] + list(args)
+        try:
+            return bench.Benchmark(bench.parse_argv())
+        finally:
+            sys.argv = argv
+
+    def test_benchmarks(self):
+        b = self.benchmark('--save-baseline')
+        b.run()
+        names = [name for name, _, _, _ in b.results]
+        self.assertEqual(names, bench.Benchmark.BENCHMARKS)
+        for name, count, elapsed, rate in b.results:
+            self.assertTrue(count > 0 and rate > 0, name)
+        self.assertFalse(os.path.exists(b.tmpdir))
+        with open(b.opts.baseline) as f: saved = json.load(f)
+        self.assertEqual(sorted(saved['rates']), sorted(names))
+        self.assertEqual(b.load_baseline(), saved['rates'])
+
+    def test_regressions(self):
+        b = self.benchmark()
+        b.results = [('add', 100, 1.0, 100.0), ('convert', 100, 1.0, 100.0),
+                     ('read', 100, 1.0, 100.0)]
+        # slower than tolerated, within tolerance, and no baseline
+        self.assertEqual(b.report({'add': 200.0, 'convert': 110.0}), ['add'])
+        self.assertIn('REGRESSION', sys.stdout.getvalue())
+
+    def test_scaling(self):
+        csv = os.path.join(self.tmpdir, 'scaling.csv')
+        self.benchmark('--scaling', '--procs', '1', '2', '--csv', csv).run()
+        with open(csv) as f: lines = f.read().splitlines()
+        columns = lines[0].split(',')
+        rows = [dict(zip(columns, map(float, line.split(','))))
+                for line in lines[1:]]
+        self.assertEqual([row['procs'] for row in rows], [1, 2])
+        self.assertEqual(rows[0]['speedup'], 1.0)
+        self.assertEqual(rows[0]['efficiency'], 1.0)
+        for row in rows:
+            self.assertAlmostEqual(row['efficiency'],
+                                   row['speedup'] / row['procs'])
+            self.assertTrue(row['max_rss_kb'] >= row['mean_rss_kb'] > 0)
+            self.assertTrue(row['result_bytes'] > 0)
+
+if __name__ == '__main__':
+    unittest.main()
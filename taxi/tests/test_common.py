@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# TimeIndex of records sorted by pickup time
+
+from __future__ import print_function
+
+import bisect
+import datetime
+import random
+import unittest
+
+from common import BASE_DATE, RECORD_LENGTH, TimeIndex
+
+def record(pickup, tag):
+    return ('%d,%d,' % (pickup, tag)).ljust(RECORD_LENGTH - 1, '*') + '\n'
+
+class TimeIndexTest(unittest.TestCase):
+    def test_sort(self):
+        rand = random.Random(0)
+        start = int((datetime.datetime(2016, 2, 1) - BASE_DATE)
+                    .total_seconds())
+        pickups = [start + rand.randrange(-86400, 30 * 86400)
+                   for i in range(5000)]
+        pickups += [start, start, start + 3600, -5, 0, 10 ** 12]  # ties
+        records = [record(pickup, i) for i, pickup in enumerate(pickups)]
+        rows, index = TimeIndex.sort('green', 2016, 2, ''.join(records))
+
+        expected = sorted(records, key=lambda r: int(r.split(',')[0]))
+        self.assertEqual(rows.tostring(), ''.join(expected))
+        self.assertEqual(index.records, len(records))
+        self.assertEqual(len(index.hours), 29 * 24 + 1)
+        times = sorted(pickups)
+        for h in [0, 1, 24, 29 * 24]:
+            self.assertEqual(index.hours[h],
+                             bisect.bisect_left(times, start + h * 3600))
+
+    def test_sort_empty(self):
+        rows, index = TimeIndex.sort('green', 2016, 2, '')
+        self.assertEqual(rows.tostring(), '')
+        self.assertEqual(index.hours, [0] * (29 * 24 + 1))
+
+if __name__ == '__main__':
+    unittest.main()
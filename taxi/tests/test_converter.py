@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# VectorConverter against RawReader.reformat, on synthetic and malformed
+# raw lines of every column layout
+
+from __future__ import print_function
+
+import logging
+import random
+import unittest
+
+import raw2aws
+from raw2aws import RawReader
+from synth import TripGenerator
+
+# (color, year, month) of each column layout of raw2aws.py
+LAYOUTS = [('green', 2014, 5), ('green', 2015, 5), ('green', 2016, 1),
+           ('yellow', 2014, 5), ('yellow', 2016, 1)]
+
+# malformed timestamps: month, day, hour, minute and second out of range
+BAD_DATETIMES = ['2016-13-01 00:00:00', '2016-00-10 10:00:00',
+                 '2016-19-31 12:00:00', '2016-02-30 10:00:00',
+                 '2016-04-31 10:00:00', '2016-01-00 10:00:00',
+                 '2016-01-32 10:00:00', '2016-01-10 24:00:00',
+                 '2016-01-10 10:60:00', '2016-01-10 10:00:60',
+                 '2016-1-10 10:00:00', '2016-01-10T10:00:00']
+
+# malformed numbers of coordinates, distance and fare
+BAD_NUMBERS = ['', 'abc', '0', '1e400', '-', '12.3.4', '99999999999999999']
+NUMBERS = ['pickup_longitude', 'pickup_latitude', 'dropoff_longitude',
+           'dropoff_latitude', 'trip_distance', 'fare_amount']
+
+def raw_reader(color, year, month):
+    reader = RawReader()
+    reader.color, reader.year, reader.month = color, year, month
+    return reader
+
+class VectorConverterTest(unittest.TestCase):
+    def setUp(self):
+        # HOWTO: reformat warns of every row it drops
+        logging.disable(logging.WARNING)
+        self.warning = raw2aws.warning
+        raw2aws.warning = lambda msg: None
+
+    def tearDown(self):
+        raw2aws.warning = self.warning
+        logging.disable(logging.NOTSET)
+
+    def assertConverts(self, layout, lines):
+        from converter import VectorConverter
+        reader = raw_reader(*layout)
+        expected = ''.join(filter(None, map(reader.reformat, lines)))
+        converted = VectorConverter(reader).convert(''.join(lines))
+        self.assertEqual(converted, expected, '%s-%d-%02d' % layout)
+
+    def test_synthetic(self):
+        for layout in LAYOUTS:
+            lines = list(TripGenerator(*layout).raw_lines(500))[2:]
+            self.assertConverts(layout, lines)
+
+    def test_bad_datetimes(self):
+        rand = random.Random(0)
+        for layout in LAYOUTS:
+            generator = TripGenerator(*layout)
+            lines = []
+            for trip in generator.trips(500):
+                if rand.random() < 0.3:
+                    field = rand.choice(['pickup_datetime',
+                                         'dropoff_datetime'])
+                    trip[field] = rand.choice(BAD_DATETIMES)
+                lines.append(generator.raw_line(trip))
+            self.assertConverts(layout, lines)
+
+    def test_bad_numbers(self):
+        rand = random.Random(0)
+        for layout in LAYOUTS:
+            generator = TripGenerator(*layout)
+            lines = []
+            for trip in generator.trips(500):
+                if rand.random() < 0.3:
+                    trip[rand.choice(NUMBERS)] = rand.choice(BAD_NUMBERS)
+                lines.append(generator.raw_line(trip))
+            self.assertConverts(layout, lines)
+
+    def test_bad_columns(self):
+        for layout in LAYOUTS:
+            generator = TripGenerator(*layout)
+            lines = []
+            for i, trip in enumerate(generator.trips(30)):
+                line = generator.raw_line(trip)
+                # a column short, a column more, and an empty row
+                if i % 3 == 1: line = line[:line.rindex(',')] + '\r\n'
+                elif i % 3 == 2: line = line.replace(',', ',,', 1)
+                lines.append(line)
+            lines.append('\r\n')
+            self.assertConverts(layout, lines)
+
+    def test_bad_month_row(self):
+        layout = ('green', 2016, 1)
+        generator = TripGenerator(*layout)
+        trips = list(generator.trips(4))
+        trips[1]['pickup_datetime'] = '2016-13-01 00:00:00'
+        self.assertConverts(layout, [generator.raw_line(trip)
+                                     for trip in trips])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# District cubes: counting, slices of weekdays and hours, StatDB items
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import logging
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+from common import BASE_DATE
+from cube import DistrictCube, HOURS, WEEKDAYS, WEEKENDS
+from mapred import StatDB, TaxiStat
+
+class DistrictCubeTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        random.seed(5)
+        self.cube = DistrictCube()
+        self.districts = self.cube.indexes
+        self.trips = []
+        for i in range(3000):
+            pickup_time = random.randrange(220000000, 223000000)
+            self.trips.append((random.choice(self.districts[:10] + [None]),
+                               random.choice(self.districts[:10] + [None]),
+                               pickup_time,
+                               pickup_time + random.randrange(7200)))
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def counted(self, trips):
+        cube = DistrictCube()
+        for trip in trips: cube.add(*trip)
+        return cube
+
+    def expected(self, kind, weekdays=None):
+        """Counter of (district, hour of the day) of trips of weekdays"""
+        counts = Counter()
+        for pickup, dropoff, pickup_time, dropoff_time in self.trips:
+            district, time = (pickup, pickup_time) if kind == 'pickups' \
+                else (dropoff, dropoff_time)
+            date = BASE_DATE + datetime.timedelta(seconds=time)
+            if weekdays is None or date.weekday() in weekdays:
+                counts[district, date.hour] += 1
+        return counts
+
+    def test_add(self):
+        self.assertEqual(list(self.cube.items()), [])
+        cube = self.counted(self.trips)
+        rows = DistrictCube()
+        rows.add_rows([(p, d) for p, d, _, _ in self.trips],
+                      [t for _, _, t, _ in self.trips],
+                      [t for _, _, _, t in self.trips])
+        self.assertEqual(list(rows.items()), list(cube.items()))
+        self.assertEqual(sum([n for _, _, _, n in cube.items()]),
+                         2 * len(self.trips))
+        # pickups only, without dropoff times
+        rows = DistrictCube()
+        rows.add_rows([(p, d) for p, d, _, _ in self.trips],
+                      [t for _, _, t, _ in self.trips])
+        self.assertEqual(list(rows.items()),
+            [item for item in cube.items() if item[0] == 'pickups'])
+        rows.add_rows([], [])
+        merged = DistrictCube()
+        merged += self.counted(self.trips[::2])
+        merged += self.counted(self.trips[1::2])
+        self.assertEqual(list(merged.items()), list(cube.items()))
+
+    def test_slices(self):
+        cube = self.counted(self.trips)
+        self.assertEqual(cube.slice('pickups').shape, (len(self.districts),
+                                                      7, 24))
+        self.assertEqual(DistrictCube().hours('dropoffs'), [0] * 24)
+        for kind in DistrictCube.KINDS:
+            for weekdays in [None, WEEKDAYS, WEEKENDS, [2]]:
+                expected = self.expected(kind, weekdays)
+                district = self.districts[3]
+                self.assertEqual(cube.hours(kind, [district], weekdays),
+                    [expected[district, hour] for hour in range(24)])
+                self.assertEqual(cube.hours(kind, None, weekdays),
+                    [sum([n for (_, h), n in expected.items() if h == hour])
+                     for hour in range(24)])
+                districts = Counter()
+                for (d, _), n in expected.items(): districts[d] += n
+                self.assertEqual(cube.districts(kind, weekdays), districts)
+
+    def test_statdb(self):
+        tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        try:
+            db = StatDB(argparse.Namespace(backend='local',
+                local_root=tmpdir, ddb_table_name='taxi'))
+            for i in range(2):
+                stat = TaxiStat('green', 2016, 1)
+                stat.cube = self.counted(self.trips[i::2])
+                db.append(stat, "hour < 25")
+            cube = self.counted(self.trips)
+            self.assertEqual(list(db.get_cube('green', 2016, 1,
+                "hour < 25").items()), list(cube.items()))
+            # one district item, the others not read
+            district = self.districts[3]
+            self.assertEqual(db.get_cube('green', 2016, 1, "hour < 25",
+                [district]).districts('pickups', WEEKENDS),
+                Counter(dict([(district,
+                    cube.districts('pickups', WEEKENDS)[district])])))
+            self.assertEqual(list(db.get_cube('green', 2016, 1).items()), [])
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        self.assertTrue(all([0 <= hour < HOURS
+                             for _, _, hour, _ in cube.items()]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# SegmentedDownloader against the Range server of download.py --serve
+
+from __future__ import print_function
+
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import download
+from download import RangeRequestHandler, SegmentedDownloader
+
+class QuietHandler(RangeRequestHandler):
+    def log_message(self, format, *args): pass
+
+class Interrupted(SegmentedDownloader):
+    """SegmentedDownloader failing once `limit` segments are fetched"""
+
+    def __init__(self, limit, **kwargs):
+        SegmentedDownloader.__init__(self, **kwargs)
+        self.limit = limit
+        self.fetched = 0
+
+    def fetch(self, url, path, start, end):
+        with self.lock:
+            if self.fetched == self.limit: raise IOError('killed')
+            self.fetched += 1
+        SegmentedDownloader.fetch(self, url, path, start, end)
+
+class DownloadTest(unittest.TestCase):
+    SIZE = 300 * 1000
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        random.seed(1)
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(self.src)
+        self.data = ''.join([chr(random.randrange(256))
+                             for i in range(self.SIZE)])
+        with open(os.path.join(self.src, 'trips.csv'), 'wb') as f:
+            f.write(self.data)
+        # HOWTO: SimpleHTTPRequestHandler serves the current directory
+        self.cwd = os.getcwd()
+        os.chdir(self.src)
+        self.httpd = download.ThreadingHTTPServer(('127.0.0.1', 0),
+                                                  QuietHandler)
+        self.url = 'http://127.0.0.1:%d/trips.csv' % self.httpd.server_port
+        self.server = threading.Thread(target=self.httpd.serve_forever)
+        self.server.daemon = True
+        self.server.start()
+        self.path = os.path.join(self.tmpdir, 'trips.csv')
+
+    def tearDown(self):
+        RangeRequestHandler.fail_rate = 0.0
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        logging.disable(logging.NOTSET)
+
+    def downloaded(self):
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertFalse(os.path.exists(self.path + '.part.done'))
+        with open(self.path, 'rb') as f: return f.read()
+
+    def test_segments(self):
+        RangeRequestHandler.fail_rate = 0.3
+        d = SegmentedDownloader(4, 16 * 1000, retries=20)
+        d.download(self.url, self.path)
+        self.assertEqual(self.downloaded(), self.data)
+        self.assertTrue(d.retried > 0)
+
+    def test_stream(self):
+        RangeRequestHandler.fail_rate = 0.5
+        d = SegmentedDownloader(1, retries=20)
+        d.download(self.url, self.path)
+        self.assertEqual(self.downloaded(), self.data)
+        self.assertTrue(d.retried > 0)
+
+    def test_stream_truncated(self):
+        RangeRequestHandler.fail_rate = 1.0
+        d = SegmentedDownloader(1, retries=1)
+        self.assertRaises(IOError, d.download, self.url, self.path)
+        self.assertEqual(d.retried, 1)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_resume(self):
+        segments = (self.SIZE + 9999) // 10000
+        d = Interrupted(7, segments=2, segment_size=10000, retries=0)
+        self.assertRaises(IOError, d.download, self.url, self.path)
+        self.assertFalse(os.path.exists(self.path))
+        d = Interrupted(None, segments=2, segment_size=10000)
+        d.download(self.url, self.path)
+        self.assertEqual(d.resumed, 7)
+        self.assertEqual(d.fetched, segments - 7)
+        self.assertEqual(self.downloaded(), self.data)
+
+    def test_resume_changed(self):
+        d = Interrupted(7, segments=2, segment_size=10000, retries=0)
+        self.assertRaises(IOError, d.download, self.url, self.path)
+        # a file modified since is downloaded again whole
+        mtime = time.time() - 3600
+        os.utime(os.path.join(self.src, 'trips.csv'), (mtime, mtime))
+        d = Interrupted(None, segments=2, segment_size=10000)
+        d.download(self.url, self.path)
+        self.assertEqual(d.resumed, 0)
+        self.assertEqual(self.downloaded(), self.data)
+
+if __name__ == '__main__':
+    unittest.main()
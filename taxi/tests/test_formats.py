@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Block-compressed and columnar records of a directory store, read by
+# ranges and columns
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from backends import DirectoryStore
+from common import RECORD_LENGTH
+from formats import BlockFile, BlockWriter, COLUMNS, ColumnFile, \
+    ColumnWriter, count_records
+from geo import NYCDistrictCode
+from synth import TripGenerator
+
+class BlockFileTest(unittest.TestCase):
+    BLOCK_RECORDS = 64
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        self.store = DirectoryStore(self.tmpdir)
+        self.data = ''.join(TripGenerator().records(1000))
+        self.records = len(self.data) // RECORD_LENGTH
+        self.store.put('plain.csv', self.data)
+        with self.store.open_write('zblock.csv') as f:
+            writer = BlockWriter(f, self.BLOCK_RECORDS)
+            # HOWTO: writes of any size, not of whole records or blocks
+            for i in range(0, len(self.data), 1000):
+                writer.write(self.data[i:i + 1000])
+            writer.close()
+        self.assertEqual(writer.size, self.store.size('zblock.csv'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def read(self, start, end, threads=2):
+        f = BlockFile(self.store, 'zblock.csv')
+        r = f.open_range(start, end, threads)
+        try:
+            data = []
+            while True:
+                chunk = r.read(7 * RECORD_LENGTH)
+                if not chunk: break
+                data.append(chunk)
+            return ''.join(data), r.transferred
+        finally:
+            r.close()
+
+    def test_round_trip(self):
+        f = BlockFile(self.store, 'zblock.csv')
+        self.assertEqual(f.records, self.records)
+        blocks = (self.records + self.BLOCK_RECORDS - 1) // self.BLOCK_RECORDS
+        self.assertEqual(len(f.offsets), blocks + 1)
+        data, transferred = self.read(0, self.records)
+        self.assertEqual(data, self.data)
+        self.assertEqual(transferred, f.offsets[-1])
+        self.assertTrue(transferred < len(self.data))
+        # past the end of the records, as mappers of the last range ask
+        self.assertEqual(self.read(0, self.records + 100)[0], self.data)
+
+    def test_ranges(self):
+        f = BlockFile(self.store, 'zblock.csv')
+        n = self.BLOCK_RECORDS
+        for start, end in [(0, 1), (n - 1, n + 1), (n, 2 * n), (70, 300),
+                           (self.records - 1, self.records), (5, 5)]:
+            data, transferred = self.read(start, end)
+            self.assertEqual(data, self.data[start * RECORD_LENGTH:
+                                             end * RECORD_LENGTH])
+            # only the blocks of the range are fetched
+            if start == end:
+                self.assertEqual(transferred, 0)
+                continue
+            first, last = start // n, (end - 1) // n
+            self.assertEqual(transferred,
+                             f.offsets[last + 1] - f.offsets[first])
+
+    def test_count_records(self):
+        self.assertEqual(count_records(self.store, 'zblock.csv', 'zblock'),
+                         self.records)
+        self.assertEqual(count_records(self.store, 'plain.csv', 'plain'),
+                         self.records)
+        self.assertRaises(IOError, count_records, self.store, 'plain.csv',
+                          'zblock')
+
+class ColumnFileTest(unittest.TestCase):
+    BLOCK_RECORDS = 64
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        self.store = DirectoryStore(self.tmpdir)
+        self.lines = list(TripGenerator().records(500))
+        # records of the first row group only are geocoded
+        n = self.BLOCK_RECORDS
+        self.lines[:n] = NYCDistrictCode().tag_records(
+            ''.join(self.lines[:n])).splitlines(True)
+        self.write('columnar.csv', ''.join(self.lines))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def write(self, key, data):
+        with self.store.open_write(key) as f:
+            writer = ColumnWriter(f, self.BLOCK_RECORDS)
+            writer.write(data)
+            writer.close()
+
+    def values(self, name, start, end):
+        """Values of a column of records [start, end) of their text"""
+        names = [column for column, _ in COLUMNS]
+        i, kind = names.index(name), dict(COLUMNS)[name]
+        lines = self.lines[start:end]
+        if name == 'districts':
+            offset = NYCDistrictCode.OFFSET
+            return [line[offset:offset + kind] for line in lines]
+        convert = int if kind == 'i' else float
+        return [convert(line.split(',')[i]) for line in lines]
+
+    def read(self, start, end, names, untagged=()):
+        f = ColumnFile(self.store, 'columnar.csv')
+        groups = list(f.read_columns(start, end, names, untagged, threads=2))
+        return f, groups
+
+    def test_round_trip(self):
+        names = [name for name, _ in COLUMNS]
+        f, groups = self.read(0, len(self.lines), names)
+        self.assertEqual(f.records, len(self.lines))
+        self.assertEqual(f.tagged[:2], [True, False])
+        self.assertEqual(count_records(self.store, 'columnar.csv',
+                                       'columnar'), len(self.lines))
+        for name in names:
+            self.assertEqual(sum([list(group[name]) for group in groups], []),
+                             self.values(name, 0, len(self.lines)), name)
+
+    def test_projection(self):
+        n = self.BLOCK_RECORDS
+        start, end = n - 10, 3 * n + 5
+        f, groups = self.read(start, end, ['fare'])
+        self.assertEqual([sorted(group) for group in groups],
+                         [['fare']] * 4)
+        self.assertEqual(sum([list(group['fare']) for group in groups], []),
+                         self.values('fare', start, end))
+        # only the fare chunks of the row groups of the range are fetched
+        i = [name for name, _ in COLUMNS].index('fare')
+        self.assertEqual(f.transferred - ColumnFile(self.store,
+            'columnar.csv').transferred, sum([f.chunks[group][i + 1] -
+            f.chunks[group][i] for group in range(4)]))
+
+    def test_untagged(self):
+        coordinates = ['pickup_longitude', 'pickup_latitude']
+        n = self.BLOCK_RECORDS
+        _, groups = self.read(0, 2 * n, ['districts'], coordinates)
+        # coordinates are read of the row group not geocoded only
+        self.assertEqual(sorted(groups[0]), ['districts'])
+        self.assertEqual(sorted(groups[1]),
+                         sorted(['districts'] + coordinates))
+        self.assertEqual(list(groups[1]['pickup_latitude']),
+                         self.values('pickup_latitude', n, 2 * n))
+        self.assertEqual(NYCDistrictCode().decode(groups[0]['districts'][0]),
+            NYCDistrictCode().read(self.lines[0]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# District codes of records tagged at conversion time
+
+from __future__ import print_function
+
+import unittest
+
+from geo import NYCDistrictCode
+from synth import TripGenerator
+
+class NYCDistrictCodeTest(unittest.TestCase):
+    coder = NYCDistrictCode()
+
+    def test_codes(self):
+        self.assertEqual(len(set(self.coder.codes.values())),
+                         len(self.coder.districts))
+        for index, code in self.coder.codes.items():
+            self.assertEqual(len(code), 2)
+            self.assertEqual(self.coder.indexes[code], index)
+        self.assertNotIn(NYCDistrictCode.NOWHERE, self.coder.indexes)
+
+    def test_tag(self):
+        records = ''.join(TripGenerator(seed=1).records(200))
+        tagged = self.coder.tag_records(records)
+        self.assertEqual(len(tagged), len(records))
+        n = NYCDistrictCode.RECORD_LENGTH
+        located = set()
+        for i in range(0, len(records), n):
+            record, tag = records[i:i + n], tagged[i:i + n]
+            self.assertEqual(tag[:NYCDistrictCode.OFFSET],
+                             record[:NYCDistrictCode.OFFSET])
+            self.assertEqual(tag[-1], '\n')
+            fields = map(float, record.split(',')[2:6])
+            districts = (self.coder.locate(*fields[:2]),
+                         self.coder.locate(*fields[2:]))
+            self.assertEqual(self.coder.read(tag), districts)
+            self.assertEqual(self.coder.read(record), None)
+            located.update(districts)
+        self.assertTrue(len(located) > 1)
+
+    def test_nowhere(self):
+        record = next(TripGenerator().records(1))
+        fields = record.split(',')
+        # at sea, east of Long Island, of the length of NYC coordinates
+        fields[2:6] = ['-70.000000', '40.000000'] * 2
+        record = ','.join(fields)
+        self.assertEqual(len(record), NYCDistrictCode.RECORD_LENGTH)
+        tag = self.coder.tag(record)
+        self.assertEqual(tag[NYCDistrictCode.OFFSET:], '#----\n')
+        self.assertEqual(self.coder.read(tag), (None, None))
+
+    def test_short_padding(self):
+        record = next(TripGenerator().records(1))
+        short = record[:NYCDistrictCode.OFFSET] + 'xx***\n'
+        self.assertEqual(self.coder.tag(short), short)
+        self.assertEqual(self.coder.decode('#' + '--' * 2), (None, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Mappers of synthetic records of a local backend
+
+from __future__ import print_function
+
+import bisect
+import datetime
+import logging
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mapred
+from common import BASE_DATE, RECORD_LENGTH, get_file_name, get_marker, \
+    get_zonemap_name
+from formats import RECORD_WRITERS
+from odmatrix import DistrictCounters
+from query import Predicate, query_key
+from synth import TripGenerator
+from zonemap import ZoneMap
+
+class MapredTest(unittest.TestCase):
+    RECORDS = 500
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(self.src)
+        self.generator = TripGenerator()
+        self.generator.write_records(self.src, self.RECORDS)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        logging.disable(logging.NOTSET)
+
+    def options(self, *args, **kwargs):
+        """mapred.py options of arguments, of the local backend of
+        `local_root` in tmpdir and records of `record_format`"""
+        record_format = kwargs.get('record_format', 'plain')
+        config = os.path.join(self.tmpdir, record_format + '.ini')
+        with open(os.path.join(os.path.dirname(mapred.__file__),
+                               'config.ini')) as f:
+            text = f.read()
+        with open(config, 'w') as f:
+            f.write(text.replace('record_format = plain',
+                                 'record_format = ' + record_format))
+        argv = sys.argv
+        sys.argv = ['mapred.py', '--src', 'file://' + self.src,
+                    '--config', config] + list(args)
+        try:
+            opts = mapred.parse_argv()
+        finally:
+            sys.argv = argv
+        opts.backend = 'local'
+        opts.local_root = os.path.join(self.tmpdir,
+                                       kwargs.get('local_root', 'local'))
+        return opts
+
+    def write(self, record_format, block_records=64):
+        """Records of src in another format, of short blocks so that
+        mappers read ranges of several blocks"""
+        with open(os.path.join(self.src, get_file_name('green', 2016, 1))) \
+                as f:
+            data = f.read()
+        with open(os.path.join(self.src, get_file_name('green', 2016, 1,
+                record_format)), 'wb') as f:
+            writer = RECORD_WRITERS[record_format](f, block_records)
+            writer.write(data)
+            writer.close()
+        zonemap = ZoneMap(block_records)
+        zonemap.write(data)
+        return zonemap.finish()
+
+    def mapped(self, record_format, *args, **kwargs):
+        """Options of mapred.py of arguments mapping records of a format"""
+        opts = self.options('-p', '3', *args, record_format=record_format,
+            local_root=kwargs.get('local_root', record_format))
+        mapred.start_multiprocess(opts)
+        return opts
+
+    def stat(self, opts, year=2016, month=1, query=None):
+        """Attributes of a month appended to StatDB, and its flows"""
+        db = mapred.StatDB(opts)
+        stat = db.get('green', year, month, query)
+        DistrictCounters.load_numbers()
+        flows = dict((pickup, db.get_flows('green', year, month, pickup,
+                                           query))
+                     for pickup in DistrictCounters.indexes)
+        return mapred.StatDB.encode(stat), flows
+
+    def test_profile(self):
+        profile = os.path.join(self.tmpdir, 'profile')
+        mapred.start_multiprocess(self.options('-p', '2', '--profile',
+                                               profile))
+        names = os.listdir(profile)
+        self.assertEqual(len([name for name in names
+                              if name.startswith('mapper')]), 2)
+        with open(os.path.join(profile, 'report.txt')) as f:
+            self.assertTrue(f.readline().startswith('Merged 2 profiles'))
+        stats = pstats.Stats(os.path.join(profile, 'merged.prof'))
+        self.assertIn('search', [name for _, _, name in stats.stats])
+        # stacks of flamegraph.pl, in microseconds
+        with open(os.path.join(profile, 'collapsed.txt')) as f:
+            stacks = dict(line.rsplit(' ', 1) for line in f)
+        self.assertTrue(any(':search;' in stack for stack in stacks))
+        for usecs in stacks.values(): self.assertTrue(int(usecs) > 0)
+
+    def test_stream(self):
+        with open(os.path.join(self.src, get_file_name('green', 2016, 1))) \
+                as f:
+            january = f.read()
+        february = ''.join(TripGenerator(month=2).records(300))
+        stream = os.path.join(self.tmpdir, 'stream')
+        with open(stream, 'w') as f:
+            f.write(get_marker('green', 2016, 1) + january +
+                    get_marker('green', 2016, 2) + february)
+        opts = self.options('--src', '-', '-p', '2')
+        stream_chunk, stdin = mapred.STREAM_CHUNK, sys.stdin
+        mapred.STREAM_CHUNK = 70
+        try:
+            with open(stream) as sys.stdin: mapred.start_stream(opts)
+        finally:
+            mapred.STREAM_CHUNK, sys.stdin = stream_chunk, stdin
+        # months of the stream, as mapped from their files
+        mapred.start_multiprocess(self.options('-p', '2',
+                                               local_root='files'))
+        self.assertEqual(self.stat(opts),
+                         self.stat(self.options(local_root='files')))
+        values, flows = self.stat(opts, month=2)
+        self.assertEqual(values['l'], len(february) // RECORD_LENGTH)
+
+    def test_flows(self):
+        opts = self.options('-p', '2')
+        stat = mapred.start_multiprocess(opts)
+        values, flows = self.stat(opts)
+        # every located trip out of a district, to anywhere
+        for pickup in stat.od.indexes:
+            self.assertEqual(flows[pickup], stat.od.flows(pickup))
+            if pickup is None: continue
+            self.assertEqual(sum(flows[pickup].values()),
+                             stat.pickups[pickup])
+        self.assertEqual(sum([sum(f.values()) for f in flows.values()]),
+                         stat.total - stat.invalid)
+
+    def test_where(self):
+        where = ['fare > 20', 'hour < 12']
+        opts = self.mapped('plain', '--where', where[0], '--where', where[1])
+        # records matching, mapped as a month of their own
+        def match(line):
+            fields = line.split(',')
+            date = BASE_DATE + datetime.timedelta(seconds=int(fields[0]))
+            return float(fields[7]) > 20 and date.hour < 12
+        filtered = os.path.join(self.tmpdir, 'filtered')
+        os.makedirs(filtered)
+        name = get_file_name('green', 2016, 1)
+        with open(os.path.join(self.src, name)) as f:
+            lines = [line for line in f if match(line)]
+        with open(os.path.join(filtered, name), 'w') as f:
+            f.writelines(lines)
+        month = self.mapped('plain', '--src', 'file://' + filtered,
+                            local_root='filtered')
+        values, flows = self.stat(opts, query=query_key(where))
+        self.assertEqual((values, flows), self.stat(month))
+        self.assertEqual(values['l'], len(lines))
+        # under the key of the query, not of the month
+        self.assertEqual(self.stat(opts)[0]['l'], 0)
+
+    def test_queries(self):
+        queries = ['fare > 40', "pickup_borough == 'Manhattan'",
+                   'distance < 1 and hour >= 18']
+        # one scan of a zone-mapped month, blocks skipped of no query
+        zonemap = self.write('zblock')
+        with open(os.path.join(self.src, get_zonemap_name('green', 2016, 1)),
+                  'w') as f:
+            f.write(zonemap.encode())
+        args = sum([['--query', query] for query in queries], [])
+        shared = self.mapped('zblock', '--where', 'fare > 10', *args)
+        self.assertEqual([stat.query for stat in
+            mapred.NYCTaxiStat(shared).stats], [query_key(where)
+            for where in [['fare > 10']] + [[query] for query in queries]])
+        for where in [['fare > 10']] + [[query] for query in queries]:
+            alone = self.mapped('plain', '--where', where[0],
+                                local_root=where[0])
+            key = query_key(where)
+            values, flows = self.stat(shared, query=key)
+            self.assertEqual((values, flows), self.stat(alone, query=key))
+            self.assertTrue(values['l'] > 0, where)
+        self.assertEqual(self.stat(shared)[0]['l'], 0)
+
+    def test_zblock(self):
+        self.write('zblock')
+        plain, zblock = self.mapped('plain'), self.mapped('zblock')
+        self.assertEqual(self.stat(zblock), self.stat(plain))
+        self.assertTrue(self.stat(plain)[0]['l'] > 0)
+
+    def test_columnar(self):
+        self.write('columnar')
+        plain, columnar = self.mapped('plain'), self.mapped('columnar')
+        self.assertEqual(self.stat(columnar), self.stat(plain))
+        # fares only, of every record as none is located
+        opts = self.options('-p', '3', '--columns', 'fare',
+                            record_format='columnar')
+        stat = mapred.start_multiprocess(opts)
+        with open(os.path.join(self.src, get_file_name('green', 2016, 1))) \
+                as f:
+            fares = [float(line.split(',')[7]) for line in f]
+        edges = mapred.NYCTaxiStat.FARES
+        self.assertEqual(sorted(stat.fare.elements()), sorted([edges[max(
+            bisect.bisect_right(edges, fare) - 1, 0)] for fare in fares]))
+        self.assertEqual((stat.total, stat.invalid), (len(fares), 0))
+        self.assertEqual(sum(stat.hour.values()), 0)
+        self.assertEqual(sum(stat.pickups.values()), 0)
+        # and not appended to StatDB
+        self.assertEqual(self.stat(opts)[0]['l'], 0)
+
+    def test_cube(self):
+        self.write('columnar')
+        stat = mapred.start_multiprocess(self.options('-p', '2',
+                                                      local_root='plain'))
+        pickups = stat.cube.districts('pickups')
+        del pickups[None]
+        self.assertEqual(pickups, stat.pickups)
+        self.assertEqual(sum(stat.cube.hours('dropoffs')),
+                         stat.total - stat.invalid)
+        # mapped by rows of the columnar format as by records
+        columnar = self.mapped('columnar')
+        cubes = [list(mapred.StatDB(opts).get_cube('green', 2016, 1).items())
+                 for opts in [self.options(local_root='plain'), columnar]]
+        self.assertEqual(cubes[0], list(stat.cube.items()))
+        self.assertEqual(cubes[1], cubes[0])
+
+    def test_zonemap(self):
+        where = ['fare > 40 and hour < 20']
+        zonemap = self.write('zblock')
+        key = get_zonemap_name('green', 2016, 1)
+        # mappers skip some blocks, not all
+        ranges = zonemap.ranges(Predicate(where))
+        self.assertTrue(0 < sum([end - start for start, end in ranges]) <
+                        zonemap.records)
+        scanned = self.mapped('zblock', '--where', where[0],
+                              local_root='scanned')
+        with open(os.path.join(self.src, key), 'w') as f:
+            f.write(zonemap.encode())
+        skipped = self.mapped('zblock', '--where', where[0],
+                              local_root='skipped')
+        values, flows = self.stat(skipped, query=query_key(where))
+        self.assertEqual((values, flows),
+                         self.stat(scanned, query=query_key(where)))
+        self.assertTrue(0 < values['l'] <
+                        self.stat(self.mapped('plain'))[0]['l'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Origin-destination matrices: counting, merging and StatDB items
+
+from __future__ import print_function
+
+import argparse
+import logging
+import pickle
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+from mapred import StatDB, TaxiStat
+from odmatrix import ODMatrix
+
+class ODMatrixTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        random.seed(4)
+        self.matrix = ODMatrix()
+        self.districts = self.matrix.indexes
+        self.trips = [(random.choice(self.districts),
+                       random.choice(self.districts)) for i in range(2000)]
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def counted(self, trips):
+        od = ODMatrix()
+        for pickup, dropoff in trips: od.add(pickup, dropoff)
+        return od
+
+    def test_add(self):
+        self.assertEqual(self.matrix.counts, None)
+        self.assertEqual(list(self.matrix.items()), [])
+        self.assertEqual(self.matrix.flows(None), Counter())
+        od = self.counted(self.trips)
+        od.add(self.districts[0], None, 5)
+        expected = Counter(self.trips)
+        expected[self.districts[0], None] += 5
+        self.assertEqual(dict(((p, d), n) for p, d, n in od.items()),
+                         dict(expected))
+        for pickup in [self.districts[0], None]:
+            self.assertEqual(od.flows(pickup), Counter(dict([(d, n)
+                for (p, d), n in expected.items() if p == pickup])))
+        self.assertEqual(len(od.counts), len(self.districts) ** 2)
+
+    def test_merge(self):
+        parts = [self.counted(self.trips[i::3]) for i in range(3)]
+        merged = ODMatrix()
+        for part in parts + [ODMatrix()]: merged += part
+        self.assertEqual(list(merged.items()),
+                         list(self.counted(self.trips).items()))
+        # as results of mappers pickle
+        for od in [merged, ODMatrix()]:
+            copy = pickle.loads(pickle.dumps(od, pickle.HIGHEST_PROTOCOL))
+            self.assertEqual(list(copy.items()), list(od.items()))
+
+    def test_statdb(self):
+        tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        try:
+            db = StatDB(argparse.Namespace(backend='local',
+                local_root=tmpdir, ddb_table_name='taxi'))
+            for i in range(2):
+                stat = TaxiStat('green', 2016, 1)
+                stat.od = self.counted(self.trips[i::2])
+                self.assertEqual(sum([len(values) for values in
+                    StatDB.encode_od(stat.od).values()]),
+                    len(list(stat.od.items())))
+                db.append(stat)
+            od = self.counted(self.trips)
+            for pickup in self.districts:
+                self.assertEqual(db.get_flows('green', 2016, 1, pickup),
+                                 od.flows(pickup))
+            self.assertEqual(db.get_flows('green', 2016, 2, None), Counter())
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# --where expressions: validation, records and row groups they match
+
+from __future__ import print_function
+
+import datetime
+import unittest
+
+import numpy
+
+from common import BASE_DATE
+from query import AnyPredicate, NAMES, Predicate, query_key, scan_predicate
+from synth import TripGenerator
+
+class PredicateTest(unittest.TestCase):
+    def setUp(self):
+        self.records = [self.values(line)
+                        for line in TripGenerator().records(500)]
+
+    def values(self, line):
+        """Values of a record in NAMES order, of no district"""
+        fields = line.split(',')
+        pickup_time, dropoff_time = int(fields[0]), int(fields[1])
+        date = BASE_DATE + datetime.timedelta(seconds=pickup_time)
+        return [pickup_time, dropoff_time] + map(float, fields[2:8]) + \
+            [date.hour, date.weekday(), dropoff_time - pickup_time,
+             0, 0, 0, 0]
+
+    def matching(self, terms):
+        p = Predicate(terms)
+        return [values for values in self.records if p.match(*values)]
+
+    def field(self, values, name):
+        return values[NAMES.index(name)]
+
+    def test_invalid(self):
+        for term in ['total_amount > 10',     # unknown name
+                     'fare >',                # syntax
+                     'fare > 10 and',
+                     'abs(fare) > 10',        # calls
+                     'fare.real > 10',        # attributes
+                     'fare ** 2 > 10',        # operators
+                     'fare is None',
+                     '1 < 2',                 # no name
+                     "weekday == 'Someday'",  # constants
+                     "pickup_borough == 'Jersey'",
+                     "pickup_time > 'soon'",
+                     "'Mon' == 'Mon' and fare > 1",
+                     'weekday in 3']:
+            self.assertRaises(ValueError, Predicate, [term])
+        self.assertRaises(ValueError, query_key, ['fare > 10', 'hour <'])
+
+    def test_match(self):
+        self.assertEqual(self.matching(['fare > 20', 'hour < 12']),
+            [values for values in self.records
+             if self.field(values, 'fare') > 20 and
+                self.field(values, 'hour') < 12])
+        self.assertEqual(self.matching(["weekday in ('Sat', 'Sun')"]),
+            [values for values in self.records
+             if self.field(values, 'weekday') in (5, 6)])
+        self.assertEqual(self.matching(['distance / trip_time * 3600 > 20 '
+                                        'or not fare >= 5']),
+            [values for values in self.records
+             if (self.field(values, 'trip_time') and
+                 self.field(values, 'distance') * 3600.0 /
+                 self.field(values, 'trip_time') > 20) or
+                self.field(values, 'fare') < 5])
+        # dates of the first --where syntax, and '='
+        day = BASE_DATE + datetime.timedelta(
+            seconds=self.field(self.records[0], 'pickup_time'))
+        after = self.matching(['pickup_time >= %s' % day.strftime('%Y-%m-%d')])
+        self.assertTrue(0 < len(after) < len(self.records))
+        self.assertEqual(self.matching(['hour = 3']),
+                         self.matching(['hour == 3']))
+
+    def test_mask(self):
+        terms = ['fare > 20 and hour in (1, 2, 3)',
+                 'not distance < 2 or trip_time / distance > 600']
+        p = Predicate(terms)
+        self.assertEqual(p.names, ['distance', 'fare', 'hour', 'trip_time'])
+        self.assertEqual(p.columns, ['distance', 'dropoff_time', 'fare',
+                                     'pickup_time'])
+        columns = dict([(name, numpy.array([self.field(values, name)
+                                            for values in self.records]))
+                        for name in p.names])
+        self.assertEqual(list(p.mask(columns)),
+                         [bool(p.match(*values)) for values in self.records])
+
+    def test_key(self):
+        self.assertEqual(query_key(None), None)
+        self.assertEqual(query_key(['fare>10', ' hour  =  3 ']),
+                         query_key(['fare > 10', 'hour == 3']))
+        self.assertNotEqual(query_key(['fare > 10']),
+                            query_key(['fare > 11']))
+        self.assertEqual(query_key(["pickup_borough == 'Manhattan'"]),
+                         query_key(['pickup_borough == 1']))
+
+    def test_may_match(self):
+        lows, highs = {'fare': 5.0, 'distance': 1.0}, \
+            {'fare': 30.0, 'distance': 8.0}
+        for term, expected in [('fare > 30', False), ('fare >= 30', True),
+                               ('40 < fare', False), ('fare == 4', False),
+                               ('fare in (1, 2)', False),
+                               ('fare in (1, 20)', True),
+                               ('fare > 50 or distance < 2', True),
+                               ('fare > 10 and distance > 9', False),
+                               ('hour == 3', True),
+                               ('not fare > 50', True)]:
+            self.assertEqual(Predicate([term]).may_match(lows, highs),
+                             expected, term)
+        p, q = Predicate(['fare > 40']), Predicate(['distance < 2'])
+        self.assertEqual(scan_predicate([p]), p)
+        self.assertEqual(scan_predicate([p, None]), None)
+        self.assertTrue(isinstance(scan_predicate([p, q]), AnyPredicate))
+        self.assertTrue(scan_predicate([p, q]).may_match(lows, highs))
+
+if __name__ == '__main__':
+    unittest.main()
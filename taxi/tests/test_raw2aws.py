@@ -0,0 +1,446 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Raw2AWS of synthetic raw months to file:// destinations
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import dateutil.parser
+
+import raw2aws
+from synth import TripGenerator
+
+class Ingest(object):
+    """StreamMapper and StatDB of --ingest, counting what is appended"""
+
+    def __init__(self):
+        self.appended = 0
+        self.size = 0
+
+    def write(self, data): self.size += len(data)
+
+    def finish(self): return self.size
+
+    def append(self, size): self.appended += 1
+
+    def close(self): pass
+
+def etag(body): return '"%s"' % hashlib.md5(body).hexdigest()
+
+class S3Client(object):
+    """put_object and multipart uploads of boto3, kept in memory, upload_part
+    fails once `fail_after` parts are uploaded"""
+
+    def __init__(self, fail_after=None):
+        self.objects = {}
+        self.uploads = {}       # upload id => part number => body
+        self.fail_after = fail_after
+        self.sent = 0
+
+    def list_multipart_uploads(self, Bucket, Prefix):
+        return {'Uploads': [{'Key': key, 'UploadId': key, 'Initiated': 0}
+                            for key in self.uploads if key.startswith(Prefix)]}
+
+    def get_paginator(self, name): return self
+
+    def paginate(self, Bucket, Key, UploadId):
+        parts = self.uploads[UploadId]
+        return [{'Parts': [{'PartNumber': n, 'ETag': etag(parts[n])}
+                           for n in sorted(parts)]}]
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self.uploads[Key] = {}
+        return {'UploadId': Key}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if self.sent == self.fail_after: raise IOError('connection reset')
+        self.sent += 1
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': etag(Body)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[Key] = ''.join([parts[part['PartNumber']]
+            for part in MultipartUpload['Parts']])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        del self.uploads[UploadId]
+
+class Raw2AWSTest(unittest.TestCase):
+    COLOR, YEAR, MONTH = 'green', 2016, 1
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        # HOWTO: raw2aws writes its info and warnings to stderr
+        self.messages = raw2aws.info, raw2aws.warning
+        raw2aws.info = raw2aws.warning = lambda msg: None
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        self.src = os.path.join(self.tmpdir, 'src')
+        os.makedirs(self.src)
+        TripGenerator(self.COLOR, self.YEAR, self.MONTH).write_raw(
+            self.src, 1000)
+
+    def tearDown(self):
+        raw2aws.info, raw2aws.warning = self.messages
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        logging.disable(logging.NOTSET)
+
+    def convert(self, dst, *args, **kwargs):
+        """Raw2AWS of the month of arguments, run to `dst` of tmpdir,
+        --ingest counts what it would append unless `ingest` is true"""
+        dst = os.path.join(self.tmpdir, dst)
+        if not os.path.isdir(dst): os.makedirs(dst)
+        month = '%d-%02d' % (self.YEAR, self.MONTH)
+        argv = sys.argv
+        sys.argv = ['raw2aws.py', '--color', self.COLOR, '--start', month,
+                    '--end', month, '--src', 'file://' + self.src,
+                    '--dst', 'file://' + dst] + list(args)
+        try:
+            opts = raw2aws.parse_argv()
+        finally:
+            sys.argv = argv
+        converter = raw2aws.Raw2AWS(opts)
+        if kwargs.get('ingest'):
+            opts.backend = 'local'
+            opts.local_root = os.path.join(self.tmpdir, 'local')
+            try:
+                converter.run_date(opts.start)
+            finally:
+                if converter.mapper: converter.mapper.close()
+            return converter
+        converter.ingested = Ingest()
+        def start_ingest(date):
+            converter.mapper = converter.statdb = converter.ingested
+            converter.sinks.append(converter.ingested)
+        converter.start_ingest = start_ingest
+        converter.run_date(opts.start)
+        return converter
+
+    def output(self, dst):
+        key = raw2aws.get_file_name(self.COLOR, self.YEAR, self.MONTH)
+        path = os.path.join(self.tmpdir, dst, key)
+        with open(path + '.manifest') as f: manifest = json.load(f)
+        with open(path) as f: return f.read(), manifest
+
+    def stat(self, root):
+        """Attributes of the month in StatDB of the local backend of `root`
+        in tmpdir, and the flows out of every district"""
+        from mapred import StatDB
+        from odmatrix import DistrictCounters
+        db = StatDB(argparse.Namespace(backend='local', ddb_table_name='taxi',
+            local_root=os.path.join(self.tmpdir, root)))
+        DistrictCounters.load_numbers()
+        flows = dict([(pickup, db.get_flows(self.COLOR, self.YEAR,
+                                            self.MONTH, pickup))
+                      for pickup in DistrictCounters.indexes])
+        return StatDB.encode(db.get(self.COLOR, self.YEAR, self.MONTH)), flows
+
+    def mapped(self, dst, *args):
+        """stat of mapred.py of arguments, on the records of `dst`"""
+        import mapred
+        argv = sys.argv
+        sys.argv = ['mapred.py', '--src', 'file://' +
+                    os.path.join(self.tmpdir, dst), '-p', '2'] + list(args)
+        try:
+            opts = mapred.parse_argv()
+        finally:
+            sys.argv = argv
+        opts.backend = 'local'
+        opts.local_root = os.path.join(self.tmpdir, 'mapred-' + dst)
+        mapred.start_multiprocess(opts)
+        return self.stat('mapred-' + dst)
+
+    def open(self, max_lines, engine='line'):
+        return raw2aws.RawReader().open(self.COLOR, self.YEAR, self.MONTH,
+            'file://' + self.src, max_lines,
+            raw2aws.RawReader.DEFAULT_BUFFER_SIZE, engine)
+
+    def test_max_lines(self):
+        self.convert('all')
+        records = self.output('all')[0]
+        length = raw2aws.RawReader.MAX_RECORD_LENGTH
+        for n in [0, 1, 777]:
+            for args in [[], ['--engine', 'vector'], ['--sort'],
+                         ['--procs', '2', '--split']]:
+                dst = 'max%d%s' % (n, ''.join(args))
+                self.convert(dst, '--max-lines', str(n), *args)
+                output, manifest = self.output(dst)
+                self.assertEqual(manifest['records'], n, args)
+                if '--sort' in args:
+                    self.assertEqual(sorted(output.splitlines()),
+                        sorted(records[:n * length].splitlines()))
+                else:
+                    self.assertEqual(output, records[:n * length], args)
+            # as a file object reads them
+            for engine in ['line', 'vector']:
+                with self.open(n, engine) as fin:
+                    self.assertEqual(fin.read(), records[:n * length])
+
+    def test_split(self):
+        self.convert('all')
+        records = self.output('all')[0]
+        chunk_size = raw2aws.RawReader.CHUNK_SIZE
+        # HOWTO: pool processes fork after the patch, and inherit it
+        raw2aws.RawReader.CHUNK_SIZE = 5000
+        try:
+            with raw2aws.RawReader().open(self.COLOR, self.YEAR, self.MONTH,
+                    'file://' + self.src, sys.maxint,
+                    raw2aws.RawReader.DEFAULT_BUFFER_SIZE, 'line', 3) as fin:
+                ranges = [(start, end) for _, _, _, path, start, end, _, _
+                          in fin.ranges]
+                with open(path) as f: raw = f.read()
+            self.assertTrue(len(ranges) > 3)
+            self.assertEqual(ranges[-1][1], len(raw))
+            for (a, b), (c, d) in zip(ranges, ranges[1:]):
+                self.assertEqual(b, c)
+                self.assertEqual(raw[b - 1], '\n')
+            for engine in ['line', 'vector']:
+                dst = 'split' + engine
+                self.convert(dst, '--split', '--procs', '3',
+                             '--engine', engine)
+                self.assertEqual(self.output(dst)[0], records)
+        finally:
+            raw2aws.RawReader.CHUNK_SIZE = chunk_size
+
+    def test_max_lines_pipeline(self):
+        from pipeline import UploadPipeline
+        self.convert('all')
+        records = self.output('all')[0]
+        length = raw2aws.RawReader.MAX_RECORD_LENGTH
+        for n in [1, 777]:
+            client = S3Client()
+            with self.open(n, 'vector') as fin:
+                UploadPipeline(fin, raw2aws.convert_chunk).upload(
+                    client, 'bucket', 'key')
+            self.assertEqual(client.objects['key'], records[:n * length])
+
+    def test_pipeline(self):
+        from pipeline import UploadPipeline
+        self.convert('all')
+        records = self.output('all')[0]
+        client = S3Client(fail_after=2)
+        def pipeline():
+            # HOWTO: a tiny CHUNK_SIZE cuts the month into many chunks
+            fin = self.open(sys.maxint, 'vector')
+            fin.CHUNK_SIZE = 4000
+            checksum = raw2aws.Checksum()
+            return fin, checksum, UploadPipeline(fin, raw2aws.convert_chunk,
+                procs=2, part_size=8000, threads=2, checksum=checksum)
+        fin, checksum, p = pipeline()
+        try:
+            self.assertRaises(IOError, p.upload, client, 'bucket', 'key')
+        finally:
+            fin.close()
+        self.assertNotIn('key', client.objects)
+        client.fail_after = None
+        fin, checksum, p = pipeline()
+        try:
+            p.upload(client, 'bucket', 'key')
+        finally:
+            fin.close()
+        self.assertEqual(client.objects['key'], records)
+        self.assertEqual(checksum.md5.hexdigest(),
+                         hashlib.md5(records).hexdigest())
+        self.assertEqual(p.resumed, 2)
+        read, convert, upload = p.stages
+        self.assertTrue(convert.items > 1)
+        self.assertEqual(convert.bytes, len(records))
+        self.assertEqual(upload.bytes + 2 * 8000, len(records))
+        self.assertEqual(len(p.report()), 5)
+
+    def test_resume_upload(self):
+        from pipeline import MultipartUpload
+        self.convert('all')
+        records = self.output('all')[0]
+        blocks = [records[i:i + 1000] for i in range(0, len(records), 1000)]
+        client = S3Client(fail_after=3)
+        self.assertRaises(IOError, MultipartUpload(8000, threads=1).upload,
+                          client, 'bucket', 'key', iter(blocks))
+        self.assertNotIn('key', client.objects)
+        # the unfinished upload keeps its parts, they are not sent again
+        client.fail_after = None
+        upload = MultipartUpload(8000, threads=1).upload(
+            client, 'bucket', 'key', iter(blocks))
+        self.assertEqual(upload.resumed, 3)
+        self.assertEqual(client.sent, (len(records) + 7999) // 8000)
+        self.assertEqual(client.objects['key'], records)
+        self.assertEqual(client.uploads, {})
+
+    def test_up_to_date(self):
+        self.convert('dst')
+        records, manifest = self.output('dst')
+        key = raw2aws.get_file_name(self.COLOR, self.YEAR, self.MONTH)
+        path = os.path.join(self.tmpdir, 'dst', key)
+        def mark():
+            with open(path, 'w') as f: f.write('#' * len(records))
+        def converted():
+            return self.output('dst')[0] != '#' * len(records)
+        # a rerun skips a month of an unchanged source and options
+        mark()
+        self.convert('dst')
+        self.assertFalse(converted())
+        for args in [['--max-lines', '10'], ['--sort'], ['--force']]:
+            mark()
+            self.convert('dst', *args)
+            self.assertTrue(converted(), args)
+        # a changed source, or an output of another size
+        self.convert('dst')
+        mark()
+        source = os.path.join(self.src, os.listdir(self.src)[0])
+        os.utime(source, (0, 0))
+        self.convert('dst')
+        self.assertTrue(converted())
+        with open(path, 'a') as f: f.write('#')
+        self.convert('dst')
+        output, again = self.output('dst')
+        self.assertEqual(output, records)
+        self.assertEqual(again['md5'], manifest['md5'])
+
+    def test_stored_md5(self):
+        self.convert('all')
+        records = self.output('all')[1]['records']
+        for fmt in ['plain', 'zblock', 'columnar']:
+            dst = 'md5' + fmt
+            self.convert(dst, '--format', fmt)
+            key = raw2aws.get_file_name(self.COLOR, self.YEAR, self.MONTH,
+                                        fmt)
+            path = os.path.join(self.tmpdir, dst, key)
+            with open(path + '.manifest') as f: manifest = json.load(f)
+            with open(path) as f: stored = f.read()
+            self.assertEqual(manifest['md5'], hashlib.md5(stored).hexdigest())
+            self.assertEqual(manifest['size'], len(stored))
+            self.assertEqual(manifest['records'], records)
+
+    def test_ingest_once(self):
+        first = self.convert('dst', '--ingest')
+        self.assertEqual(first.ingested.appended, 1)
+        self.assertTrue(self.output('dst')[1]['ingested'])
+        # a rerun, e.g. of an interrupted range of months, skips it
+        self.assertEqual(self.convert('dst', '--ingest').ingested.appended, 0)
+        # converted again, the month stays ingested
+        again = self.convert('dst', '--ingest', '--max-lines', '100')
+        self.assertEqual(again.ingested.appended, 0)
+        self.assertTrue(self.output('dst')[1]['ingested'])
+        self.assertEqual(self.convert('dst', '--ingest', '--force')
+                         .ingested.appended, 1)
+
+    def test_ingest_stat(self):
+        self.convert('dst', '--ingest', '--format', 'zblock', '--procs', '2',
+                     ingest=True)
+        key = raw2aws.get_file_name(self.COLOR, self.YEAR, self.MONTH,
+                                    'zblock')
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'dst', key)))
+        # what mapred.py appends of the converted month
+        self.convert('plain')
+        stat = self.stat('local')
+        self.assertEqual(stat, self.mapped('plain'))
+        self.assertTrue(stat[0]['l'] > 0)
+
+    def test_geocode(self):
+        from geo import NYCDistrictCode
+        self.convert('plain')
+        self.convert('geocoded', '--geocode', '--engine', 'vector')
+        plain = self.output('plain')[0].splitlines(True)
+        geocoded = self.output('geocoded')[0].splitlines(True)
+        coder = NYCDistrictCode()
+        offset = NYCDistrictCode.OFFSET
+        for record, tagged in zip(plain, geocoded):
+            self.assertEqual(tagged[:offset], record[:offset])
+            fields = map(float, record.split(',')[2:6])
+            self.assertEqual(coder.read(tagged),
+                (coder.locate(*fields[:2]), coder.locate(*fields[2:])))
+        self.assertEqual(len(geocoded), len(plain))
+        # mappers read districts of the tags, as they would locate them
+        self.assertEqual(self.mapped('geocoded'), self.mapped('plain'))
+
+    def test_ingest_converted(self):
+        self.convert('dst')
+        self.assertFalse(self.output('dst')[1]['ingested'])
+        self.assertEqual(self.convert('dst', '--ingest').ingested.appended, 1)
+
+class RingBufferTest(unittest.TestCase):
+    def test_random(self):
+        rand = random.Random(0)
+        buf = raw2aws.RingBuffer(16)
+        expected, copied = '', 0
+        for i in range(2000):
+            if rand.random() < 0.5:
+                data = ''.join([chr(rand.randrange(256))
+                                for j in range(rand.randrange(40))])
+                grown = len(expected) + len(data) > buf.capacity()
+                if grown: copied += len(expected)
+                buf.write(data)
+                expected += data
+                copied += len(data)
+            else:
+                size = rand.randrange(-1, 40)
+                n = len(expected) if size < 0 else min(size, len(expected))
+                self.assertEqual(str(buf.read(size)), expected[:n])
+                expected = expected[n:]
+                copied += n
+            self.assertEqual(len(buf), len(expected))
+            self.assertEqual(buf.copied, copied)
+        self.assertTrue(buf.capacity() >= 40)
+
+    def test_wrap(self):
+        buf = raw2aws.RingBuffer(10)
+        buf.write('abcdefgh')
+        self.assertEqual(str(buf.read(6)), 'abcdef')
+        buf.write('ijklmn')     # wraps around the end of the array
+        self.assertEqual(buf.capacity(), 10)
+        b = bytearray(5)
+        self.assertEqual(buf.readinto(b), 5)
+        self.assertEqual(str(b), 'ghijk')
+        buf.write('opqrstuv')   # grows, keeping what is buffered
+        self.assertEqual(buf.capacity(), 20)
+        self.assertEqual(str(buf.read()), 'lmnopqrstuv')
+        self.assertEqual(buf.readinto(b), 0)
+
+class RawReaderTest(unittest.TestCase):
+    def delta_seconds(self, time):
+        delta = dateutil.parser.parse(time) - raw2aws.RawReader.START_DATE
+        return int(delta.total_seconds())
+
+    def test_delta_seconds(self):
+        reader = raw2aws.RawReader()
+        random.seed(1)
+        start = datetime.datetime(2008, 12, 1)
+        times = [(start + datetime.timedelta(seconds=random.randrange(
+            8 * 366 * 86400))).strftime('%Y-%m-%d %H:%M:%S')
+            for i in range(2000)]
+        times += ['2012-02-29 23:59:59', '2016-03-01 00:00:00',
+                  '2009-01-01 00:00:00', '2008-12-31 23:59:59']
+        # memoized or not, as dateutil parses them
+        for time in times + times:
+            self.assertEqual(reader.delta_seconds(time),
+                             self.delta_seconds(time), time)
+        # other layouts go to dateutil, and are not memoized
+        for time in ['2016-01-05T10:20:30', '2016-1-5 10:20:30',
+                     '2016-01-05 10:20', '01/05/2016 10:20:30']:
+            self.assertEqual(reader.delta_seconds(time),
+                             self.delta_seconds(time), time)
+        self.assertEqual(sorted(set(len(clock) for clock in reader.times)),
+                         [9])
+        for time in ['2015-02-29 10:00:00', '2016-01-05 24:00:00',
+                     '2016-13-01 00:00:00']:
+            self.assertRaises(ValueError, reader.delta_seconds, time)
+        self.assertNotIn('2015-02-29', reader.dates)
+
+if __name__ == '__main__':
+    unittest.main()
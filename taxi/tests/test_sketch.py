@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Quantile sketches: accuracy, merging and StatDB items
+
+from __future__ import print_function
+
+import argparse
+import logging
+import math
+import random
+import shutil
+import tempfile
+import unittest
+from collections import Counter
+
+from mapred import StatDB, TaxiStat
+from sketch import ALPHA, FARE_SKETCH, QUANTILES, LogSketch
+
+class LogSketchTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(2)
+        self.sketch = LogSketch(0.01, 10000.0)
+        # skewed as fares are, over several decades
+        self.values = [math.exp(random.gauss(2.5, 1.0)) for i in range(5000)]
+
+    def sketched(self, values):
+        sketch = Counter()
+        self.sketch.count(sketch, values)
+        return sketch
+
+    def exact(self, values, q):
+        """Value of quantile q, of the rank LogSketch.quantile finds"""
+        return sorted(values)[int(q * (len(values) - 1))]
+
+    def test_buckets(self):
+        s = self.sketch
+        self.assertTrue(s.size < 1000)
+        for value in self.values + [s.low, s.high - 1e-9]:
+            self.assertTrue(abs(s.value(s.bucket(value)) - value) <=
+                            ALPHA * value * (1 + 1e-9), value)
+        # out of range values, in the first and last buckets
+        self.assertEqual(s.bucket(0.001), 0)
+        self.assertEqual(s.value(0), 0.0)
+        self.assertEqual(s.bucket(1e6), s.size - 1)
+
+    def test_quantiles(self):
+        sketch = self.sketched(self.values)
+        self.assertEqual(sum(sketch.values()), len(self.values))
+        for q in QUANTILES + [0.0, 0.25, 1.0]:
+            exact = self.exact(self.values, q)
+            self.assertTrue(abs(self.sketch.quantile(sketch, q) - exact) <=
+                            ALPHA * exact * (1 + 1e-9), q)
+        self.assertEqual(self.sketch.quantiles(Counter()),
+                         [None] * len(QUANTILES))
+
+    def test_merge(self):
+        parts = [self.values[i::3] for i in range(3)]
+        merged = Counter()
+        for part in parts: merged.update(self.sketched(part))
+        self.assertEqual(merged, self.sketched(self.values))
+        self.assertEqual(self.sketch.quantiles(merged),
+                         self.sketch.quantiles(self.sketched(self.values)))
+
+class StatSketchTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        random.seed(3)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        logging.disable(logging.NOTSET)
+
+    def stat(self, fares):
+        stat = TaxiStat('green', 2016, 1)
+        FARE_SKETCH.count(stat.fare_sketch, fares)
+        return stat
+
+    def test_statdb(self):
+        fares = [[random.uniform(2.5, 80.0) for i in range(1000)]
+                 for j in range(2)]
+        db = StatDB(argparse.Namespace(backend='local', local_root=self.tmpdir,
+                                       ddb_table_name='taxi'))
+        # mappers append their months, adding up in the item
+        for part in fares: db.append(self.stat(part))
+        stat = db.get('green', 2016, 1)
+        self.assertEqual(stat.fare_sketch,
+                         self.stat(fares[0] + fares[1]).fare_sketch)
+        merged = self.stat(fares[0]) + self.stat(fares[1])
+        self.assertEqual(stat.get_fare_quantiles(),
+                         merged.get_fare_quantiles())
+        for q, value in zip(QUANTILES, stat.get_fare_quantiles()):
+            exact = sorted(fares[0] + fares[1])[int(q * 1999)]
+            self.assertTrue(abs(value - exact) <= ALPHA * exact * (1 + 1e-9))
+        self.assertEqual(TaxiStat('green', 2016, 1).get_fare_quantiles(),
+                         [None] * len(QUANTILES))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Record ranges of tasks and of mappers
+
+from __future__ import print_function
+
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import botocore
+
+from backends import SQLiteTable
+from tasks import Task, TaskHeartbeat, TaskManager, ThroughputHistory
+
+class CutTest(unittest.TestCase):
+    def assertCovers(self, start, end, n):
+        """cut of [start, end) into n parts, contiguous and proportional"""
+        parts = TaskManager.cut(start, end - 1, n)
+        self.assertEqual(len(parts), n)
+        self.assertEqual(parts[0][0], start)
+        self.assertEqual(parts[-1][1], end)
+        for (a, b), (c, d) in zip(parts, parts[1:]): self.assertEqual(b, c)
+        sizes = [b - a for a, b in parts]
+        self.assertTrue(max(sizes) - min(sizes) <= 1, (start, end, n))
+        for i in range(n):
+            self.assertEqual(TaskManager.cut(start, end - 1, n, i), parts[i])
+
+    def test_small_ranges(self):
+        for count in range(1, 40):
+            for n in range(1, count + 1):
+                self.assertCovers(100, 100 + count, n)
+
+    def test_reported_ranges(self):
+        self.assertEqual(TaskManager.cut(0, 7, 4),
+                         [[0, 2], [2, 4], [4, 6], [6, 8]])
+        self.assertCovers(0, 12, 4)
+        self.assertCovers(0, 10, 8)
+
+    def test_month(self):
+        for n in [1, 2, 7, 64, 1000]:
+            self.assertCovers(0, 296932, n)
+
+class ThroughputHistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        self.table = SQLiteTable(self.tmpdir + '/ddb/taxi.db')
+        self.table.create()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_shared(self):
+        """Rates of workers are seen by tasks created on another box"""
+        self.assertEqual(ThroughputHistory(self.table, 'h').rate(), None)
+        worker = ThroughputHistory(self.table, 'h')
+        for records, seconds in [(1000, 1.0), (3000, 1.0), (2000, 1.0)]:
+            worker.add(records, seconds)
+        self.assertEqual(worker.rate(), 2000.0)
+        self.assertEqual(ThroughputHistory(self.table, 'h').rate(), 2000.0)
+        self.assertEqual(ThroughputHistory(self.table, 'other').rate(), None)
+
+    def test_latest_samples(self):
+        worker = ThroughputHistory(self.table, 'h')
+        n = ThroughputHistory.MAX_SAMPLES
+        for i in range(n + 8): worker.add(1000 * (i + 1), 1.0)
+        self.assertEqual(len(worker.samples), n)
+        history = ThroughputHistory(self.table, 'h')
+        self.assertEqual([records for _, records, _ in history.samples],
+                         [1000 * (i + 1) for i in range(8, n + 8)])
+        self.assertEqual(len(self.table.keys('#h')), n)
+
+class Extensions(object):
+    """TaskManager extending tasks, failing with `errors` first"""
+
+    logger = logging.getLogger('test')
+
+    def __init__(self, errors):
+        self.errors = errors
+        self.extended = 0
+
+    def extend_task(self, task):
+        self.extended += 1
+        if self.errors: raise self.errors.pop(0)
+
+class TaskHeartbeatTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.WARNING)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_backend_errors(self):
+        manager = Extensions([
+            botocore.exceptions.ClientError(
+                {'Error': {'Code': '500', 'Message': 'internal error'}},
+                'ChangeMessageVisibility'),
+            sqlite3.OperationalError('database is locked'),
+            IOError('connection reset')])
+        heartbeat = TaskHeartbeat(manager, None, 0.001)
+        heartbeat.start()
+        for i in range(1000):
+            if manager.extended > 3: break
+            time.sleep(0.01)
+        heartbeat.stop()
+        # the heartbeat keeps beating through the errors
+        self.assertTrue(manager.extended > 3)
+
+
+class GatherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        opts = argparse.Namespace(backend='local', local_root=self.tmpdir,
+            ddb_table_name='taxi', throughput_history='throughput',
+            sqs_queue='tasks', bucket='bucket', verbose=logging.WARNING)
+        self.manager = TaskManager(opts)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def test_gather(self):
+        queue = self.manager.queue
+        where = [[], ['fare > 10'], ['hour == 1']]
+        for i, queries in enumerate(where):
+            queue.send_message(str(Task('green', 2016, 1, 0, 1000,
+                                        queries=[queries])))
+            queue.send_message(str(Task('green', 2016, 1, 1000, 2000,
+                                        queries=[queries])))
+        task = self.manager.retrieve_task()
+        self.assertEqual(task.scan(), ('green', 2016, 1, 0, 1000))
+        self.assertEqual(task.queries, where)
+        self.assertEqual(len(task.merged), 2)
+        # tasks of other scans are not received, nor hidden
+        handles = queue.db.execute('SELECT handle FROM messages '
+            'WHERE id IN (2, 4, 6)').fetchall()
+        self.assertEqual(handles, [(None,)] * 3)
+        other = self.manager.retrieve_task()
+        self.assertEqual(other.scan(), ('green', 2016, 1, 1000, 2000))
+        self.assertEqual(len(other.merged), 2)
+        self.assertEqual(self.manager.retrieve_task(), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
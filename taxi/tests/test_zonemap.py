@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Zone maps of synthetic records, and the blocks they rule out
+
+from __future__ import print_function
+
+import shutil
+import tempfile
+import unittest
+
+from backends import DirectoryStore
+from common import get_zonemap_name
+from query import Predicate
+from synth import TripGenerator
+from zonemap import ZoneMap
+
+class ZoneMapTest(unittest.TestCase):
+    BLOCK_RECORDS = 64
+
+    def setUp(self):
+        self.data = ''.join(TripGenerator().records(500))
+        self.lines = self.data.splitlines(True)
+        self.zonemap = ZoneMap(self.BLOCK_RECORDS)
+        for i in range(0, len(self.data), 1000):
+            self.zonemap.write(self.data[i:i + 1000])
+        self.zonemap.finish()
+
+    def fares(self, n):
+        """Fares of block n"""
+        lines = self.lines[n * self.BLOCK_RECORDS:
+                           (n + 1) * self.BLOCK_RECORDS]
+        return [float(line.split(',')[7]) for line in lines]
+
+    def test_bounds(self):
+        self.assertEqual(self.zonemap.records, len(self.lines))
+        blocks = (len(self.lines) + self.BLOCK_RECORDS - 1) // \
+            self.BLOCK_RECORDS
+        self.assertEqual(len(self.zonemap.lows), blocks)
+        for n in range(blocks):
+            fares = self.fares(n)
+            self.assertEqual(self.zonemap.lows[n]['fare'], min(fares))
+            self.assertEqual(self.zonemap.highs[n]['fare'], max(fares))
+
+    def test_encode(self):
+        decoded = ZoneMap.decode(self.zonemap.encode())
+        for name in ['block_records', 'records', 'lows', 'highs']:
+            self.assertEqual(getattr(decoded, name),
+                             getattr(self.zonemap, name))
+        tmpdir = tempfile.mkdtemp(prefix='taxi-test-')
+        try:
+            store = DirectoryStore(tmpdir)
+            self.assertEqual(ZoneMap.load(store, 'green', 2016, 1), None)
+            store.put(get_zonemap_name('green', 2016, 1),
+                      self.zonemap.encode())
+            self.assertEqual(ZoneMap.load(store, 'green', 2016, 1).highs,
+                             self.zonemap.highs)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def test_ranges(self):
+        # a fare above the least of the block maximums rules blocks out
+        fare = sorted([high['fare'] for high in self.zonemap.highs])[2]
+        predicate = Predicate(['fare > %s' % fare])
+        ranges = self.zonemap.ranges(predicate)
+        n = self.BLOCK_RECORDS
+        kept = [i for i in range(len(self.zonemap.lows))
+                if max(self.fares(i)) > fare]
+        self.assertTrue(0 < len(kept) < len(self.zonemap.lows))
+        self.assertEqual(sum([end - start for start, end in ranges]),
+            sum([len(self.fares(i)) for i in kept]))
+        # every matching record is in a range, ranges are merged
+        for i, line in enumerate(self.lines):
+            if float(line.split(',')[7]) > fare:
+                self.assertTrue(any([start <= i < end
+                                     for start, end in ranges]))
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            self.assertTrue(end < start)
+        # ranges within [start, end)
+        for start, end in self.zonemap.ranges(predicate, n + 10, 3 * n):
+            self.assertTrue(n + 10 <= start < end <= 3 * n)
+        self.assertEqual(self.zonemap.ranges(Predicate(['fare > 1000'])), [])
+        self.assertEqual(self.zonemap.ranges(Predicate(['hour < 25'])),
+                         [(0, len(self.lines))])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# All rights reserved.
+
+# Zone Maps: Minimum and Maximum of Record Fields per Block
+#
+# raw2aws.py --zonemap writes <key>.zonemap.json next to a monthly file,
+# with the minimum and maximum of a few fields of every block of records.
+# Blocks are those of the zblock format, or row groups of the columnar one,
+# so a block that cannot match a predicate of query.py is neither fetched
+# nor decompressed. Comparisons of these fields with constants rule blocks
+# out, such as
+#
+#   pickup_latitude < 40.75     fare > 50     pickup_time >= 2016-01-04T13
+
+from __future__ import print_function
+
+import json
+
+from common import *
+from formats import BLOCK_RECORDS
+
+__all__ = ['FIELDS', 'ZoneMap']
+
+# name => (index in record, type) of fields with zone maps
+FIELDS = {
+    'pickup_time':       (0, int),
+    'pickup_longitude':  (2, float),
+    'pickup_latitude':   (3, float),
+    'dropoff_longitude': (4, float),
+    'dropoff_latitude':  (5, float),
+    'distance':          (6, float),
+    'fare':              (7, float)
+}
+NAMES = sorted(FIELDS, key=lambda name: FIELDS[name][0])
+
+class ZoneMap:
+    """Field bounds of blocks of `block_records` records
+
+    Records are written as they are to a file, so a ZoneMap is a sink of
+    raw2aws.py and `finish()` closes the last, short, block.
+    """
+
+    def __init__(self, block_records=BLOCK_RECORDS):
+        self.block_records = block_records
+        self.records = 0
+        self.lows = []      # {name: minimum} of each block
+        self.highs = []     # {name: maximum} of each block
+        self.buf = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buffered += len(data)
+        block_size = self.block_records * RECORD_LENGTH
+        if self.buffered < block_size: return
+        data = ''.join(self.buf)
+        n = len(data) - len(data) % block_size
+        for start in range(0, n, block_size):
+            self.add_block(data[start:start + block_size])
+        self.buf, self.buffered = [data[n:]], len(data) - n
+
+    def add_block(self, data):
+        columns = zip(*[line.split(',', 8) for line in data.splitlines()])
+        low, high = {}, {}
+        for name in NAMES:
+            index, type_ = FIELDS[name]
+            values = map(type_, columns[index])
+            low[name], high[name] = min(values), max(values)
+        self.lows.append(low)
+        self.highs.append(high)
+        self.records += len(data) / RECORD_LENGTH
+
+    def finish(self):
+        data = ''.join(self.buf)
+        if data: self.add_block(data)
+        self.buf, self.buffered = [], 0
+        return self
+
+    def ranges(self, predicate, start=0, end=None):
+        """Records [start, end) of blocks that may match, merged"""
+        if end is None: end = self.records
+        ranges = []
+        for n, (low, high) in enumerate(zip(self.lows, self.highs)):
+            first = max(n * self.block_records, start)
+            last = min((n + 1) * self.block_records, self.records, end)
+            if first >= last or not predicate.may_match(low, high): continue
+            if ranges and ranges[-1][1] == first:
+                ranges[-1] = (ranges[-1][0], last)
+            else:
+                ranges.append((first, last))
+        return ranges
+
+    def encode(self):
+        return json.dumps({
+            'block_records': self.block_records,
+            'records': self.records,
+            'fields': NAMES,
+            'min': [[low[name] for name in NAMES] for low in self.lows],
+            'max': [[high[name] for name in NAMES] for high in self.highs]
+        })
+
+    @classmethod
+    def decode(cls, body):
+        zonemap = json.loads(body)
+        self = cls(zonemap['block_records'])
+        self.records = zonemap['records']
+        names = zonemap['fields']
+        self.lows = [dict(zip(names, low)) for low in zonemap['min']]
+        self.highs = [dict(zip(names, high)) for high in zonemap['max']]
+        return self
+
+    @classmethod
+    def load(cls, store, color, year, month):
+        """Zone map of a month in a store, None if there is none"""
+        body = store.get(get_zonemap_name(color, year, month))
+        if body is None: return None
+        return cls.decode(body)